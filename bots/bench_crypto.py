@@ -0,0 +1,102 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+# ==============================================================================
+# MIT License
+#
+# Copyright (c) 2024 Albert Moky
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+# ==============================================================================
+
+"""
+    Benchmark: Crypto Pool
+    ~~~~~~~~~~~~~~~~~~~~~~
+
+    Messages/sec for asymmetric crypto of messages (sign, verify, encrypt & decrypt message key),
+    run in place and in crypto pool with different numbers of workers
+
+        usage: bench_crypto.py [messages] [mode]
+"""
+
+import asyncio
+import os
+import sys
+import time
+
+from dimples.utils import Path
+
+path = Path.abs(path=__file__)
+path = Path.dir(path=path)
+path = Path.dir(path=path)
+Path.add(path=path)
+
+from dimples import AsymmetricKey, PrivateKey, SymmetricKey
+
+from libs.client import CryptoPool
+
+
+async def run_message(pool, sign_key, verify_key, decrypt_key, encrypt_key, data: bytes):
+    if pool is None:
+        # in place, as messenger does by default
+        encrypted = encrypt_key.encrypt(data=data, extra={})
+        plaintext = decrypt_key.decrypt(data=encrypted, params={})
+        signature = sign_key.sign(data=encrypted)
+        ok = verify_key.verify(data=encrypted, signature=signature)
+    else:
+        encrypted = await pool.encrypt(key=encrypt_key, data=data)
+        plaintext = await pool.decrypt(keys=[decrypt_key], data=encrypted)
+        signature = await pool.sign(key=sign_key, data=encrypted)
+        ok = await pool.verify(keys=[verify_key], data=encrypted, signature=signature)
+    assert ok and plaintext == data, 'crypto error'
+
+
+async def bench(pool, count: int, keys) -> float:
+    data = SymmetricKey.generate(algorithm=SymmetricKey.AES).data
+    start = time.time()
+    await asyncio.gather(*[run_message(pool, *keys, data=data) for _ in range(count)])
+    return count / (time.time() - start)
+
+
+async def async_main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    mode = sys.argv[2] if len(sys.argv) > 2 else CryptoPool.PROCESS
+    sign_key = PrivateKey.generate(algorithm=AsymmetricKey.ECC)
+    decrypt_key = PrivateKey.generate(algorithm=AsymmetricKey.RSA)
+    keys = (sign_key, sign_key.public_key, decrypt_key, decrypt_key.public_key)
+    cores = os.cpu_count() or 1
+    print('%d messages, %d CPU core(s), mode: %s' % (count, cores, mode))
+    base = await bench(pool=None, count=count, keys=keys)
+    print('  in place   : %8.1f msg/s' % base)
+    workers = 1
+    while workers <= cores * 2:
+        pool = CryptoPool(workers=workers, mode=mode)
+        # warm up: start workers & cache keys
+        await bench(pool=pool, count=workers * 2, keys=keys)
+        speed = await bench(pool=pool, count=count, keys=keys)
+        pool.shutdown()
+        print('  %2d worker(s): %8.1f msg/s (x%.2f)' % (workers, speed, speed / base))
+        workers *= 2
+
+
+def main():
+    asyncio.run(async_main())
+
+
+if __name__ == '__main__':
+    main()
@@ -44,6 +44,7 @@ from engine import WebPageService
 
 from bots.shared import GlobalVariable
 from bots.shared import start_bot
+from bots.shared import stop_bot
 
 
 class BotMessageProcessor(ClientProcessor):
@@ -75,8 +76,11 @@ async def async_main():
                              processor_class=BotMessageProcessor)
     # main run loop
     await client.start()
-    await client.run()
-    # await client.stop()
+    try:
+        await client.run()
+    finally:
+        # await client.stop()
+        stop_bot()
     Log.warning(msg='bot stopped: %s' % client)
 
 
@@ -23,7 +23,9 @@
 # SOFTWARE.
 # ==============================================================================
 
+import asyncio
 import getopt
+import os
 import sys
 import time
 from typing import Optional
@@ -38,6 +40,9 @@ from dimples.client import ClientArchivist, ClientFacebook
 
 from libs.utils import Path
 from libs.utils import Singleton
+from libs.utils import Runner
+from libs.utils import MetricsExporter
+from libs.utils import Profiler
 from libs.database.redis import RedisConnector
 from libs.database import DbInfo
 from libs.database import Database
@@ -46,6 +51,16 @@ from libs.client import ClientSession, ClientMessenger
 from libs.client import ClientProcessor, ClientPacker
 from libs.client import Terminal
 from libs.client import Emitter
+from libs.client import FileCache
+from libs.client import HttpUploadBackend, Uploader
+from libs.client import UploadIndex
+from libs.client import Downloader
+from libs.client import FileOutboxStorage, RedisOutboxStorage, Outbox
+from libs.client import PriorityPolicy
+from libs.client import CryptoPool, MessageKeyCache
+from libs.client import DuplicateFilter
+from libs.client import InboundPipeline
+from libs.client.priority import parse_types, parse_flags
 from libs.client import SharedGroupManager
 
 
@@ -147,8 +162,10 @@ async def create_database(config: Config) -> Database:
     private = config.database_private
     redis_conn = create_redis_connector(config=config)
     info = DbInfo(redis_connector=redis_conn, root_dir=root, public_dir=public, private_dir=private)
-    # create database
-    db = Database(info=info)
+    # create database for the bot
+    bid = config.get_identifier(section='bot', option='id')
+    assert bid is not None, 'bot ID not set: %s' % config
+    db = Database(info=info, owner=bid)
     db.show_info()
     # update neighbor stations (default provider)
     provider = ProviderInfo.GSP
@@ -202,14 +219,44 @@ def create_session(facebook: CommonFacebook, database: SessionDBI, host: str, po
     return session
 
 
-def create_messenger(facebook: CommonFacebook, database: MessageDBI,
+def create_crypto_pool(config: Config) -> Optional[CryptoPool]:
+    workers = config.get_integer(section='packer', option='crypto_workers')
+    if workers <= 0:
+        return None
+    mode = config.get_string(section='packer', option='crypto_mode')
+    batch_size = config.get_integer(section='packer', option='crypto_batch')
+    return CryptoPool(workers=workers, mode=mode, batch_size=batch_size)
+
+
+def create_message_keys(config: Config) -> MessageKeyCache:
+    ttl = config.get_integer(section='packer', option='key_ttl')
+    max_messages = config.get_integer(section='packer', option='key_messages')
+    capacity = config.get_integer(section='packer', option='key_capacity')
+    return MessageKeyCache(ttl=ttl, max_messages=max_messages, capacity=capacity)
+
+
+def create_duplicate_filter(config: Config) -> DuplicateFilter:
+    window = config.get_integer(section='packer', option='dedup_window')
+    capacity = config.get_integer(section='packer', option='dedup_capacity')
+    return DuplicateFilter(window=window, capacity=capacity)
+
+
+def create_messenger(config: Config, facebook: CommonFacebook, database: MessageDBI,
                      session: ClientSession, processor_class) -> ClientMessenger:
     assert issubclass(processor_class, ClientProcessor), 'processor class error: %s' % processor_class
     # 1. create messenger with session and MessageDB
     messenger = ClientMessenger(session=session, facebook=facebook, database=database)
+    messenger.crypto_pool = create_crypto_pool(config=config)
+    messenger.message_keys = create_message_keys(config=config)
+    if config.get_boolean(section='packer', option='pipeline'):
+        queue_size = config.get_integer(section='packer', option='pipeline_queue')
+        batch_size = config.get_integer(section='packer', option='pipeline_batch')
+        messenger.inbound_pipeline = InboundPipeline(messenger=messenger, queue_size=queue_size, batch_size=batch_size)
     # 2. create packer, processor for messenger
     #    they have weak references to facebook & messenger
-    messenger.packer = ClientPacker(facebook=facebook, messenger=messenger)
+    packer = ClientPacker(facebook=facebook, messenger=messenger)
+    packer.duplicate_filter = create_duplicate_filter(config=config)
+    messenger.packer = packer
     messenger.processor = processor_class(facebook=facebook, messenger=messenger)
     # 3. set weak reference to messenger
     session.messenger = messenger
@@ -219,6 +266,109 @@ def create_messenger(facebook: CommonFacebook, database: MessageDBI,
     return messenger
 
 
+def create_file_cache(config: Config) -> FileCache:
+    root = config.get_string(section='emitter', option='cache_dir')
+    if root is None:
+        root = Path.join(config.database_root, 'protected', 'caches')
+    quota = config.get_integer(section='emitter', option='cache_quota')
+    cache = FileCache(root=root, quota=quota)
+    Runner.thread_run(runner=cache)
+    return cache
+
+
+def create_uploader(config: Config, emitter: Emitter) -> Optional[Uploader]:
+    api = config.get_string(section='uploader', option='api')
+    if api is None:
+        print('!!! upload API not set, file messages cannot be sent')
+        return None
+    pool_size = config.get_integer(section='uploader', option='pool_size')
+    backend = HttpUploadBackend(api=api, pool_size=pool_size)
+    concurrency = config.get_integer(section='uploader', option='concurrency')
+    retries = config.get_integer(section='uploader', option='retries')
+    return Uploader(backend=backend, delegate=emitter, max_concurrent=concurrency, max_retries=retries)
+
+
+def create_downloader(config: Config, file_cache: FileCache) -> Downloader:
+    root = config.get_string(section='downloader', option='tmp_dir')
+    if root is None:
+        root = Path.join(config.database_root, 'protected', 'downloads')
+    downloader = Downloader()
+    downloader.root = root
+    downloader.file_cache = file_cache
+    downloader.pool_size = config.get_integer(section='downloader', option='pool_size')
+    downloader.max_concurrent = config.get_integer(section='downloader', option='concurrency')
+    downloader.max_size = config.get_integer(section='downloader', option='max_size')
+    Runner.thread_run(runner=downloader)
+    return downloader
+
+
+def get_bot_path(config: Config, *names: str) -> str:
+    """ '{ROOT}/protected/{ADDRESS}/...', bots sharing the same config must not share these files """
+    bid = config.get_identifier(section='bot', option='id')
+    assert bid is not None, 'bot ID not set: %s' % config
+    return Path.join(config.database_root, 'protected', str(bid.address), *names)
+
+
+def create_upload_index(config: Config) -> UploadIndex:
+    path = config.get_string(section='uploader', option='index')
+    if path is None:
+        path = get_bot_path(config, 'uploads', 'index')
+    expires = config.get_integer(section='uploader', option='url_expires')
+    return UploadIndex(path=path, expires=expires)
+
+
+def create_outbox(config: Config) -> Outbox:
+    redis_conn = create_redis_connector(config=config)
+    if redis_conn is not None:
+        owner = str(config.get_identifier(section='bot', option='id').address)
+        storage = RedisOutboxStorage(connector=redis_conn, owner=owner)
+        parking = RedisOutboxStorage(connector=redis_conn, owner=owner, table='parked')
+    else:
+        path = config.get_string(section='emitter', option='outbox')
+        if path is None:
+            path = get_bot_path(config, 'outbox', 'messages.js')
+        storage = FileOutboxStorage(path=path)
+        # 'messages.js' => 'messages.parked.js'
+        parking = FileOutboxStorage(path='%s.parked%s' % os.path.splitext(path))
+    capacity = config.get_integer(section='emitter', option='outbox_capacity')
+    attempts = config.get_integer(section='emitter', option='outbox_attempts')
+    return Outbox(storage=storage, capacity=capacity, parking=parking, attempts=attempts)
+
+
+def create_metrics_exporter(config: Config) -> Optional[MetricsExporter]:
+    path = config.get_string(section='metrics', option='path')
+    if path is None:
+        return None
+    interval = config.get_integer(section='metrics', option='interval')
+    exporter = MetricsExporter(path=path, interval=interval)
+    Runner.thread_run(runner=exporter)
+    return exporter
+
+
+def create_profiler(config: Config) -> Optional[Profiler]:
+    directory = config.get_string(section='profiler', option='path')
+    if directory is None:
+        return None
+    # profile the running loop (messenger, packer, processor & emitter)
+    profiler = Profiler(directory=directory, loop=asyncio.get_running_loop())
+    profiler.install_signals()
+    Runner.thread_run(runner=profiler)
+    return profiler
+
+
+def create_priority_policy(config: Config) -> PriorityPolicy:
+    bulk_size = config.get_integer(section='priority', option='bulk_size')
+    normal_budget = config.get_integer(section='priority', option='normal_budget')
+    bulk_budget = config.get_integer(section='priority', option='bulk_budget')
+    types = parse_types(text=config.get_string(section='priority', option='urgent_types'), lane=PriorityPolicy.URGENT)
+    types.update(parse_types(text=config.get_string(section='priority', option='bulk_types'), lane=PriorityPolicy.BULK))
+    return PriorityPolicy(bulk_size=bulk_size,
+                          normal_budget=normal_budget if normal_budget > 0 else 16,
+                          bulk_budget=bulk_budget if bulk_budget > 0 else 2,
+                          types=types,
+                          flags=parse_flags(text=config.get_string(section='priority', option='bulk_flags')))
+
+
 #
 #   DIM Bot
 #
@@ -263,10 +413,27 @@ async def start_bot(default_config: str, app_name: str, ans_name: str, processor
     host = config.station_host
     port = config.station_port
     session = create_session(facebook=facebook, database=db, host=host, port=port)
-    messenger = create_messenger(facebook=facebook, database=db, session=session, processor_class=processor_class)
+    messenger = create_messenger(config=config, facebook=facebook, database=db, session=session,
+                                 processor_class=processor_class)
     facebook.archivist.messenger = messenger
     # set messenger to emitter
     emitter = Emitter()
     emitter.messenger = messenger
+    emitter.file_cache = create_file_cache(config=config)
+    emitter.uploader = create_uploader(config=config, emitter=emitter)
+    emitter.upload_index = create_upload_index(config=config)
+    create_downloader(config=config, file_cache=emitter.file_cache)
+    emitter.outbox = create_outbox(config=config)
+    emitter.priority_policy = create_priority_policy(config=config)
+    create_metrics_exporter(config=config)
+    create_profiler(config=config)
     # create terminal
     return Terminal(messenger=messenger)
+
+
+def stop_bot():
+    """ write pending changes before exiting """
+    shared = GlobalVariable()
+    db = shared.database
+    if db is not None:
+        db.flush()
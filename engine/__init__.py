@@ -24,12 +24,16 @@
 # ==============================================================================
 
 from .tv_service import LiveStreamService
-from .web_service import WebPageService
+from .web_template import VariablesProvider
+from .web_site import WebSite
+from .web_service import WebMaster, WebPageService
 
 
 __all__ = [
 
     'LiveStreamService',
-    'WebPageService',
+
+    'VariablesProvider',
+    'WebSite', 'WebMaster', 'WebPageService',
 
 ]
@@ -23,18 +23,22 @@
 # SOFTWARE.
 # ==============================================================================
 
+import asyncio
 import threading
 from abc import ABC, abstractmethod
-from typing import Optional, List, Dict
+from typing import Optional, Set, List, Dict
 
 from dimples import DateTime
 from dimples import ID
+from dimples import TransportableData
 from dimples import Envelope
 from dimples import Content
 from dimples import TextContent, FileContent
 
-from libs.utils import Runner
+from libs.utils import Runner, Log
 from libs.client import Emitter
+from libs.client import Downloader
+from libs.client import get_file_params
 from libs.client import Service
 
 
@@ -75,6 +79,7 @@ class BaseService(Runner, Service, ABC):
         super().__init__(interval=Runner.INTERVAL_SLOW)
         self.__lock = threading.Lock()
         self.__requests = []
+        self.__downloads: Set[asyncio.Task] = set()
 
     def _add_request(self, content: Content, envelope: Envelope):
         with self.__lock:
@@ -104,7 +109,10 @@ class BaseService(Runner, Service, ABC):
         if isinstance(content, TextContent):
             await self._process_text_content(content=content, request=request)
         elif isinstance(content, FileContent):
-            await self._process_file_content(content=content, request=request)
+            # download in background, don't block the next request
+            task = asyncio.create_task(self._receive_file(content=content, request=request))
+            self.__downloads.add(task)
+            task.add_done_callback(self.__downloads.discard)
         # task done,
         # return True to process next immediately
         return True
@@ -113,8 +121,23 @@ class BaseService(Runner, Service, ABC):
     async def _process_text_content(self, content: TextContent, request: Request):
         raise NotImplemented
 
+    async def _receive_file(self, content: FileContent, request: Request):
+        try:
+            params = get_file_params(content=content)
+            if params is None:
+                Log.error(msg='file IV not found: %s, from "%s"' % (content.url, request.identifier))
+                return
+            data = await Downloader().fetch(content=content, params=params)
+            if data is None:
+                Log.error(msg='failed to get file data: %s, from "%s"' % (content.url, request.identifier))
+                return
+            await self._process_file_content(content=content, data=data, request=request)
+        except Exception as error:
+            Log.error(msg='failed to process file: %s, %s' % (content.url, error))
+
     @abstractmethod
-    async def _process_file_content(self, content: FileContent, request: Request):
+    async def _process_file_content(self, content: FileContent, data: bytes, request: Request):
+        """ file data downloaded & decrypted """
         raise NotImplemented
 
     #
@@ -144,6 +167,18 @@ class BaseService(Runner, Service, ABC):
         await self._send_content(content=content, receiver=request.identifier)
         return content
 
+    async def respond_file(self, data: bytes, filename: str, request: Request, extra: Dict = None) -> FileContent:
+        """ file data will be encrypted & uploaded by emitter before sending out """
+        ted = TransportableData.create(data=data)
+        content = FileContent.file(filename=filename, data=ted)
+        content['length'] = len(data)
+        if extra is not None:
+            for key in extra:
+                content[key] = extra[key]
+        calibrate_time(content=content, request=request)
+        await self._send_content(content=content, receiver=request.identifier)
+        return content
+
     # noinspection PyMethodMayBeStatic
     async def _send_content(self, content: Content, receiver: ID):
         emitter = Emitter()
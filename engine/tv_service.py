@@ -72,8 +72,8 @@ class LiveStreamService(BaseService, Logging):
         return live_set.lives
 
     # Override
-    async def _process_file_content(self, content: FileContent, request: Request):
-        self.warning(msg='TODO: process file content from "%s"' % request.identifier)
+    async def _process_file_content(self, content: FileContent, data: bytes, request: Request):
+        self.warning(msg='TODO: process file content (len=%d) from "%s"' % (len(data), request.identifier))
 
     # Override
     async def _process_text_content(self, content: TextContent, request: Request):
@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+# ==============================================================================
+# MIT License
+#
+# Copyright (c) 2024 Albert Moky
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+# ==============================================================================
+
+"""
+    Title Index
+    ~~~~~~~~~~~
+
+    Trie (for prefix) & trigram table (for typo) of page titles
+"""
+
+from typing import Optional, Iterable, List, Set, Dict
+
+
+def normalize_title(title: str) -> str:
+    """ lower case, single spaces """
+    return ' '.join(title.lower().split())
+
+
+def get_trigrams(text: str) -> Set[str]:
+    """ trigrams of the text, padded with spaces at both ends """
+    padded = '  %s ' % text
+    return {padded[i:i+3] for i in range(len(padded) - 2)}
+
+
+class TrieNode:
+
+    __slots__ = ('children', 'title')
+
+    def __init__(self):
+        self.children: Dict[str, TrieNode] = {}
+        self.title: Optional[str] = None  # normalized title ends here
+
+
+class TitleIndex:
+    """ Index for looking up page titles by prefix or similarity """
+
+    SIMILAR_THRESHOLD = 0.2  # trigram similarity (Jaccard)
+
+    def __init__(self, titles: Iterable[str] = None):
+        super().__init__()
+        self.__root = TrieNode()
+        self.__grams: Dict[str, Set[str]] = {}  # trigram => normalized titles
+        self.__sizes: Dict[str, int] = {}       # normalized title => count of trigrams
+        self.__titles: Dict[str, str] = {}      # normalized title => origin title
+        if titles is not None:
+            for item in titles:
+                self.add(title=item)
+
+    def __len__(self) -> int:
+        return len(self.__titles)
+
+    def add(self, title: str):
+        key = normalize_title(title=title)
+        if len(key) == 0 or key in self.__titles:
+            return
+        self.__titles[key] = title
+        # 1. trie
+        node = self.__root
+        for ch in key:
+            child = node.children.get(ch)
+            if child is None:
+                child = TrieNode()
+                node.children[ch] = child
+            node = child
+        node.title = key
+        # 2. trigrams
+        grams = get_trigrams(text=key)
+        for g in grams:
+            bucket = self.__grams.get(g)
+            if bucket is None:
+                bucket = set()
+                self.__grams[g] = bucket
+            bucket.add(key)
+        self.__sizes[key] = len(grams)
+
+    def exact(self, title: str) -> Optional[str]:
+        """ get origin title with normalized title """
+        return self.__titles.get(normalize_title(title=title))
+
+    def prefix(self, prefix: str, limit: int = 8) -> List[str]:
+        """ get titles start with the prefix (shortest first) """
+        node = self.__root
+        for ch in normalize_title(title=prefix):
+            node = node.children.get(ch)
+            if node is None:
+                return []
+        # breadth first, so shorter titles come first
+        results = []
+        queue = [node]
+        while len(queue) > 0 and len(results) < limit:
+            next_level = []
+            for node in queue:
+                if node.title is not None:
+                    results.append(self.__titles[node.title])
+                    if len(results) >= limit:
+                        break
+                next_level.extend(node.children.values())
+            queue = next_level
+        return results
+
+    def similar(self, title: str, limit: int = 8, threshold: float = None) -> List[str]:
+        """ get titles similar to the given one (most similar first) """
+        if threshold is None:
+            threshold = self.SIMILAR_THRESHOLD
+        grams = get_trigrams(text=normalize_title(title=title))
+        # count shared trigrams
+        shared: Dict[str, int] = {}
+        for g in grams:
+            bucket = self.__grams.get(g)
+            if bucket is None:
+                continue
+            for key in bucket:
+                shared[key] = shared.get(key, 0) + 1
+        # calculate similarities
+        candidates = []
+        total = len(grams)
+        for key, count in shared.items():
+            score = count / (total + self.__sizes[key] - count)
+            if score >= threshold:
+                candidates.append((-score, len(key), key))
+        candidates.sort()
+        return [self.__titles[item[2]] for item in candidates[:limit]]
+
+    def match(self, title: str) -> Optional[str]:
+        """ get the exact title, or the only title starts with it """
+        origin = self.exact(title=title)
+        if origin is not None:
+            return origin
+        array = self.prefix(prefix=title, limit=2)
+        if len(array) == 1:
+            return array[0]
+
+    def suggest(self, title: str, limit: int = 5) -> List[str]:
+        """ get titles by prefix first, then by similarity """
+        results = self.prefix(prefix=title, limit=limit)
+        if len(results) < limit:
+            for item in self.similar(title=title, limit=limit):
+                if item not in results:
+                    results.append(item)
+                    if len(results) >= limit:
+                        break
+        return results
@@ -23,135 +23,130 @@
 # SOFTWARE.
 # ==============================================================================
 
-import threading
-import time
-from typing import Optional, Dict
+from typing import Optional, Union, Iterable, Tuple, List, Dict
 
+from dimp import Content
 from dimp import FileContent, TextContent
-from dimples.utils import SharedCacheManager
-from dimples.database import Storage
-
-from tvbox.utils import json_decode
 
+from libs.utils import utf8_encode
+from libs.utils import MappedFile
 from libs.utils import Logging
 from libs.utils import Config
 
 from .service import Request
 from .service import BaseService
+from .web_template import VariablesProvider, DefaultVariablesProvider
+from .web_site import WebSite
 
 
 class WebMaster(Logging):
+    """ Sites with isolated caches, routed by 'mod' or title prefix """
+
+    DEFAULT_SITE = 'default'
 
-    MEM_CACHE_EXPIRES = 600  # seconds
-    MEM_CACHE_REFRESH = 32   # seconds
+    CACHE_BUDGET = 1024 * 1024 * 64  # bytes for each site
 
     def __init__(self, config: Config):
         self.__config = config
-        man = SharedCacheManager()
-        self.__cache = man.get_pool(name='web_pages')  # path => text
-        self.__lock = threading.Lock()
+        self.__sites: Dict[str, WebSite] = {}
+        self.__variables: VariablesProvider = DefaultVariablesProvider()
+        self._load_sites()
 
     @property  # protected
     def config(self) -> Config:
         return self.__config
 
-    @property  # protected
-    def indexes(self) -> Optional[str]:
+    def _load_sites(self):
+        """
+            [webmaster]
+            indexes = /var/dim/protected/sites/index.json
+            cache_budget = 67108864
+
+            [webmaster.sites]
+            news = /var/dim/protected/news/index.json
+            news.budget = 16777216
+        """
         config = self.config
-        return config.get_string(section='webmaster', option='indexes')
-
-    async def _load_file(self, path: str) -> Optional[str]:
-        now = time.time()
-        cache_pool = self.__cache
-        #
-        #  1. check memory cache
-        #
-        value, holder = cache_pool.fetch(key=path, now=now)
-        if value is not None:
-            # got it from cache
-            return value
-        elif holder is None:
-            # holder not exists, means it is the first querying
-            pass
-        elif holder.is_alive(now=now):
-            # holder is not expired yet,
-            # means the value is actually empty,
-            # no need to check it again.
-            return None
-        #
-        #  2. lock for querying
-        #
-        with self.__lock:
-            # locked, check again to make sure the cache not exists.
-            # (maybe the cache was updated by other threads while waiting the lock)
-            value, holder = cache_pool.fetch(key=path, now=now)
-            if value is not None:
-                return value
-            elif holder is None:
-                pass
-            elif holder.is_alive(now=now):
-                return None
-            else:
-                # holder exists, renew the expired time for other threads
-                holder.renewal(duration=self.MEM_CACHE_REFRESH, now=now)
-            # check local storage
-            value = await Storage.read_text(path=path)
-            # update memory cache
-            cache_pool.update(key=path, value=value, life_span=self.MEM_CACHE_EXPIRES, now=now)
-        #
-        #  3. OK, return cached value
-        #
-        return value
-
-    async def _get_path(self, title: str) -> Optional[str]:
-        index_path = self.indexes
-        if index_path is None:
+        budget = config.get_integer(section='webmaster', option='cache_budget')
+        if budget <= 0:
+            budget = self.CACHE_BUDGET
+        # default site
+        indexes = config.get_string(section='webmaster', option='indexes')
+        if indexes is not None:
+            self._add_site(name=self.DEFAULT_SITE, indexes=indexes, budget=budget)
+        # named sites
+        section = config.get('webmaster.sites')
+        if section is None:
+            section = {}
+        for name in section:
+            if name.endswith(r'.budget'):
+                continue
+            size = config.get_integer(section='webmaster.sites', option='%s.budget' % name)
+            self._add_site(name=name, indexes=section[name], budget=size if size > 0 else budget)
+        if len(self.__sites) == 0:
             self.error(msg='failed to get indexes for webmaster')
-            return None
-        # get indexes
-        js = await self._load_file(path=index_path)
-        if js is None:
-            self.error(msg='indexes not found: %s' % index_path)
-            return None
-        info = json_decode(string=js)
-        if info is None:
-            self.error(msg='indexes error: %s' % js)
-            return None
-        assert isinstance(info, Dict), 'indexes error: %s' % info
-        return info.get(title)
-
-    async def get_format(self, title: str) -> Optional[str]:
-        path = await self._get_path(title=title)
-        if path is None:
-            self.warning(msg='page not found: "%s"' % title)
-        elif path.endswith(r'.md'):
-            return 'markdown'
-        elif path.endswith(r'.html'):
-            return 'html'
-        else:
-            self.error(msg='unknown format: "%s" -> %s' % (title, path))
 
-    async def get_page(self, title: str) -> Optional[str]:
-        path = await self._get_path(title=title)
-        if path is None:
-            self.warning(msg='page not found: "%s"' % title)
-        else:
-            return await self._load_file(path=path)
+    def _add_site(self, name: str, indexes: str, budget: int):
+        site = WebSite(name=name, indexes=indexes, budget=budget)
+        site.variables_provider = self.__variables
+        self.__sites[name] = site
+        self.info(msg='site added: %s' % site)
+
+    @property
+    def site_names(self) -> List[str]:
+        return list(self.__sites.keys())
+
+    def get_site(self, name: str) -> Optional[WebSite]:
+        return self.__sites.get(name)
+
+    def route(self, title: str, content: Content) -> Tuple[Optional[WebSite], str]:
+        """ get site with 'mod' (when 'app' is 'chat.dim.sites'), or with prefix 'site:' in title """
+        sites = self.__sites
+        # 1. check 'app' & 'mod'
+        if content.get('app') == 'chat.dim.sites':
+            site = sites.get(content.get('mod'))
+            if site is not None:
+                return site, title
+        # 2. check prefix
+        pos = title.find(':')
+        if pos > 0:
+            site = sites.get(title[:pos].strip())
+            if site is not None:
+                return site, title[pos+1:].strip()
+        # 3. default site
+        return sites.get(self.DEFAULT_SITE), title
+
+    @property
+    def variables_provider(self) -> VariablesProvider:
+        return self.__variables
+
+    @variables_provider.setter
+    def variables_provider(self, provider: VariablesProvider):
+        self.__variables = provider
+        for site in self.__sites.values():
+            site.variables_provider = provider
 
 
 class WebPageService(BaseService, Logging):
 
+    PAGE_SIZE_LIMIT = 1024 * 64  # bytes
+
     def __init__(self, config: Config):
         super().__init__()
         self.__master = WebMaster(config=config)
+        # large pages
+        limit = config.get_integer(section='webmaster', option='page_size_limit')
+        self.__page_limit = limit if limit > 0 else self.PAGE_SIZE_LIMIT
+        mode = config.get_string(section='webmaster', option='large_page')
+        self.__large_page = 'chunks' if mode is None else mode.strip().lower()  # 'chunks' or 'file'
 
     @property
     def master(self) -> WebMaster:
         return self.__master
 
     # Override
-    async def _process_file_content(self, content: FileContent, request: Request):
-        self.warning(msg='TODO: process file content from "%s"' % request.identifier)
+    async def _process_file_content(self, content: FileContent, data: bytes, request: Request):
+        self.warning(msg='TODO: process file content (len=%d) from "%s"' % (len(data), request.identifier))
 
     # Override
     async def _process_text_content(self, content: TextContent, request: Request):
@@ -162,16 +157,34 @@ class WebPageService(BaseService, Logging):
         else:
             title = text.strip()
             title = title.lower()
-            master = self.master
+        site, title = self.master.route(title=title, content=content)
+        if site is None:
+            self.error(msg='site not found: "%s"' % text)
+            await self._respond_homepage(title=text, text=None, text_format=None, request=request)
+            return
         # load page content with title
-        text_page = await master.get_page(title=title)
-        text_format = await master.get_format(title=title)
-        await self._respond_homepage(title=text, text=text_page, text_format=text_format, request=request)
+        text_page = await site.get_page(title=title)
+        text_format = await site.get_format(title=title)
+        if text_page is None:
+            suggestions = await site.get_suggestions(title=title)
+        else:
+            suggestions = None
+        try:
+            await self._respond_homepage(title=text, text=text_page, text_format=text_format, request=request,
+                                         suggestions=suggestions, site=site.name)
+        finally:
+            if isinstance(text_page, MappedFile):
+                text_page.release()
 
-    async def _respond_homepage(self, title: str, text: Optional[str], text_format: Optional[str], request: Request):
+    async def _respond_homepage(self, title: str, text: Union[str, MappedFile, None], text_format: Optional[str],
+                                request: Request, suggestions: List[str] = None, site: str = None):
         if text is None:
             text = '## 404 Not Found\n' \
                    'The resource (**%s**) not exists.' % title.strip()
+            if suggestions is not None and len(suggestions) > 0:
+                text += '\n\nDid you mean:\n'
+                for item in suggestions:
+                    text += '- **%s**\n' % item
             text_format = 'markdown'
         elif text_format is None:
             text_format = 'markdown'
@@ -180,8 +193,7 @@ class WebPageService(BaseService, Logging):
         title = request.content.get('title')
         hidden = request.content.get('hidden')
         cid = request.identifier
-        self.info(msg='respond %d bytes with tag %s to %s' % (len(text), tag, cid))
-        return await self.respond_text(text=text, request=request, extra={
+        extra = {
             'format': text_format,
             'muted': 'yes',
             'hidden': hidden,
@@ -193,4 +205,87 @@ class WebPageService(BaseService, Logging):
 
             'tag': tag,
             'title': title,
-        })
+            'site': site,
+        }
+        if isinstance(text, MappedFile):
+            mapped = text
+            data = None
+            size = mapped.size
+        else:
+            mapped = None
+            data = utf8_encode(string=text)
+            size = len(data)
+        limit = self.__page_limit
+        if size <= limit:
+            if mapped is not None:
+                text = mapped.decode()
+            self.info(msg='respond %d bytes with tag %s to %s' % (size, tag, cid))
+            return await self.respond_text(text=text, request=request, extra=extra)
+        elif self.__large_page == 'file':
+            if mapped is not None:
+                data = mapped.read()
+            ext = 'html' if text_format == 'html' else 'md'
+            self.info(msg='respond %d bytes as file with tag %s to %s' % (size, tag, cid))
+            return await self.respond_file(data=data, filename='index.%s' % ext, request=request, extra=extra)
+        elif mapped is not None:
+            # decode each chunk just before sending it
+            ranges = mapped.split(limit=limit)
+            chunks = (mapped.decode(start=start, end=end) for start, end in ranges)
+            total = len(ranges)
+        else:
+            chunks = split_page(text=text, limit=limit)
+            total = len(chunks)
+        self.info(msg='respond %d bytes in %d chunks with tag %s to %s' % (size, total, tag, cid))
+        return await self._respond_chunks(chunks=chunks, total=total, request=request, extra=extra)
+
+    async def _respond_chunks(self, chunks: Iterable[str], total: int, request: Request, extra: Dict) -> TextContent:
+        """ send chunks in order, all linked to the first one by 'sn' """
+        head = None
+        index = 0
+        for text in chunks:
+            info = extra.copy()
+            if head is None:
+                info['chunk'] = {'index': index, 'total': total}
+                head = await self.respond_text(text=text, request=request, extra=info)
+            else:
+                info['chunk'] = {'sn': head.sn, 'index': index, 'total': total}
+                await self.respond_text(text=text, request=request, extra=info)
+            index += 1
+        return head
+
+
+def split_page(text: str, limit: int) -> List[str]:
+    """ split text into chunks not larger than limit (bytes), at line breaks if possible """
+    chunks = []
+    buffer = []
+    size = 0
+    for line in text.splitlines(keepends=True):
+        length = len(utf8_encode(string=line))
+        if size + length > limit and size > 0:
+            chunks.append(''.join(buffer))
+            buffer = []
+            size = 0
+        while length > limit:
+            # line too long, cut it by characters
+            pos = _cut_position(line=line, limit=limit)
+            chunks.append(line[:pos])
+            line = line[pos:]
+            length = len(utf8_encode(string=line))
+        buffer.append(line)
+        size += length
+    if size > 0:
+        chunks.append(''.join(buffer))
+    return chunks
+
+
+def _cut_position(line: str, limit: int) -> int:
+    # each character takes up to 4 bytes in UTF-8
+    pos = max(1, limit // 4)
+    size = len(utf8_encode(string=line[:pos]))
+    while pos < len(line):
+        length = len(utf8_encode(string=line[pos]))
+        if size + length > limit:
+            break
+        size += length
+        pos += 1
+    return pos
@@ -0,0 +1,392 @@
+# -*- coding: utf-8 -*-
+# ==============================================================================
+# MIT License
+#
+# Copyright (c) 2024 Albert Moky
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+# ==============================================================================
+
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional, Union, Any, Callable, Tuple, List, Dict
+
+from dimples.utils import CachePool, SharedCacheManager
+from dimples.database import Storage
+
+from tvbox.utils import json_decode
+
+from libs.utils import utf8_encode
+from libs.utils import MappedFile
+from libs.utils import Logging
+
+from .web_index import TitleIndex
+from .web_template import is_template, fill_slots, PageTemplate
+from .web_template import VariablesProvider, DefaultVariablesProvider
+
+
+class CacheBudget:
+    """ LRU ledger for bytes cached in the pools of one site """
+
+    def __init__(self, limit: int, evicted: Callable[[str, Any], None] = None):
+        super().__init__()
+        self.__limit = limit
+        self.__evicted = evicted  # callback with (pool name, key) after erased from the pool
+        self.__entries = OrderedDict()  # (pool name, key) => (pool, size)
+        self.__total = 0
+        self.__lock = threading.Lock()
+
+    @property
+    def limit(self) -> int:
+        return self.__limit
+
+    @property
+    def total(self) -> int:
+        return self.__total
+
+    def touch(self, name: str, key: Any):
+        """ mark as recently used """
+        with self.__lock:
+            if (name, key) in self.__entries:
+                self.__entries.move_to_end((name, key))
+
+    def charge(self, name: str, key: Any, pool: CachePool, size: int) -> int:
+        """ account the cached value, evict least recently used ones when over budget """
+        evicted = []
+        with self.__lock:
+            old = self.__entries.pop((name, key), None)
+            if old is not None:
+                self.__total -= old[1]
+            self.__entries[(name, key)] = (pool, size)
+            self.__total += size
+            while self.__total > self.__limit and len(self.__entries) > 1:
+                (lru_name, lru_key), (lru_pool, lru_size) = self.__entries.popitem(last=False)
+                lru_pool.erase(key=lru_key)
+                self.__total -= lru_size
+                evicted.append((lru_name, lru_key))
+        callback = self.__evicted
+        if callback is not None:
+            for lru_name, lru_key in evicted:
+                callback(lru_name, lru_key)
+        return len(evicted)
+
+    def discharge(self, name: str, key: Any):
+        """ the value was removed from the pool """
+        with self.__lock:
+            old = self.__entries.pop((name, key), None)
+            if old is not None:
+                self.__total -= old[1]
+
+
+class WebSite(Logging):
+    """ Pages & caches for one index file """
+
+    MEM_CACHE_EXPIRES = 600  # seconds
+    MEM_CACHE_REFRESH = 32   # seconds
+
+    TEMPLATE_RENDER_EXPIRES = 60  # seconds
+    TEMPLATE_CAPACITY = 256       # compiled templates
+
+    MMAP_THRESHOLD = 1024 * 256  # bytes
+
+    def __init__(self, name: str, indexes: str, budget: int):
+        super().__init__()
+        self.__name = name
+        self.__indexes = indexes
+        self.__budget = CacheBudget(limit=budget, evicted=self._evicted)
+        man = SharedCacheManager()
+        self.__cache = man.get_pool(name='web_pages.%s' % name)  # path => text
+        self.__mapped = man.get_pool(name='web_mapped_pages.%s' % name)  # path => mapped file
+        self.__renders = man.get_pool(name='web_renders.%s' % name)  # (path, version, variables) => parts
+        self.__lock = threading.Lock()
+        # mapped files opened by this site: path => map,
+        # retired when replaced, evicted, expired, or the file becomes small
+        self.__maps: Dict[str, MappedFile] = {}
+        self.__maps_lock = threading.Lock()
+        # templates: path => (text, template, version), least recently used first
+        self.__templates: Dict[str, Tuple[str, PageTemplate, int]] = OrderedDict()
+        self.__template_versions: Dict[str, int] = {}  # path => last version
+        self.__variables: VariablesProvider = DefaultVariablesProvider()
+        # indexes: title => path
+        self.__index_text: Optional[str] = None
+        self.__index_info: Optional[Dict[str, str]] = None
+        self.__title_index: Optional[TitleIndex] = None
+
+    # Override
+    def __str__(self) -> str:
+        clazz = self.__class__.__name__
+        return '<%s name="%s" indexes="%s" budget=%d />' % (clazz, self.name, self.indexes, self.budget.limit)
+
+    # Override
+    def __repr__(self) -> str:
+        return self.__str__()
+
+    @property
+    def name(self) -> str:
+        return self.__name
+
+    @property
+    def indexes(self) -> str:
+        return self.__indexes
+
+    @property
+    def budget(self) -> CacheBudget:
+        return self.__budget
+
+    @property
+    def variables_provider(self) -> VariablesProvider:
+        return self.__variables
+
+    @variables_provider.setter
+    def variables_provider(self, provider: VariablesProvider):
+        self.__variables = provider
+
+    async def _load_file(self, path: str) -> Optional[str]:
+        now = time.time()
+        cache_pool = self.__cache
+        #
+        #  1. check memory cache
+        #
+        value, holder = cache_pool.fetch(key=path, now=now)
+        if value is not None:
+            # got it from cache
+            self.__budget.touch(name='text', key=path)
+            return value
+        elif holder is None:
+            # holder not exists, means it is the first querying
+            pass
+        elif holder.is_alive(now=now):
+            # holder is not expired yet,
+            # means the value is actually empty,
+            # no need to check it again.
+            return None
+        #
+        #  2. lock for querying
+        #
+        with self.__lock:
+            # locked, check again to make sure the cache not exists.
+            # (maybe the cache was updated by other threads while waiting the lock)
+            value, holder = cache_pool.fetch(key=path, now=now)
+            if value is not None:
+                return value
+            elif holder is None:
+                pass
+            elif holder.is_alive(now=now):
+                return None
+            else:
+                # holder exists, renew the expired time for other threads
+                holder.renewal(duration=self.MEM_CACHE_REFRESH, now=now)
+            # check local storage
+            value = await Storage.read_text(path=path)
+            # update memory cache
+            cache_pool.update(key=path, value=value, life_span=self.MEM_CACHE_EXPIRES, now=now)
+            size = 0 if value is None else len(utf8_encode(string=value))
+            self.__budget.charge(name='text', key=path, pool=cache_pool, size=size)
+        #
+        #  3. OK, return cached value
+        #
+        return value
+
+    async def _load_page(self, path: str) -> Union[str, MappedFile, None]:
+        """
+        large pages are mapped into memory, small pages are loaded as text;
+        the mapped file returned is retained, caller must release it after using
+        """
+        now = time.time()
+        # close maps expired (or purged) from the pool
+        self._sweep_maps(now=now)
+        mapped, _ = self.__mapped.fetch(key=path, now=now)
+        if mapped is not None and not mapped.is_modified() and mapped.retain():
+            # got it from cache
+            self.__budget.touch(name='mapped', key=path)
+            return mapped
+        try:
+            size = os.path.getsize(path)
+        except OSError:
+            # file not found? let the text loader cache the empty value
+            size = 0
+        if size < self.MMAP_THRESHOLD:
+            if mapped is not None:
+                # file becomes small, load it as text
+                self.__mapped.erase(key=path)
+                self.__budget.discharge(name='mapped', key=path)
+                self._retire_map(path=path)
+            return await self._load_file(path=path)
+        with self.__lock:
+            # locked, check again
+            mapped, _ = self.__mapped.fetch(key=path, now=now)
+            if mapped is None or mapped.is_modified() or not mapped.retain():
+                try:
+                    mapped = MappedFile(path=path)
+                except (OSError, ValueError) as error:
+                    self.error(msg='failed to map file: %s, %s' % (path, error))
+                    return None
+                mapped.retain()
+                # close the replaced one after responses using it finished
+                self._retire_map(path=path, replacement=mapped)
+                self.__mapped.update(key=path, value=mapped, life_span=self.MEM_CACHE_EXPIRES, now=now)
+                self.__budget.charge(name='mapped', key=path, pool=self.__mapped, size=mapped.size)
+        return mapped
+
+    def _retire_map(self, path: str, replacement: MappedFile = None):
+        """ close the map opened for this path, after responses using it finished """
+        with self.__maps_lock:
+            if replacement is None:
+                old = self.__maps.pop(path, None)
+            else:
+                old = self.__maps.get(path)
+                self.__maps[path] = replacement
+        if old is not None and old is not replacement:
+            old.retire()
+
+    def _sweep_maps(self, now: float):
+        """ retire maps no longer alive in the pool """
+        pool = self.__mapped
+        with self.__maps_lock:
+            stale = [(path, mapped) for path, mapped in self.__maps.items()
+                     if pool.fetch(key=path, now=now)[0] is not mapped]
+            for path, _ in stale:
+                self.__maps.pop(path, None)
+        for _, mapped in stale:
+            mapped.retire()
+
+    def _evicted(self, name: str, key: Any):
+        """ callback from budget """
+        if name == 'mapped':
+            self._retire_map(path=key)
+
+    async def _get_indexes(self) -> Tuple[Optional[Dict[str, str]], Optional[TitleIndex]]:
+        index_path = self.indexes
+        # get indexes
+        js = await self._load_file(path=index_path)
+        if js is None:
+            self.error(msg='indexes not found: %s' % index_path)
+            return None, None
+        with self.__lock:
+            if js is self.__index_text or js == self.__index_text:
+                # index file not changed
+                return self.__index_info, self.__title_index
+        # index file changed, rebuild title index
+        info = json_decode(string=js)
+        if info is None:
+            self.error(msg='indexes error: %s' % js)
+            return None, None
+        assert isinstance(info, Dict), 'indexes error: %s' % info
+        title_index = TitleIndex(titles=info.keys())
+        with self.__lock:
+            self.__index_text = js
+            self.__index_info = info
+            self.__title_index = title_index
+        self.info(msg='title index rebuilt: %d title(s) from %s' % (len(title_index), index_path))
+        return info, title_index
+
+    async def _get_path(self, title: str) -> Optional[str]:
+        info, title_index = await self._get_indexes()
+        if info is None:
+            return None
+        path = info.get(title)
+        if path is None:
+            # try the only title starts with it
+            origin = title_index.match(title=title)
+            if origin is not None:
+                path = info.get(origin)
+        return path
+
+    async def get_suggestions(self, title: str, limit: int = 5) -> List[str]:
+        """ get titles close to the missing one """
+        _, title_index = await self._get_indexes()
+        if title_index is None:
+            return []
+        return title_index.suggest(title=title, limit=limit)
+
+    async def get_format(self, title: str) -> Optional[str]:
+        path = await self._get_path(title=title)
+        if path is None:
+            self.warning(msg='page not found: "%s"' % title)
+        elif path.endswith(r'.md'):
+            return 'markdown'
+        elif path.endswith(r'.html'):
+            return 'html'
+        else:
+            self.error(msg='unknown format: "%s" -> %s' % (title, path))
+
+    async def get_page(self, title: str) -> Union[str, MappedFile, None]:
+        """
+        get page text, or mapped file for large page (decode it when building message);
+        the mapped file is retained, release it after responding
+        """
+        path = await self._get_path(title=title)
+        if path is None:
+            self.warning(msg='page not found: "%s"' % title)
+            return None
+        elif is_template(path=path):
+            text = await self._load_file(path=path)
+            if text is not None:
+                text = await self._render(title=title, path=path, text=text)
+            return text
+        else:
+            return await self._load_page(path=path)
+
+    #
+    #   Template Pages
+    #
+
+    def _compile(self, path: str, text: str) -> Tuple[PageTemplate, int]:
+        """ compile template once for each version of the file """
+        templates = self.__templates
+        with self.__lock:
+            old = templates.get(path)
+            if old is not None and (old[0] is text or old[0] == text):
+                # file not changed
+                templates.move_to_end(path)
+                return old[1], old[2]
+            # versions are kept after the template dropped, so old renders won't be reused
+            version = self.__template_versions.get(path, 0) + 1
+            self.__template_versions[path] = version
+            template = PageTemplate(template=text)
+            templates[path] = (text, template, version)
+            templates.move_to_end(path)
+            while len(templates) > self.TEMPLATE_CAPACITY:
+                templates.popitem(last=False)
+        self.info(msg='template compiled: %s (version %d), tags: %s' % (path, version, template.keys))
+        return template, version
+
+    async def _render(self, title: str, path: str, text: str) -> str:
+        template, version = self._compile(path=path, text=text)
+        provider = self.variables_provider
+        variables = await provider.get_variables(title=title, path=path)
+        # cache key with the stable variables used by this template only,
+        # volatile ones (e.g. time) are rendered after the cache
+        volatile = frozenset(k for k in template.keys if provider.is_volatile(key=k))
+        stable = {k: variables[k] for k in template.keys if k in variables and k not in volatile}
+        used = tuple(sorted((k, str(v)) for k, v in stable.items()))
+        key = (path, version, used)
+        now = time.time()
+        parts, _ = self.__renders.fetch(key=key, now=now)
+        if parts is None:
+            # volatile tags are kept as slots, filled without scanning the stable values again
+            parts = template.prerender(variables=stable, slots=volatile)
+            self.__renders.update(key=key, value=parts, life_span=self.TEMPLATE_RENDER_EXPIRES, now=now)
+            size = sum(len(utf8_encode(string=item)) for item in parts)
+            self.__budget.charge(name='render', key=key, pool=self.__renders, size=size)
+        else:
+            self.__budget.touch(name='render', key=key)
+        return fill_slots(parts=parts, variables=variables)
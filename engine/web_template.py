@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+# ==============================================================================
+# MIT License
+#
+# Copyright (c) 2024 Albert Moky
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+# ==============================================================================
+
+"""
+    Page Template
+    ~~~~~~~~~~~~~
+
+    Template pages use the same '{key}' tags as 'template_replace',
+    tags in the text are scanned only once for each version of the file,
+    and all tags are replaced in one pass, so values are never scanned again.
+"""
+
+import re
+from abc import ABC, abstractmethod
+from typing import FrozenSet, Tuple, List, Dict
+
+from dimples import DateTime
+
+
+def is_template(path: str) -> bool:
+    """ template pages: '*.tpl.md', '*.tpl.html' """
+    return path.endswith(r'.tpl.md') or path.endswith(r'.tpl.html')
+
+
+class PageTemplate:
+    """ Compiled template: (text, key, text, key, ..., text) """
+
+    def __init__(self, template: str):
+        super().__init__()
+        self.__parts: List[str] = _tag.split(template)
+        self.__keys = frozenset(self.__parts[1::2])
+
+    @property
+    def keys(self) -> FrozenSet[str]:
+        """ all tag names in this template """
+        return self.__keys
+
+    def render(self, variables: Dict[str, str]) -> str:
+        """ replace '{key}' with value, unknown tags are kept """
+        return fill_slots(parts=self.__parts, variables=variables)
+
+    def prerender(self, variables: Dict[str, str], slots: FrozenSet[str]) -> Tuple[str, ...]:
+        """
+        Replace tags except the slots (e.g. time), which are kept for 'fill_slots()'
+
+        :param variables: values for tags not in slots
+        :param slots:     tag names to keep
+        :return: (text, key, text, key, ..., text)
+        """
+        parts = self.__parts
+        results = []
+        buffer = [parts[0]]
+        for pos in range(1, len(parts), 2):
+            key = parts[pos]
+            if key in slots:
+                results.append(''.join(buffer))
+                results.append(key)
+                buffer = [parts[pos + 1]]
+                continue
+            value = variables.get(key)
+            buffer.append('{%s}' % key if value is None else str(value))
+            buffer.append(parts[pos + 1])
+        results.append(''.join(buffer))
+        return tuple(results)
+
+
+def fill_slots(parts, variables: Dict[str, str]) -> str:
+    """ join texts & values of the keys between them: (text, key, text, key, ..., text) """
+    if len(parts) == 1:
+        return parts[0]
+    array = list(parts)
+    for pos in range(1, len(array), 2):
+        key = array[pos]
+        value = variables.get(key)
+        array[pos] = '{%s}' % key if value is None else str(value)
+    return ''.join(array)
+
+
+_tag = re.compile(r'\{([A-Za-z_][\w.\-]*)}')
+
+
+class VariablesProvider(ABC):
+    """ Variables for rendering template pages """
+
+    @abstractmethod
+    async def get_variables(self, title: str, path: str) -> Dict[str, str]:
+        """
+        Get variables for template page
+
+        :param title: page title
+        :param path:  template file path
+        :return: key => value
+        """
+        raise NotImplemented
+
+    # noinspection PyMethodMayBeStatic
+    def is_volatile(self, key: str) -> bool:
+        """ variables changing on every request (e.g. time) are rendered after the cache """
+        return False
+
+
+class DefaultVariablesProvider(VariablesProvider):
+    """ title, date & time """
+
+    VOLATILE_KEYS = frozenset(['now', 'date', 'time'])
+
+    # Override
+    def is_volatile(self, key: str) -> bool:
+        return key in self.VOLATILE_KEYS
+
+    # Override
+    async def get_variables(self, title: str, path: str) -> Dict[str, str]:
+        now = DateTime.now()
+        string = str(now)  # 'yyyy-MM-dd HH:mm:ss'
+        return {
+            'title': title,
+            'now': string,
+            'date': string[:10],
+            'time': string[11:19],
+        }
@@ -31,16 +31,31 @@
 
 from dimples.client import ClientSession, SessionState
 from dimples.client import ClientContentProcessorCreator
-from dimples.client import ClientMessenger
 from dimples.client import Terminal
 
 from .group import SharedGroupManager
 
+from .cache import FileCache
+from .uploader import UploadError, UploadBackend, HttpUploadBackend
+from .uploader import UploadDelegate, Uploader
+from .upload_index import UploadIndex
+from .cipher import get_file_params
+from .downloader import Downloader
+from .outbox import OutboxStorage, FileOutboxStorage, RedisOutboxStorage
+from .outbox import Outbox
+from .priority import Lane, PriorityPolicy
+from .image import ImagePipeline
 from .emitter import Emitter
 
+from .crypto import CryptoPool
+from .keys import MessageKeyCache
+from .pipeline import InboundPipeline
+from .messenger import ClientMessenger
+
+from .dedup import DuplicateFilter
 from .packer import ClientPacker
 from .processor import ClientProcessor
-from .processor import Service
+from .processor import Service, ServiceRouter
 
 
 __all__ = [
@@ -55,10 +70,22 @@ __all__ = [
 
     'SharedGroupManager',
 
+    'FileCache',
+    'UploadError', 'UploadBackend', 'HttpUploadBackend',
+    'UploadDelegate', 'Uploader', 'UploadIndex',
+    'get_file_params', 'Downloader',
+    'OutboxStorage', 'FileOutboxStorage', 'RedisOutboxStorage',
+    'Outbox',
+    'Lane', 'PriorityPolicy',
+    'ImagePipeline',
     'Emitter',
 
+    'CryptoPool', 'MessageKeyCache',
+    'InboundPipeline',
+
+    'DuplicateFilter',
     'ClientPacker',
     'ClientProcessor',
-    'Service',
+    'Service', 'ServiceRouter',
 
 ]
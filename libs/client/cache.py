@@ -0,0 +1,220 @@
+# -*- coding: utf-8 -*-
+# ==============================================================================
+# MIT License
+#
+# Copyright (c) 2024 Albert Moky
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+# ==============================================================================
+
+"""
+    File Cache
+    ~~~~~~~~~~
+
+    Content-addressed local storage for file data: '{ROOT}/{md5[:2]}/{md5}.{ext}'
+"""
+
+import asyncio
+import functools
+import os
+import threading
+from collections import OrderedDict
+from typing import Optional, List
+
+from ..utils import filename_from_data
+from ..utils import Runner, Logging
+
+
+class FileCache(Runner, Logging):
+
+    QUOTA = 1024 * 1024 * 1024  # 1 GB
+
+    # hash small data on the event loop, bigger ones in executor
+    INLINE_HASH_SIZE = 1024 * 64  # bytes
+
+    def __init__(self, root: str, quota: int = None):
+        super().__init__(interval=2.0)
+        self.__root = root
+        self.__quota = self.QUOTA if quota is None or quota <= 0 else quota
+        self.__index = OrderedDict()  # filename => size (least recently used first)
+        self.__total = 0
+        self.__lock = threading.Lock()
+        self.__scanned = False
+
+    @property
+    def root(self) -> str:
+        return self.__root
+
+    @property
+    def quota(self) -> int:
+        return self.__quota
+
+    @property
+    def total(self) -> int:
+        """ bytes cached """
+        return self.__total
+
+    def get_path(self, filename: str) -> str:
+        """ '{ROOT}/{md5[:2]}/{filename}' """
+        return os.path.join(self.__root, filename[:2], filename)
+
+    def contains(self, filename: str) -> bool:
+        with self.__lock:
+            if filename in self.__index:
+                self.__index.move_to_end(filename)
+                return True
+        return False
+
+    async def save(self, data: bytes, filename: str) -> int:
+        """
+        Save file data with filename encoded from data
+
+        :param data:     file data
+        :param filename: origin filename, to keep the extension
+        :return: size of data cached
+        """
+        size = len(data)
+        if size > self.INLINE_HASH_SIZE:
+            loop = asyncio.get_running_loop()
+            name = await loop.run_in_executor(None, functools.partial(filename_from_data, data=data, filename=filename))
+        else:
+            name = filename_from_data(data=data, filename=filename)
+        if self.contains(filename=name):
+            # same data cached before
+            self.debug(msg='file data exists: %s -> %s' % (filename, name))
+            return size
+        path = self.get_path(filename=name)
+        loop = asyncio.get_running_loop()
+        try:
+            await loop.run_in_executor(None, _write_file, path, data)
+        except OSError as error:
+            self.error(msg='failed to save file data (len=%d): %s, %s' % (size, path, error))
+            return -1
+        with self.__lock:
+            if name not in self.__index:
+                self.__index[name] = size
+                self.__total += size
+        self.info(msg='file data saved (len=%d): %s -> %s' % (size, filename, path))
+        return size
+
+    async def load(self, filename: str) -> Optional[bytes]:
+        """ load file data with encoded filename """
+        if not self.contains(filename=filename):
+            return None
+        path = self.get_path(filename=filename)
+        loop = asyncio.get_running_loop()
+        try:
+            return await loop.run_in_executor(None, _read_file, path)
+        except OSError as error:
+            self.error(msg='failed to load file: %s, %s' % (path, error))
+            with self.__lock:
+                size = self.__index.pop(filename, None)
+                if size is not None:
+                    self.__total -= size
+
+    #
+    #   Background
+    #
+
+    # Override
+    async def process(self) -> bool:
+        if not self.__scanned:
+            self.__scanned = True
+            self._scan()
+            return True
+        if self.__total <= self.__quota:
+            return False
+        # over quota, evict least recently used files
+        try:
+            count = self._evict()
+            self.info(msg='evicted %d file(s), %d bytes cached' % (count, self.__total))
+        except Exception as error:
+            self.error(msg='failed to evict files: %s' % error)
+        return False
+
+    def _scan(self):
+        """ build index from files existed, oldest access first """
+        items = []
+        for sub in _list_dir(path=self.__root):
+            for entry in _scan_dir(path=os.path.join(self.__root, sub)):
+                if entry.is_file() and not entry.name.endswith(r'.tmp'):
+                    info = entry.stat()
+                    items.append((info.st_atime, entry.name, info.st_size))
+        items.sort()
+        with self.__lock:
+            index = OrderedDict()
+            total = 0
+            for _, name, size in items:
+                index[name] = size
+                total += size
+            # files saved while scanning are newer
+            for name, size in self.__index.items():
+                if name not in index:
+                    index[name] = size
+                    total += size
+            self.__index = index
+            self.__total = total
+        self.info(msg='scanned %d file(s), %d bytes in %s' % (len(items), self.__total, self.__root))
+
+    def _evict(self) -> int:
+        # evict down to 90% of quota, so it won't evict again too soon
+        target = self.__quota * 9 // 10
+        count = 0
+        while True:
+            with self.__lock:
+                if self.__total <= target or len(self.__index) == 0:
+                    break
+                name, size = self.__index.popitem(last=False)
+                self.__total -= size
+            try:
+                os.remove(self.get_path(filename=name))
+            except FileNotFoundError:
+                pass
+            count += 1
+        return count
+
+
+def _write_file(path: str, data: bytes):
+    """ write to a temporary file, then rename it """
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    tmp = '%s.%d.tmp' % (path, threading.get_ident())
+    with open(tmp, 'wb') as file:
+        file.write(data)
+    os.replace(tmp, path)
+
+
+def _read_file(path: str) -> bytes:
+    with open(path, 'rb') as file:
+        return file.read()
+
+
+def _list_dir(path: str) -> List[str]:
+    try:
+        return os.listdir(path)
+    except OSError:
+        return []
+
+
+def _scan_dir(path: str) -> List[os.DirEntry]:
+    try:
+        with os.scandir(path) as it:
+            return list(it)
+    except OSError:
+        return []
@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+# ==============================================================================
+# MIT License
+#
+# Copyright (c) 2024 Albert Moky
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+# ==============================================================================
+
+"""
+    File Cipher
+    ~~~~~~~~~~~
+
+    Encrypt file data in chunks (for worker threads), hashing in the same pass
+"""
+
+import hashlib
+import os
+from typing import Optional, Union, Iterator, Tuple, Dict
+
+from Crypto.Cipher import AES
+
+from dimples import TransportableData
+from dimples import EncryptKey, DecryptKey, SymmetricKey
+from dimples import FileContent
+
+from ..utils import hex_encode
+from ..utils import get_extension
+
+
+CHUNK_SIZE = 1024 * 1024  # bytes, multiple of AES block size
+
+
+def encrypt_file_data(data: bytes, filename: str, password: EncryptKey, extra: Dict) -> Tuple[bytes, str]:
+    """
+    Encrypt file data and build filename from the encrypted data (MD5),
+    this may take a while for large file, call it in a worker thread
+
+    :param data:     file data
+    :param filename: origin filename, to keep the extension
+    :param password: message key
+    :param extra:    to store 'IV'
+    :return: encrypted data & encoded filename
+    """
+    if isinstance(password, SymmetricKey) and password.algorithm == SymmetricKey.AES:
+        # same as 'AES/CBC/PKCS7Padding', without copying the whole data for padding
+        encrypted, digest = _aes_encrypt(data=data, key=password.data, extra=extra)
+    else:
+        encrypted = password.encrypt(data=data, extra=extra)
+        digest = hashlib.md5(encrypted).digest()
+    return encrypted, _encrypted_filename(digest=digest, filename=filename)
+
+
+def get_file_params(content: FileContent) -> Optional[Dict]:
+    """
+    Get params for decrypting the file data downloaded from URL,
+    the 'IV' of file data is recorded in the content by the sender,
+    not in the message ('IV' there is for the message body)
+
+    :param content: file content with password
+    :return: None if the password needs an IV but not found
+    """
+    iv = content.get('IV')
+    if iv is None:
+        password = content.password
+        if password is not None:
+            iv = password.get('iv')
+            if iv is None:
+                iv = password.get('IV')
+        if iv is None and _needs_iv(password=password):
+            return None
+    return {} if iv is None else {'IV': iv}
+
+
+def _needs_iv(password: Optional[DecryptKey]) -> bool:
+    return isinstance(password, SymmetricKey) and password.algorithm == SymmetricKey.AES
+
+
+def _encrypted_filename(digest: bytes, filename: str) -> str:
+    """
+    build filename with MD5 of the encrypted data,
+    even if the origin filename was encoded from the plaintext (e.g. '{MD5}.jpeg'),
+    so different ciphertexts never share a filename on CDN
+    """
+    name = hex_encode(data=digest)
+    ext = get_extension(filename=filename)
+    if ext is None or len(ext) == 0:
+        return name
+    return '%s.%s' % (name, ext)
+
+
+def _aes_encrypt(data: bytes, key: bytes, extra: Dict) -> Tuple[bytearray, bytes]:
+    # 1. random new 'IV', put it into extra
+    iv = os.urandom(AES.block_size)
+    extra['IV'] = TransportableData.create(data=iv).object
+    # 2. encrypt full blocks chunk by chunk into the output buffer
+    size = len(data)
+    pad = AES.block_size - size % AES.block_size
+    body = size + pad - AES.block_size
+    output = bytearray(size + pad)
+    src = memoryview(data)
+    dst = memoryview(output)
+    cipher = AES.new(key, AES.MODE_CBC, iv)
+    hasher = hashlib.md5()
+    pos = 0
+    while pos < body:
+        end = min(pos + CHUNK_SIZE, body)
+        cipher.encrypt(src[pos:end], output=dst[pos:end])
+        hasher.update(dst[pos:end])
+        pos = end
+    # 3. PKCS#7 padding for the last block
+    tail = bytes(src[body:]) + bytes([pad]) * pad
+    cipher.encrypt(tail, output=dst[body:])
+    hasher.update(dst[body:])
+    return output, hasher.digest()
+
+
+def iter_chunks(data: Union[bytes, bytearray], size: int = CHUNK_SIZE) -> Iterator[memoryview]:
+    """ slices of data without copying """
+    view = memoryview(data)
+    for pos in range(0, len(view), size):
+        yield view[pos:pos + size]
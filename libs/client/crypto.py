@@ -0,0 +1,244 @@
+# -*- coding: utf-8 -*-
+# ==============================================================================
+# MIT License
+#
+# Copyright (c) 2024 Albert Moky
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+# ==============================================================================
+
+
+"""
+    Crypto Pool
+    ~~~~~~~~~~~
+
+    Run asymmetric crypto (sign, verify, encrypt & decrypt message keys) in worker processes/threads;
+    jobs queued in the same loop iteration are sent to the workers in batches
+"""
+
+import asyncio
+import threading
+from collections import OrderedDict
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Optional, Tuple, List
+
+from dimples import SignKey, VerifyKey
+from dimples import EncryptKey, DecryptKey
+from dimples import PublicKey, PrivateKey
+
+from ..utils import json_encode
+from ..utils import Logging
+
+
+class CryptoPool(Logging):
+    """
+        mode 'process': keys are sent to workers as dictionaries, parsed & cached there;
+        mode 'thread':  keys are used directly, only helps when the crypto library releases the GIL.
+    """
+
+    PROCESS = 'process'
+    THREAD = 'thread'
+
+    BATCH_SIZE = 16  # jobs per worker call
+
+    def __init__(self, workers: int, mode: str = None, batch_size: int = None):
+        super().__init__()
+        self.__workers = max(1, workers)
+        self.__mode = self.PROCESS if mode is None else mode
+        self.__batch_size = self.BATCH_SIZE if batch_size is None or batch_size <= 0 else batch_size
+        self.__executor: Optional[Executor] = None
+        self.__pending: List[Tuple[tuple, asyncio.Future]] = []
+        self.__lock = threading.Lock()
+
+    @property
+    def workers(self) -> int:
+        return self.__workers
+
+    @property
+    def mode(self) -> str:
+        return self.__mode
+
+    @property
+    def batch_size(self) -> int:
+        return self.__batch_size
+
+    def _get_executor(self) -> Executor:
+        with self.__lock:
+            executor = self.__executor
+            if executor is None:
+                if self.__mode == self.THREAD:
+                    executor = ThreadPoolExecutor(max_workers=self.__workers, thread_name_prefix='crypto')
+                else:
+                    executor = ProcessPoolExecutor(max_workers=self.__workers, initializer=_init_worker)
+                self.__executor = executor
+                self.info(msg='crypto pool started: %d %s worker(s)' % (self.__workers, self.__mode))
+            return executor
+
+    def shutdown(self):
+        with self.__lock:
+            executor = self.__executor
+            self.__executor = None
+        if executor is not None:
+            executor.shutdown(wait=False)
+
+    #
+    #   Crypto
+    #
+
+    async def sign(self, key: SignKey, data: bytes) -> bytes:
+        return await self._submit(job=(_SIGN, [self._pack(key)], data, None))
+
+    async def verify(self, keys: List[VerifyKey], data: bytes, signature: bytes) -> bool:
+        return await self._submit(job=(_VERIFY, [self._pack(key) for key in keys], data, signature))
+
+    async def encrypt(self, key: EncryptKey, data: bytes) -> bytes:
+        return await self._submit(job=(_ENCRYPT, [self._pack(key)], data, None))
+
+    async def decrypt(self, keys: List[DecryptKey], data: bytes) -> Optional[bytes]:
+        return await self._submit(job=(_DECRYPT, [self._pack(key) for key in keys], data, None))
+
+    def _pack(self, key):
+        if self.__mode == self.THREAD:
+            return key
+        return key.dictionary
+
+    #
+    #   Batching
+    #
+
+    async def _submit(self, job: tuple):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.__pending.append((job, future))
+        if len(self.__pending) == 1:
+            # flush after other coroutines in this loop iteration queued their jobs
+            loop.call_soon(self._flush, loop)
+        return await future
+
+    def _flush(self, loop: asyncio.AbstractEventLoop):
+        pending = self.__pending
+        self.__pending = []
+        size = self.__batch_size
+        # spread jobs over workers, but no more than batch size for each call
+        count = len(pending)
+        step = min(size, max(1, -(-count // self.__workers)))
+        executor = self._get_executor()
+        for start in range(0, count, step):
+            batch = pending[start:start + step]
+            jobs = [job for job, _ in batch]
+            try:
+                waiting = loop.run_in_executor(executor, _run_jobs, jobs)
+            except Exception as error:
+                # executor shutdown or broken
+                self.error(msg='failed to submit %d crypto job(s): %s' % (len(jobs), error))
+                _set_results(batch=batch, results=_run_jobs(jobs=jobs))
+                continue
+            waiting.add_done_callback(lambda fut, b=batch: self._finish(batch=b, waiting=fut))
+
+    def _finish(self, batch: List[Tuple[tuple, asyncio.Future]], waiting: asyncio.Future):
+        error = None if waiting.cancelled() else waiting.exception()
+        if error is None and not waiting.cancelled():
+            _set_results(batch=batch, results=waiting.result())
+            return
+        # worker crashed? run them here
+        self.error(msg='crypto worker failed, run %d job(s) in place: %s' % (len(batch), error))
+        if self.__mode == self.PROCESS:
+            with self.__lock:
+                self.__executor = None
+        _set_results(batch=batch, results=_run_jobs(jobs=[job for job, _ in batch]))
+
+
+def _set_results(batch: List[Tuple[tuple, asyncio.Future]], results: List):
+    for (_, future), result in zip(batch, results):
+        if future.done():
+            continue
+        elif isinstance(result, Exception):
+            future.set_exception(result)
+        else:
+            future.set_result(result)
+
+
+#
+#   Workers
+#
+
+_SIGN = 'sign'
+_VERIFY = 'verify'
+_ENCRYPT = 'encrypt'
+_DECRYPT = 'decrypt'
+
+_KEYS_CAPACITY = 256
+_keys = OrderedDict()  # JSON => key object
+_keys_lock = threading.Lock()
+
+
+def _init_worker():
+    # importing it registers the crypto plugin factories, for parsing keys in worker process
+    import dimples.common  # noqa: F401
+
+
+def _get_key(info, private: bool):
+    if not isinstance(info, dict):
+        # key object from thread mode
+        return info
+    tag = json_encode(obj=info)
+    with _keys_lock:
+        key = _keys.get(tag)
+        if key is not None:
+            _keys.move_to_end(tag)
+            return key
+    if private:
+        key = PrivateKey.parse(key=info)
+    else:
+        key = PublicKey.parse(key=info)
+    with _keys_lock:
+        _keys[tag] = key
+        while len(_keys) > _KEYS_CAPACITY:
+            _keys.popitem(last=False)
+    return key
+
+
+def _run_job(job: tuple):
+    op, keys, data, signature = job
+    if op == _SIGN:
+        return _get_key(keys[0], private=True).sign(data=data)
+    elif op == _VERIFY:
+        for info in keys:
+            if _get_key(info, private=False).verify(data=data, signature=signature):
+                return True
+        return False
+    elif op == _ENCRYPT:
+        return _get_key(keys[0], private=False).encrypt(data=data, extra={})
+    elif op == _DECRYPT:
+        for info in keys:
+            plaintext = _get_key(info, private=True).decrypt(data=data, params={})
+            if plaintext is not None:
+                return plaintext
+        return None
+    raise ValueError('unknown crypto job: %s' % op)
+
+
+def _run_jobs(jobs: List[tuple]) -> List:
+    results = []
+    for job in jobs:
+        try:
+            results.append(_run_job(job=job))
+        except Exception as error:
+            results.append(error)
+    return results
@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+# ==============================================================================
+# MIT License
+#
+# Copyright (c) 2024 Albert Moky
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+# ==============================================================================
+
+
+"""
+    Duplicate Filter
+    ~~~~~~~~~~~~~~~~
+
+    Signatures of incoming messages seen in the last time window, bounded in memory
+"""
+
+import asyncio
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional, Dict
+
+from dimples import ReliableMessage
+
+from ..utils import get_msg_sig
+
+
+class DuplicateFilter:
+    """
+        Messages are checked before verifying (drop replays before any crypto),
+        but recorded only after verified, so forged messages cannot hide the real ones;
+        while a copy is verifying (in flight), other copies wait for its result.
+    """
+
+    WINDOW = 3600 * 2   # seconds
+    CAPACITY = 65536    # signatures
+
+    def __init__(self, window: int = None, capacity: int = None):
+        super().__init__()
+        self.__window = self.WINDOW if window is None or window <= 0 else window
+        self.__capacity = self.CAPACITY if capacity is None or capacity <= 0 else capacity
+        self.__seen: Dict[str, float] = OrderedDict()  # tag => expires, oldest first
+        self.__flying: Dict[str, asyncio.Future] = {}  # tag => result of verifying
+        self.__lock = threading.Lock()
+        self.__dropped = 0
+
+    @property
+    def window(self) -> int:
+        return self.__window
+
+    @property
+    def count(self) -> int:
+        return len(self.__seen)
+
+    @property
+    def dropped(self) -> int:
+        """ duplicated messages dropped """
+        return self.__dropped
+
+    def duplicated(self, msg: ReliableMessage, now: float = None) -> bool:
+        if now is None:
+            now = time.time()
+        tag = get_msg_tag(msg=msg)
+        with self.__lock:
+            expires = self.__seen.get(tag)
+            if expires is None:
+                return False
+            elif expires < now:
+                self.__seen.pop(tag, None)
+                return False
+            self.__dropped += 1
+            return True
+
+    async def acquire(self, msg: ReliableMessage) -> Optional[str]:
+        """
+        Mark message in flight before verifying
+
+        :return: tag for 'release()', None if duplicated
+        """
+        tag = get_msg_tag(msg=msg)
+        while True:
+            with self.__lock:
+                expires = self.__seen.get(tag)
+                if expires is not None and expires >= time.time():
+                    self.__dropped += 1
+                    return None
+                waiter = self.__flying.get(tag)
+                if waiter is None:
+                    self.__flying[tag] = asyncio.get_running_loop().create_future()
+                    return tag
+            # another copy is verifying, check again after it's done
+            await asyncio.shield(waiter)
+
+    def release(self, tag: str, verified: bool):
+        """ promote to recorded if verified, or clear it for the other copies to verify """
+        with self.__lock:
+            waiter = self.__flying.pop(tag, None)
+            if verified:
+                self._record(tag=tag, now=time.time())
+        if waiter is not None and not waiter.done():
+            waiter.set_result(verified)
+
+    def record(self, msg: ReliableMessage, now: float = None):
+        if now is None:
+            now = time.time()
+        tag = get_msg_tag(msg=msg)
+        with self.__lock:
+            self._record(tag=tag, now=now)
+
+    def _record(self, tag: str, now: float):
+        seen = self.__seen
+        seen.pop(tag, None)
+        seen[tag] = now + self.__window
+        # remove expired & overflowed, oldest first
+        while len(seen) > 0:
+            first = next(iter(seen))
+            if len(seen) > self.__capacity or seen[first] < now:
+                seen.pop(first)
+            else:
+                break
+
+
+def get_msg_tag(msg: ReliableMessage) -> str:
+    """ '{SIG}:{SENDER}:{RECEIVER}' """
+    return '%s:%s:%s' % (get_msg_sig(msg=msg), msg.sender, msg.receiver)
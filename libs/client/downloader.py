@@ -0,0 +1,341 @@
+# -*- coding: utf-8 -*-
+# ==============================================================================
+# MIT License
+#
+# Copyright (c) 2024 Albert Moky
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+# ==============================================================================
+
+
+"""
+    Downloader
+    ~~~~~~~~~~
+
+    Download file data from URL in FileContent (resumable, streaming to disk),
+    decrypt it in executor, and keep the plaintext in file cache (content-addressed)
+"""
+
+import asyncio
+import os
+import time
+from collections import OrderedDict
+from typing import Optional, Tuple, Dict
+from urllib.parse import urlparse
+
+import aiohttp
+
+from dimples import DecryptKey
+from dimples import FileContent
+
+from ..utils import md5, hex_encode
+from ..utils import Singleton, Runner, Logging
+
+from .cache import FileCache
+from .cipher import get_file_params
+
+
+@Singleton
+class Downloader(Runner, Logging):
+    """
+        Runs in its own thread (one connection pool for all services),
+        services in other threads await the results with 'fetch()'.
+    """
+
+    POOL_SIZE = 8          # connections
+    KEEP_ALIVE = 60        # seconds
+    TIMEOUT = 300          # seconds
+    MAX_CONCURRENT = 4     # downloading tasks
+    MAX_SIZE = 1024 * 1024 * 64  # bytes
+    MAX_RETRIES = 3
+
+    CHUNK_SIZE = 1024 * 64     # bytes
+    NAMES_CAPACITY = 1024      # URLs
+    PART_EXPIRES = 3600 * 24   # seconds, for unfinished downloads
+
+    def __init__(self):
+        super().__init__(interval=Runner.INTERVAL_SLOW)
+        self.__root: Optional[str] = None  # directory for partial downloads
+        self.__file_cache: Optional[FileCache] = None
+        self.__pool_size = self.POOL_SIZE
+        self.__max_concurrent = self.MAX_CONCURRENT
+        self.__max_size = self.MAX_SIZE
+        self.__loop: Optional[asyncio.AbstractEventLoop] = None
+        self.__session: Optional[aiohttp.ClientSession] = None
+        self.__semaphore: Optional[asyncio.Semaphore] = None
+        self.__tasks: Dict[str, asyncio.Task] = {}  # URL => downloading task
+        self.__names: Dict[str, str] = OrderedDict()  # URL => cached filename
+        self.__next_purge = 0
+
+    @property
+    def root(self) -> Optional[str]:
+        return self.__root
+
+    @root.setter
+    def root(self, path: str):
+        self.__root = path
+
+    @property
+    def file_cache(self) -> Optional[FileCache]:
+        return self.__file_cache
+
+    @file_cache.setter
+    def file_cache(self, cache: FileCache):
+        self.__file_cache = cache
+
+    @property
+    def pool_size(self) -> int:
+        return self.__pool_size
+
+    @pool_size.setter
+    def pool_size(self, size: int):
+        self.__pool_size = self.POOL_SIZE if size is None or size <= 0 else size
+
+    @property
+    def max_concurrent(self) -> int:
+        return self.__max_concurrent
+
+    @max_concurrent.setter
+    def max_concurrent(self, count: int):
+        self.__max_concurrent = self.MAX_CONCURRENT if count is None or count <= 0 else count
+
+    @property
+    def max_size(self) -> int:
+        return self.__max_size
+
+    @max_size.setter
+    def max_size(self, size: int):
+        self.__max_size = self.MAX_SIZE if size is None or size <= 0 else size
+
+    #
+    #   Runner
+    #
+
+    # Override
+    async def setup(self):
+        await super().setup()
+        self.__loop = asyncio.get_running_loop()
+
+    # Override
+    async def finish(self):
+        session = self.__session
+        if session is not None:
+            self.__session = None
+            await session.close()
+        self.__loop = None
+        await super().finish()
+
+    # Override
+    async def process(self) -> bool:
+        now = time.time()
+        if now > self.__next_purge:
+            self.__next_purge = now + 3600
+            self._purge_parts(now=now)
+        return False
+
+    def _purge_parts(self, now: float):
+        """ remove unfinished downloads too old to resume """
+        root = self.__root
+        if root is None:
+            return
+        try:
+            with os.scandir(root) as it:
+                entries = [entry for entry in it if entry.name.endswith('.part')]
+            for entry in entries:
+                if entry.stat().st_mtime < now - self.PART_EXPIRES:
+                    os.remove(entry.path)
+        except OSError as error:
+            self.error(msg='failed to purge partial downloads: %s, %s' % (root, error))
+
+    #
+    #   Fetching
+    #
+
+    async def fetch(self, content: FileContent, params: Dict = None) -> Optional[bytes]:
+        """
+        Get decrypted file data (from file cache, or download it)
+
+        :param content: file content with URL & password
+        :param params:  params for decryption (IV), default is the 'IV' recorded in the content
+        :return: None on failed
+        """
+        data = content.data
+        if data is not None:
+            # small file in message
+            return data
+        url = content.url
+        if url is None:
+            self.warning(msg='file content without URL: %s' % content)
+            return None
+        if params is None:
+            params = get_file_params(content=content)
+            if params is None:
+                # decrypting with a zero IV would return broken data silently
+                self.error(msg='IV not found for file: %s, %s' % (url, content.filename))
+                return None
+        loop = self.__loop
+        if loop is None:
+            self.error(msg='downloader not running, cannot fetch: %s' % url)
+            return None
+        coro = self._fetch(url=url, password=content.password, params=params, filename=content.filename)
+        if loop is asyncio.get_running_loop():
+            return await coro
+        # call from other thread
+        future = asyncio.run_coroutine_threadsafe(coro, loop)
+        return await asyncio.wrap_future(future)
+
+    async def _fetch(self, url: str, password: Optional[DecryptKey], params: Dict,
+                     filename: Optional[str]) -> Optional[bytes]:
+        # 1. check file cache
+        cache = self.__file_cache
+        name = self.__names.get(url)
+        if name is not None and cache is not None:
+            data = await cache.load(filename=name)
+            if data is not None:
+                self.__names.move_to_end(url)
+                return data
+        # 2. download (only once for the same URL)
+        task = self.__tasks.get(url)
+        if task is None:
+            if filename is None:
+                filename = urlparse(url).path
+            coro = self._download_and_decrypt(url=url, password=password, params=params, filename=filename)
+            task = asyncio.create_task(coro)
+            self.__tasks[url] = task
+            task.add_done_callback(lambda t: self.__tasks.pop(url, None))
+        return await asyncio.shield(task)
+
+    async def _download_and_decrypt(self, url: str, password: Optional[DecryptKey], params: Dict,
+                                    filename: Optional[str]) -> Optional[bytes]:
+        path = await self._download(url=url)
+        if path is None:
+            return None
+        loop = asyncio.get_running_loop()
+        try:
+            data, name = await loop.run_in_executor(None, _decrypt_file, path, password, params, filename)
+        except Exception as error:
+            self.error(msg='failed to decrypt file: %s, %s' % (url, error))
+            return None
+        finally:
+            _remove(path=path)
+        if data is None:
+            self.error(msg='failed to decrypt file: %s, password: %s' % (url, password))
+            return None
+        # 3. cache decrypted data
+        cache = self.__file_cache
+        if cache is not None and await cache.save(data=data, filename=name) >= 0:
+            names = self.__names
+            names[url] = name
+            names.move_to_end(url)
+            while len(names) > self.NAMES_CAPACITY:
+                names.popitem(last=False)
+        return data
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        """ persistent session (connection pool), created on the running loop """
+        session = self.__session
+        if session is None or session.closed:
+            connector = aiohttp.TCPConnector(limit=self.__pool_size, keepalive_timeout=self.KEEP_ALIVE)
+            timeout = aiohttp.ClientTimeout(total=self.TIMEOUT)
+            self.__session = session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+        return session
+
+    async def _download(self, url: str) -> Optional[str]:
+        """ download to '{ROOT}/{md5(url)}.part', resume from the partial file if exists """
+        root = self.__root
+        if root is None:
+            self.error(msg='download directory not set: %s' % url)
+            return None
+        path = os.path.join(root, '%s.part' % hex_encode(data=md5(data=url.encode('utf-8'))))
+        semaphore = self.__semaphore
+        if semaphore is None:
+            self.__semaphore = semaphore = asyncio.Semaphore(self.__max_concurrent)
+        async with semaphore:
+            delay = 1.0
+            for attempt in range(1, self.MAX_RETRIES + 1):
+                try:
+                    size = await self._download_to(url=url, path=path)
+                    self.info(msg='file downloaded (len=%d): %s -> %s' % (size, url, path))
+                    return path
+                except (aiohttp.ClientError, asyncio.TimeoutError, OSError) as error:
+                    self.warning(msg='download failed (%d/%d): %s, %s' % (attempt, self.MAX_RETRIES, url, error))
+                except ValueError as error:
+                    # file too large
+                    self.error(msg='download refused: %s, %s' % (url, error))
+                    break
+                await asyncio.sleep(delay)
+                delay *= 2
+        _remove(path=path)
+
+    async def _download_to(self, url: str, path: str) -> int:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        offset = _file_size(path=path)
+        headers = None if offset == 0 else {'Range': 'bytes=%d-' % offset}
+        session = self._get_session()
+        async with session.get(url, headers=headers) as response:
+            if response.status == 416 and offset > 0:
+                # range not satisfiable, downloaded already
+                return offset
+            elif response.status == 206 and offset > 0:
+                mode = 'ab'
+            elif response.status == 200:
+                # server doesn't support range, download again
+                mode = 'wb'
+                offset = 0
+            else:
+                raise aiohttp.ClientResponseError(request_info=response.request_info, history=response.history,
+                                                  status=response.status, message='download error')
+            length = response.content_length
+            if length is not None and offset + length > self.__max_size:
+                raise ValueError('file too large: %d + %d > %d' % (offset, length, self.__max_size))
+            size = offset
+            with open(path, mode) as file:
+                async for chunk in response.content.iter_chunked(self.CHUNK_SIZE):
+                    size += len(chunk)
+                    if size > self.__max_size:
+                        raise ValueError('file too large: > %d' % self.__max_size)
+                    file.write(chunk)
+        return size
+
+
+def _decrypt_file(path: str, password: Optional[DecryptKey], params: Dict,
+                  filename: Optional[str]) -> Tuple[Optional[bytes], Optional[str]]:
+    """ decrypt file data, and name it with MD5 of the plaintext: '{md5}.{ext}' """
+    with open(path, 'rb') as file:
+        data = file.read()
+    if password is not None:
+        data = password.decrypt(data=data, params=params)
+        if data is None:
+            return None, None
+    ext = '' if filename is None else os.path.splitext(filename)[1]
+    return data, '%s%s' % (hex_encode(data=md5(data=data)), ext)
+
+
+def _file_size(path: str) -> int:
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
+
+def _remove(path: str):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
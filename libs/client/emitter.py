@@ -23,30 +23,64 @@
 # SOFTWARE.
 # ==============================================================================
 
-from typing import Optional, Tuple, Dict
+import asyncio
+import functools
+import time
+from collections import OrderedDict
+from typing import Optional, Iterable, Tuple, List, Dict
 
-from dimples import TransportableData
+from dimples import PortableNetworkFile
 from dimples import EncryptKey, ID
 from dimples import InstantMessage, ReliableMessage
 from dimples import Envelope, Content
 from dimples import TextContent, FileContent
 from dimples.client import ClientMessenger
+from dimples.client.network.state import StateOrder
 
-from ..utils import md5, hex_encode
-from ..utils import filename_from_data
 from ..utils import Singleton, Log, Logging
+from ..utils import Metrics, MetricsRegistry
 
 from .group import SharedGroupManager
+from .cache import FileCache
+from .cipher import encrypt_file_data
+from .uploader import Uploader, UploadDelegate
+from .upload_index import UploadIndex, get_upload_key
+from .outbox import Outbox
+from .priority import PriorityPolicy, estimate_size
+from .image import ImagePipeline
+from .messenger import ClientMessenger as BodySharingMessenger
 
 
 @Singleton
-class Emitter(Logging):
+class Emitter(UploadDelegate, Logging):
+
+    OUTGOING_EXPIRES = 3600   # seconds
+    OUTGOING_CAPACITY = 1024  # tasks
+    PURGE_INTERVAL = 60       # seconds
+
+    RESEND_INTERVAL = 8  # seconds
+    RESEND_BATCH = 32    # messages
+
+    BROADCAST_CONCURRENCY = 16  # receivers
+
+    # encrypt small file on the event loop, bigger ones in executor
+    INLINE_ENCRYPT_SIZE = 1024 * 64  # bytes
 
     def __init__(self):
         super().__init__()
         self.__messenger: Optional[ClientMessenger] = None
-        # filename => task
-        self.__outgoing: Dict[str, InstantMessage] = {}
+        self.__file_cache: Optional[FileCache] = None
+        self.__uploader: Optional[Uploader] = None
+        self.__upload_index: Optional[UploadIndex] = None
+        # (filename, sn) => (task, created time, upload key), oldest first
+        self.__outgoing: Dict[Tuple[str, int], Tuple[InstantMessage, float, Optional[str]]] = {}
+        self.__expired_count = 0
+        self.__purging: Optional[asyncio.Task] = None
+        self.__outbox: Optional[Outbox] = None
+        self.__resending: Optional[asyncio.Task] = None
+        self.__priority_policy = PriorityPolicy()
+        self.__image_pipeline: Optional[ImagePipeline] = None
+        self.__metrics = MetricsRegistry().get_metrics(name='emitter')
 
     @property
     def messenger(self) -> ClientMessenger:
@@ -56,23 +90,147 @@ class Emitter(Logging):
     def messenger(self, transceiver: ClientMessenger):
         self.__messenger = transceiver
 
-    def _add_task(self, filename: str, msg: InstantMessage):
-        self.__outgoing[filename] = msg
+    @property
+    def file_cache(self) -> Optional[FileCache]:
+        return self.__file_cache
+
+    @file_cache.setter
+    def file_cache(self, cache: FileCache):
+        self.__file_cache = cache
+
+    @property
+    def uploader(self) -> Optional[Uploader]:
+        return self.__uploader
+
+    @uploader.setter
+    def uploader(self, delegate: Uploader):
+        self.__uploader = delegate
+
+    @property
+    def upload_index(self) -> Optional[UploadIndex]:
+        return self.__upload_index
+
+    @upload_index.setter
+    def upload_index(self, index: UploadIndex):
+        self.__upload_index = index
 
-    def _pop_task(self, filename: str) -> Optional[InstantMessage]:
-        return self.__outgoing.pop(filename, None)
+    @property
+    def outbox(self) -> Optional[Outbox]:
+        return self.__outbox
+
+    @outbox.setter
+    def outbox(self, box: Outbox):
+        self.__outbox = box
+        if box is not None:
+            # load messages left by last run
+            self._start_resending()
+
+    @property
+    def priority_policy(self) -> PriorityPolicy:
+        return self.__priority_policy
 
-    def purge(self):
-        # TODO: remove expired messages in the map
-        pass
+    @priority_policy.setter
+    def priority_policy(self, policy: PriorityPolicy):
+        self.__priority_policy = policy
 
+    @property
+    def image_pipeline(self) -> ImagePipeline:
+        pipeline = self.__image_pipeline
+        if pipeline is None:
+            self.__image_pipeline = pipeline = ImagePipeline()
+        return pipeline
+
+    @image_pipeline.setter
+    def image_pipeline(self, pipeline: ImagePipeline):
+        self.__image_pipeline = pipeline
+
+    @property
+    def pending_count(self) -> int:
+        """ count of tasks waiting for upload """
+        return len(self.__outgoing)
+
+    @property
+    def expired_count(self) -> int:
+        """ count of tasks expired or evicted """
+        return self.__expired_count
+
+    async def _add_task(self, filename: str, msg: InstantMessage, upload_key: Optional[str] = None):
+        outgoing = self.__outgoing
+        # tasks for the same file are kept separately by message
+        key = (filename, msg.content.sn)
+        # re-insert to keep the map ordered by created time
+        outgoing.pop(key, None)
+        # check capacity
+        overflow = len(outgoing) - self.OUTGOING_CAPACITY + 1
+        if overflow > 0:
+            oldest = list(outgoing.keys())[:overflow]
+            self.warning(msg='too many tasks (%d), evict %d oldest' % (len(outgoing), overflow))
+            await self._expire_tasks(keys=oldest)
+        outgoing[key] = (msg, time.time(), upload_key)
+        self._start_purging()
+
+    def _pop_task(self, filename: str) -> Tuple[Optional[InstantMessage], Optional[str]]:
+        """ pop the oldest task for this file, return message & upload key """
+        outgoing = self.__outgoing
+        for key in outgoing:
+            if key[0] == filename:
+                msg, created, upload_key = outgoing.pop(key)
+                # time from adding task to upload finished
+                self._observe(name='upload_seconds', msg=msg, value=time.time() - created)
+                return msg, upload_key
+        return None, None
+
+    async def purge(self, now: float = None) -> int:
+        """ remove expired tasks in the map, mark them failed """
+        if now is None:
+            now = time.time()
+        expired = now - self.OUTGOING_EXPIRES
+        keys = []
+        for key, task in self.__outgoing.items():
+            if task[1] > expired:
+                # the rest are newer
+                break
+            keys.append(key)
+        if len(keys) > 0:
+            self.warning(msg='purge %d expired task(s), %d pending' % (len(keys), len(self.__outgoing)))
+            await self._expire_tasks(keys=keys)
+        return len(keys)
+
+    async def _expire_tasks(self, keys: List[Tuple[str, int]]):
+        for key in keys:
+            task = self.__outgoing.pop(key, None)
+            if task is None:
+                continue
+            self.__expired_count += 1
+            self.info(msg='task expired: %s' % key[0])
+            await self._task_failed(msg=task[0])
+
+    def _start_purging(self):
+        task = self.__purging
+        if task is None or task.done():
+            self.__purging = asyncio.get_running_loop().create_task(self._purge_loop())
+
+    async def _purge_loop(self):
+        """ purge periodically while there are tasks waiting """
+        while len(self.__outgoing) > 0:
+            await asyncio.sleep(self.PURGE_INTERVAL)
+            try:
+                await self.purge()
+            except Exception as error:
+                self.error(msg='failed to purge tasks: %s' % error)
+
+    # Override
     async def upload_success(self, filename: str, url: str):
         """ callback when file data uploaded to CDN and download URL responded """
-        msg = self._pop_task(filename=filename)
+        msg, upload_key = self._pop_task(filename=filename)
         if msg is None:
             self.error(msg='failed to get task: %s, url: %s' % (filename, url))
             return
         self.info(msg='get task for file: %s, url: %s' % (filename, url))
+        # remember the URL with IV, no need to upload the same data with the same key again
+        index = self.upload_index
+        if index is not None and upload_key is not None:
+            await index.save_upload(upload_key=upload_key, url=url, iv=msg.content.get('IV'))
         # file data uploaded to FTP server, replace it with download URL
         # and send the content to station
         content = msg.content
@@ -81,36 +239,147 @@ class Emitter(Logging):
         content.url = url
         await self._send_instant_message(msg=msg)
 
+    # Override
     async def upload_failed(self, filename: str):
         """ callback when failed to upload file data """
-        msg = self._pop_task(filename=filename)
+        msg, _ = self._pop_task(filename=filename)
         if msg is None:
             self.error(msg='failed to get task: %s' % filename)
             return
         self.info(msg='get task for file: %s' % filename)
+        await self._task_failed(msg=msg)
+
+    async def _task_failed(self, msg: InstantMessage):
+        self._increase(name='upload_failures', msg=msg)
         # file data failed to upload, mark it error
         msg['error'] = {
             'message': 'failed to upload file'
         }
         await self._save_instant_message(msg=msg)
 
+    #
+    #   Metrics
+    #
+
+    @property
+    def metrics(self) -> Metrics:
+        return self.__metrics
+
+    def _increase(self, name: str, msg: InstantMessage, value: float = 1):
+        self.__metrics.increase(name=name, labels=_get_labels(msg=msg), value=value)
+
+    def _observe(self, name: str, msg: InstantMessage, value: float):
+        self.__metrics.observe(name=name, labels=_get_labels(msg=msg), value=value)
+
     async def _save_instant_message(self, msg: InstantMessage):
-        # TODO: save into local storage
-        pass
+        """ save message not sent yet into outbox, for resending later """
+        content = msg.content
+        if isinstance(content, FileContent) and content.url is None:
+            # waiting for uploading, or failed to upload file data
+            return
+        if 'error' in msg:
+            # suspended by packer (e.g. visa not found), it will be resumed by the packer
+            return
+        outbox = self.outbox
+        if outbox is None:
+            self.warning(msg='outbox not set, message lost: %s -> %s' % (msg.sender, msg.receiver))
+            return
+        await outbox.append(msg=msg)
+        self._start_resending()
+
+    async def resend(self, limit: int) -> int:
+        """ resend messages in outbox, stop at the first failure of each receiver """
+        outbox = self.outbox
+        if outbox is None:
+            return 0
+        batch = await outbox.get_batch(limit=limit)
+        sent = []
+        blocked = set()
+        messenger = self.messenger
+        for key, msg in batch:
+            receiver = msg.receiver
+            if receiver in blocked:
+                # keep the order for this receiver
+                continue
+            lane = self.priority_policy.get_lane(msg=msg)
+            async with lane:
+                r_msg = await messenger.send_instant_message(msg=msg, priority=lane.priority)
+            if r_msg is None and 'error' in msg:
+                # suspended by packer (e.g. visa not found), the packer resumes it, not the outbox
+                sent.append((key, receiver))
+            elif r_msg is None:
+                blocked.add(receiver)
+                # put aside if failed too many times, so it won't block the others
+                await outbox.failed(key=key, msg=msg)
+            else:
+                sent.append((key, receiver))
+        await outbox.remove(keys=sent)
+        if len(batch) > 0:
+            self.info(msg='resent %d/%d message(s), %d left in outbox' % (len(sent), len(batch), outbox.count))
+        return len(sent)
+
+    def _is_session_running(self) -> bool:
+        messenger = self.messenger
+        if messenger is None:
+            return False
+        state = messenger.session.state
+        return state is not None and state.index == StateOrder.RUNNING
+
+    def _start_resending(self):
+        task = self.__resending
+        if task is None or task.done():
+            try:
+                loop = asyncio.get_running_loop()
+            except RuntimeError:
+                # no loop yet, start it when the next message saved
+                return
+            self.__resending = loop.create_task(self._resend_loop())
+
+    async def _resend_loop(self):
+        """ resend messages while the session is running """
+        outbox = self.outbox
+        await outbox.load()
+        while outbox.count > 0:
+            await asyncio.sleep(self.RESEND_INTERVAL)
+            if not self._is_session_running():
+                # wait for reconnecting
+                continue
+            try:
+                await self.resend(limit=self.RESEND_BATCH)
+            except Exception as error:
+                self.error(msg='failed to resend messages: %s' % error)
 
     async def _send_instant_message(self, msg: InstantMessage) -> Optional[ReliableMessage]:
         self.info(msg='send message (type=%d): %s -> %s' % (msg.content.type, msg.sender, msg.receiver))
         receiver = msg.receiver
-        if receiver.is_group:
-            # send by group manager
-            g_man = SharedGroupManager()
-            r_msg = await g_man.send_message(msg=msg)
-        else:
-            # send by shared messenger
-            messenger = self.messenger
-            r_msg = await messenger.send_instant_message(msg=msg, priority=1)
-        # save instant message
-        await self._save_instant_message(msg=msg)
+        if not receiver.is_group and self.outbox is not None and not self._is_session_running():
+            # the session would queue it in memory only, keep it in outbox for resending after connected
+            self.info(msg='session not running, save message into outbox: %s' % receiver)
+            self._increase(name='send_failures', msg=msg)
+            await self._save_instant_message(msg=msg)
+            return None
+        start = time.time()
+        # wait for the budget of lane
+        lane = self.priority_policy.get_lane(msg=msg)
+        async with lane:
+            if receiver.is_group:
+                # send by group manager
+                g_man = SharedGroupManager()
+                r_msg = await g_man.send_message(msg=msg, priority=lane.priority)
+            else:
+                # send by shared messenger
+                messenger = self.messenger
+                r_msg = await messenger.send_instant_message(msg=msg, priority=lane.priority)
+        # time for packing (encrypt & sign) and queueing, with waiting time for lane;
+        # the lane budgets packing & queueing only, the session sends packages by departure priority
+        self._observe(name='send_seconds', msg=msg, value=time.time() - start)
+        self._increase(name='messages', msg=msg)
+        self._increase(name='payload_bytes', msg=msg, value=estimate_size(content=msg.content))
+        if r_msg is None:
+            self._increase(name='send_failures', msg=msg)
+        # save instant message not sent yet
+        if r_msg is None and not receiver.is_group:
+            await self._save_instant_message(msg=msg)
         return r_msg
 
     async def send_content(self, content: Content, receiver: ID) -> Tuple[InstantMessage, Optional[ReliableMessage]]:
@@ -142,6 +411,52 @@ class Emitter(Logging):
             self.warning(msg='not send yet (type=%d): %s' % (content.type, receiver))
         return i_msg, r_msg
 
+    async def broadcast(self, content: Content, receivers: Iterable[ID],
+                        concurrency: int = None) -> Dict[ID, Optional[ReliableMessage]]:
+        """
+        Send the same content to many receivers, packing concurrently;
+        the content is serialized once for all personal messages,
+        only encrypted (with the cached message key of each direction) & signed for each receiver
+
+        :param content:     message content, shared by all personal messages
+        :param receivers:   users or groups
+        :param concurrency: max messages packing at the same time
+        :return: receiver => message sent (None if not sent yet, kept in outbox)
+        """
+        if concurrency is None or concurrency <= 0:
+            concurrency = self.BROADCAST_CONCURRENCY
+        semaphore = asyncio.Semaphore(concurrency)
+        # content will be modified when sending to group ('group'),
+        # or sending file data ('data' => 'URL'), so make copies for them only
+        has_data = isinstance(content, FileContent) and content.data is not None
+        messenger = self.messenger
+        shared = not has_data and isinstance(messenger, BodySharingMessenger)
+
+        async def send_one(receiver: ID) -> Optional[ReliableMessage]:
+            if has_data or receiver.is_group:
+                body = Content.parse(content=content.copy_dictionary())
+            else:
+                body = content
+            async with semaphore:
+                try:
+                    _, r_msg = await self.send_content(content=body, receiver=receiver)
+                    return r_msg
+                except Exception as error:
+                    self.error(msg='failed to send content (type=%d) to %s: %s' % (content.type, receiver, error))
+
+        # remove duplicated receivers, keep the order
+        targets = list(OrderedDict.fromkeys(receivers))
+        if shared:
+            messenger.share_content(content=content)
+        try:
+            results = await asyncio.gather(*[send_one(receiver=item) for item in targets])
+        finally:
+            if shared:
+                messenger.unshare_content(content=content)
+        count = len([r_msg for r_msg in results if r_msg is not None])
+        self.info(msg='broadcast content (type=%d) to %d/%d receiver(s)' % (content.type, count, len(targets)))
+        return dict(zip(targets, results))
+
     #
     #   File Message
     #
@@ -159,41 +474,67 @@ class Emitter(Logging):
         data = content.data
         filename = content.filename
         assert data is not None and filename is not None, 'file content error: %s' % content
-        size = await cache_file_data(data=data, filename=filename)
+        size = await cache_file_data(data=data, filename=filename, cache=self.file_cache)
         if size != len(data):
             self.error(msg='failed to save file data (len=%d): %s' % (len(data), filename))
             return
         # 2. save instant message without file data
         content.data = None
         await self._save_instant_message(msg=msg)
-        # 3. add upload task with encrypted data
-        encrypted = password.encrypt(data=data, extra=msg.dictionary)
-        filename = filename_from_data(data=encrypted, filename=filename)
-        sender = msg.sender
-        url = await upload_encrypted_data(data=encrypted, filename=filename, sender=sender)
-        if url is None:
-            # uploading in background thread
-            self.info(msg='wait for uploading: %s -> %s' % (content.filename, filename))
-            self._add_task(filename=filename, msg=msg)
+        # 3. check the same data encrypted by the same key uploaded before
+        upload_key = None
+        index = self.upload_index
+        if index is not None:
+            if len(data) > self.INLINE_ENCRYPT_SIZE:
+                loop = asyncio.get_running_loop()
+                upload_key = await loop.run_in_executor(None, get_upload_key, data, password)
+            else:
+                upload_key = get_upload_key(data=data, password=password)
+            uploaded = None if upload_key is None else await index.get_upload(upload_key=upload_key)
+            if uploaded is not None:
+                url, iv = uploaded
+                self.info(msg='uploaded before: %s => %s' % (filename, url))
+                if iv is not None:
+                    # record 'IV' in the content, 'IV' in the message is overwritten by body encryption
+                    content['IV'] = iv
+                content.url = url
+                return await self._send_instant_message(msg=msg)
+        # 4. add upload task with encrypted data
+        start = time.time()
+        extra = {}
+        if len(data) > self.INLINE_ENCRYPT_SIZE:
+            loop = asyncio.get_running_loop()
+            task = functools.partial(encrypt_file_data, data=data, filename=filename, password=password, extra=extra)
+            encrypted, filename = await loop.run_in_executor(None, task)
         else:
-            # uploaded before
-            self.info(msg='uploaded filename: %s -> %s => %s' % (content.filename, filename, url))
-            content.url = url
-            return await self._send_instant_message(msg=msg)
+            encrypted, filename = encrypt_file_data(data=data, filename=filename, password=password, extra=extra)
+        # record 'IV' in the content, 'IV' in the message is overwritten by body encryption
+        for key in extra:
+            content[key] = extra[key]
+        self._observe(name='encrypt_seconds', msg=msg, value=time.time() - start)
+        self._increase(name='file_bytes', msg=msg, value=len(data))
+        del data  # release the origin data before uploading
+        sender = msg.sender
+        # add task before uploading, the callback may come soon
+        self.info(msg='wait for uploading: %s -> %s' % (content.filename, filename))
+        await self._add_task(filename=filename, msg=msg, upload_key=upload_key)
+        await upload_encrypted_data(data=encrypted, filename=filename, sender=sender, uploader=self.uploader)
 
-    async def send_image_message(self, image: bytes, thumbnail: bytes, receiver: ID):
+    async def send_image_message(self, image: bytes, thumbnail: Optional[bytes], receiver: ID):
         """
         Send image message to receiver
 
         :param image:     image data
-        :param thumbnail: image thumbnail
+        :param thumbnail: image thumbnail (JPEG), None to make it from image
         :param receiver:  destination
         """
-        filename = '%s.jpeg' % hex_encode(data=md5(data=image))
-        ted = TransportableData.create(data=image)
+        # hash, encode & make thumbnail in executor
+        digest, ted, small = await self.image_pipeline.prepare(image=image, thumbnail=thumbnail)
+        filename = '%s.jpeg' % digest
         content = FileContent.image(filename=filename, data=ted)
         content['length'] = len(image)
-        content.thumbnail = thumbnail
+        if small is not None:
+            content.thumbnail = PortableNetworkFile.parse(small)
         return await self.send_content(content=content, receiver=receiver)
 
     async def send_text_message(self, text: str, receiver: ID):
@@ -207,20 +548,31 @@ class Emitter(Logging):
         return await self.send_content(content=content, receiver=receiver)
 
 
+def _get_labels(msg: InstantMessage) -> Dict[str, str]:
+    """ content type & receiver class """
+    return {
+        'type': str(msg.content.type),
+        'receiver': 'group' if msg.receiver.is_group else 'user',
+    }
+
+
 #
 #   CDN Utils
 #
 
 
-async def cache_file_data(data: bytes, filename: str) -> int:
-    # TODO: save file data
-    size = len(data)
-    Log.info(msg='save file: %s, length: %d' % (filename, size))
-    return size
+async def cache_file_data(data: bytes, filename: str, cache: Optional[FileCache]) -> int:
+    if cache is None:
+        size = len(data)
+        Log.warning(msg='file cache not set, skip saving file: %s, length: %d' % (filename, size))
+        return size
+    return await cache.save(data=data, filename=filename)
 
 
-async def upload_encrypted_data(data: bytes, filename: str, sender: ID) -> Optional[str]:
-    # TODO: save file data
+async def upload_encrypted_data(data: bytes, filename: str, sender: ID, uploader: Optional[Uploader]):
     size = len(data)
-    Log.info(msg='upload file: %s, length: %d, sender: %s' % (filename, size, sender))
-    return None
+    if uploader is None:
+        Log.warning(msg='uploader not set, cannot upload file: %s, length: %d, sender: %s' % (filename, size, sender))
+    elif uploader.upload(data=data, filename=filename, sender=sender):
+        Log.info(msg='uploading file: %s, length: %d, sender: %s' % (filename, size, sender))
+    # the URL will be responded via 'upload_success()'
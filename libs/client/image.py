@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+# ==============================================================================
+# MIT License
+#
+# Copyright (c) 2024 Albert Moky
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+# ==============================================================================
+
+"""
+    Image Pipeline
+    ~~~~~~~~~~~~~~
+
+    Hash, encode & make thumbnail for image in executor, thumbnails cached by image hash
+"""
+
+import asyncio
+import io
+import threading
+from collections import OrderedDict
+from typing import Optional, Tuple
+
+from dimples import TransportableData
+
+from ..utils import md5, hex_encode, base64_encode
+from ..utils import Logging
+
+try:
+    # optional, for making thumbnails
+    from PIL import Image
+except ImportError:
+    Image = None
+
+
+class ImagePipeline(Logging):
+
+    THUMBNAIL_SIZE = 128    # pixels, max width & height
+    THUMBNAIL_QUALITY = 50  # JPEG quality
+    CACHE_CAPACITY = 1024   # thumbnails
+
+    def __init__(self, size: int = None, quality: int = None, capacity: int = None):
+        super().__init__()
+        self.__size = self.THUMBNAIL_SIZE if size is None or size <= 0 else size
+        self.__quality = self.THUMBNAIL_QUALITY if quality is None or quality <= 0 else quality
+        self.__capacity = self.CACHE_CAPACITY if capacity is None or capacity <= 0 else capacity
+        self.__thumbnails = OrderedDict()  # image hash => thumbnail ('data:image/jpeg;base64,...')
+        self.__lock = threading.Lock()
+        if Image is None:
+            self.warning(msg='Pillow not installed, cannot make thumbnails')
+
+    def get_thumbnail(self, digest: str) -> Optional[str]:
+        with self.__lock:
+            thumbnail = self.__thumbnails.get(digest)
+            if thumbnail is not None:
+                self.__thumbnails.move_to_end(digest)
+            return thumbnail
+
+    def _cache_thumbnail(self, digest: str, thumbnail: str):
+        with self.__lock:
+            self.__thumbnails[digest] = thumbnail
+            self.__thumbnails.move_to_end(digest)
+            while len(self.__thumbnails) > self.__capacity:
+                self.__thumbnails.popitem(last=False)
+
+    async def prepare(self, image: bytes,
+                      thumbnail: Optional[bytes] = None) -> Tuple[str, TransportableData, Optional[str]]:
+        """
+        Process image data in executor
+
+        :param image:     image data
+        :param thumbnail: thumbnail data (JPEG), make it from image if not given
+        :return: image hash (MD5 in hex), image data wrapper, thumbnail
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, self._prepare, image, thumbnail)
+
+    def _prepare(self, image: bytes, thumbnail: Optional[bytes]) -> Tuple[str, TransportableData, Optional[str]]:
+        # one hash pass for filename, file cache & thumbnail cache
+        digest = hex_encode(data=md5(data=image))
+        ted = TransportableData.create(data=image)
+        if thumbnail is not None:
+            small = _thumbnail_uri(data=thumbnail)
+            self._cache_thumbnail(digest=digest, thumbnail=small)
+            return digest, ted, small
+        small = self.get_thumbnail(digest=digest)
+        if small is None:
+            data = self._make_thumbnail(image=image)
+            if data is not None:
+                small = _thumbnail_uri(data=data)
+                self._cache_thumbnail(digest=digest, thumbnail=small)
+        return digest, ted, small
+
+    def _make_thumbnail(self, image: bytes) -> Optional[bytes]:
+        if Image is None:
+            return None
+        try:
+            with Image.open(io.BytesIO(image)) as img:
+                img.thumbnail((self.__size, self.__size))
+                if img.mode != 'RGB':
+                    img = img.convert('RGB')
+                buffer = io.BytesIO()
+                img.save(buffer, format='JPEG', quality=self.__quality)
+                return buffer.getvalue()
+        except Exception as error:
+            self.error(msg='failed to make thumbnail (len=%d): %s' % (len(image), error))
+
+
+def _thumbnail_uri(data: bytes) -> str:
+    return 'data:image/jpeg;base64,%s' % base64_encode(data=data)
@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+# ==============================================================================
+# MIT License
+#
+# Copyright (c) 2024 Albert Moky
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+# ==============================================================================
+
+
+"""
+    Message Keys
+    ~~~~~~~~~~~~
+
+    Reuse message keys for each direction (sender => receiver/group) until expired or used too many times,
+    and the message key encrypted for each receiver, so asymmetric encryption runs once for every new key
+"""
+
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional, Tuple, Dict
+
+from dimples import ID
+from dimples import SymmetricKey
+
+from ..utils import Logging
+
+
+class _KeyEntry:
+
+    def __init__(self, key: SymmetricKey, expires: float):
+        super().__init__()
+        self.key = key
+        self.expires = expires
+        self.count = 0
+
+
+class MessageKeyCache(Logging):
+    """
+        1. message key of (sender, receiver/group) is rotated after 'ttl' seconds or 'max_messages' messages;
+        2. encrypted key is cached by (receiver, key data, receiver's public key),
+           so it is re-encrypted when the key rotated or the receiver's visa changed;
+        both maps keep 'capacity' entries at most (least recently used evicted first),
+        and expired entries are swept periodically.
+    """
+
+    TTL = 3600            # seconds
+    MAX_MESSAGES = 1024   # messages for each key
+    CAPACITY = 4096       # directions, and encrypted keys
+    SWEEP_INTERVAL = 300  # seconds
+
+    def __init__(self, ttl: int = None, max_messages: int = None, capacity: int = None):
+        super().__init__()
+        self.__ttl = self.TTL if ttl is None or ttl <= 0 else ttl
+        self.__max_messages = self.MAX_MESSAGES if max_messages is None or max_messages <= 0 else max_messages
+        self.__capacity = self.CAPACITY if capacity is None or capacity <= 0 else capacity
+        self.__keys: Dict[Tuple[ID, ID], _KeyEntry] = OrderedDict()
+        # (receiver, key data, public key) => (expires, encrypted key)
+        self.__encrypted: Dict[Tuple[ID, bytes, str], Tuple[float, bytes]] = OrderedDict()
+        self.__lock = threading.Lock()
+        self.__next_sweep = 0
+
+    @property
+    def ttl(self) -> int:
+        return self.__ttl
+
+    @property
+    def max_messages(self) -> int:
+        return self.__max_messages
+
+    def get_key(self, sender: ID, receiver: ID, now: float = None) -> Optional[SymmetricKey]:
+        """ get message key for one more message, None when it should be rotated """
+        if now is None:
+            now = time.time()
+        direction = (sender, receiver)
+        with self.__lock:
+            entry = self.__keys.get(direction)
+            if entry is None:
+                return None
+            elif entry.expires < now or entry.count >= self.__max_messages:
+                self.__keys.pop(direction, None)
+                return None
+            self.__keys.move_to_end(direction)
+            entry.count += 1
+            return entry.key
+
+    def set_key(self, key: SymmetricKey, sender: ID, receiver: ID, now: float = None):
+        """ new message key for this direction, counted as used once """
+        if now is None:
+            now = time.time()
+        entry = _KeyEntry(key=key, expires=now + self.__ttl)
+        entry.count = 1
+        direction = (sender, receiver)
+        with self.__lock:
+            self.__keys[direction] = entry
+            self.__keys.move_to_end(direction)
+            while len(self.__keys) > self.__capacity:
+                self.__keys.popitem(last=False)
+            self._sweep(now=now)
+        self.debug(msg='message key rotated: %s => %s' % (sender, receiver))
+
+    def get_encrypted_key(self, data: bytes, receiver: ID, public_key: str, now: float = None) -> Optional[bytes]:
+        if now is None:
+            now = time.time()
+        tag = (receiver, data, public_key)
+        with self.__lock:
+            value = self.__encrypted.get(tag)
+            if value is None:
+                return None
+            elif value[0] < now:
+                self.__encrypted.pop(tag, None)
+                return None
+            self.__encrypted.move_to_end(tag)
+            return value[1]
+
+    def cache_encrypted_key(self, encrypted: bytes, data: bytes, receiver: ID, public_key: str, now: float = None):
+        if now is None:
+            now = time.time()
+        tag = (receiver, data, public_key)
+        with self.__lock:
+            self.__encrypted[tag] = (now + self.__ttl, encrypted)
+            self.__encrypted.move_to_end(tag)
+            while len(self.__encrypted) > self.__capacity:
+                self.__encrypted.popitem(last=False)
+            self._sweep(now=now)
+
+    def _sweep(self, now: float):
+        """ remove expired entries, not looked up again since expired """
+        if now < self.__next_sweep:
+            return
+        self.__next_sweep = now + self.SWEEP_INTERVAL
+        keys = self.__keys
+        expired = [direction for direction, entry in keys.items() if entry.expires < now]
+        for direction in expired:
+            keys.pop(direction, None)
+        encrypted = self.__encrypted
+        dropped = [tag for tag, value in encrypted.items() if value[0] < now]
+        for tag in dropped:
+            encrypted.pop(tag, None)
+        if len(expired) > 0 or len(dropped) > 0:
+            self.debug(msg='swept %d message key(s), %d encrypted key(s)' % (len(expired), len(dropped)))
@@ -0,0 +1,203 @@
+# -*- coding: utf-8 -*-
+# ==============================================================================
+# MIT License
+#
+# Copyright (c) 2023 Albert Moky
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+# ==============================================================================
+
+
+from typing import Optional, List, Dict
+
+from dimples import ID
+from dimples import SymmetricKey
+from dimples import Content
+from dimples import InstantMessage, SecureMessage, ReliableMessage
+from dimples import CipherKeyDelegate
+from dimples.client import ClientMessenger as SuperMessenger
+from dimples.client import ClientSession
+from dimples.common import CommonFacebook
+from dimples.common import MessageDBI
+
+from .crypto import CryptoPool
+from .keys import MessageKeyCache
+from .pipeline import InboundPipeline
+
+
+class _SharedBody:
+
+    def __init__(self, content: Content):
+        super().__init__()
+        self.content = content
+        self.data: Optional[bytes] = None  # serialized when the first message packed
+        self.count = 1
+
+
+class ClientMessenger(SuperMessenger):
+    """ Messenger with optional crypto pool & message key cache for the packer, and inbound pipeline """
+
+    def __init__(self, session: ClientSession, facebook: CommonFacebook, database: MessageDBI):
+        super().__init__(session=session, facebook=facebook, database=database)
+        self.__crypto_pool: Optional[CryptoPool] = None
+        self.__msg_keys: Optional[MessageKeyCache] = None
+        self.__inbound: Optional[InboundPipeline] = None
+        # id(content) => body serialized once for all messages carrying the same content object
+        self.__shared_bodies: Dict[int, _SharedBody] = {}
+
+    @property
+    def crypto_pool(self) -> Optional[CryptoPool]:
+        return self.__crypto_pool
+
+    @crypto_pool.setter
+    def crypto_pool(self, pool: CryptoPool):
+        self.__crypto_pool = pool
+
+    @property
+    def message_keys(self) -> Optional[MessageKeyCache]:
+        return self.__msg_keys
+
+    @message_keys.setter
+    def message_keys(self, cache: MessageKeyCache):
+        self.__msg_keys = cache
+
+    @property
+    def inbound_pipeline(self) -> Optional[InboundPipeline]:
+        return self.__inbound
+
+    @inbound_pipeline.setter
+    def inbound_pipeline(self, pipeline: InboundPipeline):
+        self.__inbound = pipeline
+
+    # Override
+    async def process_package(self, data: bytes) -> List[bytes]:
+        pipeline = self.__inbound
+        if pipeline is None:
+            return await super().process_package(data=data)
+        msg = await self.deserialize_message(data=data)
+        if msg is not None:
+            # responses will be sent by the pipeline
+            await pipeline.push(msg=msg)
+        return []
+
+    #
+    #   Shared Body
+    #
+
+    def share_content(self, content: Content):
+        """ serialize the content once for the messages packed before unshare_content(),
+            the content must not be modified until then """
+        entry = self.__shared_bodies.get(id(content))
+        if entry is not None and entry.content is content:
+            entry.count += 1
+        else:
+            self.__shared_bodies[id(content)] = _SharedBody(content=content)
+
+    def unshare_content(self, content: Content):
+        entry = self.__shared_bodies.get(id(content))
+        if entry is None or entry.content is not content:
+            return
+        entry.count -= 1
+        if entry.count <= 0:
+            self.__shared_bodies.pop(id(content), None)
+
+    # Override
+    async def serialize_content(self, content: Content, key: SymmetricKey, msg: InstantMessage) -> bytes:
+        entry = self.__shared_bodies.get(id(content))
+        if entry is None or entry.content is not content:
+            return await super().serialize_content(content=content, key=key, msg=msg)
+        data = entry.data
+        if data is None:
+            data = await super().serialize_content(content=content, key=key, msg=msg)
+            entry.data = data
+        return data
+
+    # Override
+    async def get_encrypt_key(self, msg: InstantMessage) -> Optional[SymmetricKey]:
+        cache = self.__msg_keys
+        if cache is None:
+            return await super().get_encrypt_key(msg=msg)
+        sender = msg.sender
+        target = CipherKeyDelegate.destination_for_message(msg=msg)
+        if target.is_broadcast:
+            return await super().get_encrypt_key(msg=msg)
+        key = cache.get_key(sender=sender, receiver=target)
+        if key is None:
+            # rotate: messages sent before still carry the old key
+            key = SymmetricKey.generate(algorithm=SymmetricKey.AES)
+            await self.key_cache.cache_cipher_key(key=key, sender=sender, receiver=target)
+            cache.set_key(key=key, sender=sender, receiver=target)
+        return key
+
+    # Override
+    async def sign_data(self, data: bytes, msg: SecureMessage) -> bytes:
+        pool = self.__crypto_pool
+        if pool is None:
+            return await super().sign_data(data=data, msg=msg)
+        key = await self.facebook.private_key_for_signature(identifier=msg.sender)
+        assert key is not None, 'failed to get sign key for user: %s' % msg.sender
+        return await pool.sign(key=key, data=data)
+
+    # Override
+    async def verify_data_signature(self, data: bytes, signature: bytes, msg: ReliableMessage) -> bool:
+        pool = self.__crypto_pool
+        if pool is None:
+            return await super().verify_data_signature(data=data, signature=signature, msg=msg)
+        keys = await self.facebook.public_keys_for_verification(identifier=msg.sender)
+        if len(keys) == 0:
+            self.warning(msg='failed to get verify keys: %s' % msg.sender)
+            return False
+        return await pool.verify(keys=keys, data=data, signature=signature)
+
+    # Override
+    async def encrypt_key(self, data: bytes, receiver: ID, msg: InstantMessage) -> Optional[bytes]:
+        pool = self.__crypto_pool
+        cache = self.__msg_keys
+        if pool is None and cache is None:
+            return await super().encrypt_key(data=data, receiver=receiver, msg=msg)
+        try:
+            key = await self.facebook.public_key_for_encryption(identifier=receiver)
+            if key is None:
+                self.error(msg='failed to get encrypt key for user: %s' % receiver)
+                return None
+            # 1. check encrypted key for this receiver
+            tag = key.get_str(key='data', default='')
+            if cache is not None:
+                encrypted = cache.get_encrypted_key(data=data, receiver=receiver, public_key=tag)
+                if encrypted is not None:
+                    return encrypted
+            # 2. encrypt it
+            if pool is None:
+                encrypted = key.encrypt(data=data, extra={})
+            else:
+                encrypted = await pool.encrypt(key=key, data=data)
+            if cache is not None and encrypted is not None:
+                cache.cache_encrypted_key(encrypted=encrypted, data=data, receiver=receiver, public_key=tag)
+            return encrypted
+        except Exception as error:
+            self.error(msg='failed to encrypt key: %s' % error)
+
+    # Override
+    async def decrypt_key(self, data: bytes, receiver: ID, msg: SecureMessage) -> Optional[bytes]:
+        pool = self.__crypto_pool
+        if pool is None:
+            return await super().decrypt_key(data=data, receiver=receiver, msg=msg)
+        keys = await self.facebook.private_keys_for_decryption(identifier=receiver)
+        assert len(keys) > 0, 'failed to get decrypt keys: %s' % receiver
+        return await pool.decrypt(keys=keys, data=data)
@@ -0,0 +1,401 @@
+# -*- coding: utf-8 -*-
+# ==============================================================================
+# MIT License
+#
+# Copyright (c) 2024 Albert Moky
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+# ==============================================================================
+
+"""
+    Outbox
+    ~~~~~~
+
+    Durable queue for instant messages not sent yet, ordered for each receiver;
+    messages failed too many times are put aside (parking storage), so they won't block the others
+"""
+
+import asyncio
+import os
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from typing import Optional, Tuple, List, Dict
+
+from dimples import ID
+from dimples import InstantMessage
+from dimples.database.redis.base import Cache
+
+from ..utils import utf8_encode, utf8_decode
+from ..utils import json_encode, json_decode
+from ..utils import Logging
+
+
+class OutboxStorage(ABC):
+    """ Persistent entries: key => message info """
+
+    @abstractmethod
+    async def load(self) -> List[Tuple[str, Dict]]:
+        """ all entries, oldest first """
+        raise NotImplemented
+
+    @abstractmethod
+    async def append(self, key: str, info: Dict) -> bool:
+        raise NotImplemented
+
+    @abstractmethod
+    async def remove(self, keys: List[str]) -> bool:
+        raise NotImplemented
+
+
+class FileOutboxStorage(OutboxStorage, Logging):
+    """
+        Append-only file, one JSON record per line:
+            {"add": "{KEY}", "msg": {...}}
+            {"del": ["{KEY}", ...]}
+        rewritten with the live entries when there are too many dead lines;
+        file operations run in executor, synced to disk after each write
+    """
+
+    def __init__(self, path: str):
+        super().__init__()
+        self.__path = path
+        self.__live: Dict[str, Dict] = OrderedDict()
+        self.__lines = 0
+        self.__lock = threading.Lock()
+
+    @property
+    def path(self) -> str:
+        return self.__path
+
+    # Override
+    async def load(self) -> List[Tuple[str, Dict]]:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, self._load)
+
+    # Override
+    async def append(self, key: str, info: Dict) -> bool:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, self._append, key, info)
+
+    # Override
+    async def remove(self, keys: List[str]) -> bool:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, self._remove, keys)
+
+    def _load(self) -> List[Tuple[str, Dict]]:
+        live = OrderedDict()
+        lines = 0
+        try:
+            with open(self.__path, 'rb') as file:
+                for line in file:
+                    lines += 1
+                    record = _parse_record(line=line)
+                    if record is None:
+                        # broken line (crashed while writing?)
+                        continue
+                    key = record.get('add')
+                    if key is not None:
+                        live[key] = record.get('msg')
+                    for key in record.get('del', []):
+                        live.pop(key, None)
+        except FileNotFoundError:
+            pass
+        except OSError as error:
+            self.error(msg='failed to load outbox: %s, %s' % (self.__path, error))
+        with self.__lock:
+            self.__live = live
+            self.__lines = lines
+            self._compact()
+        return list(live.items())
+
+    def _append(self, key: str, info: Dict) -> bool:
+        with self.__lock:
+            self.__live[key] = info
+            return self._write(record={'add': key, 'msg': info})
+
+    def _remove(self, keys: List[str]) -> bool:
+        with self.__lock:
+            for k in keys:
+                self.__live.pop(k, None)
+            ok = self._write(record={'del': keys})
+            if self.__lines > 1024 and self.__lines > len(self.__live) * 4:
+                self._compact()
+            return ok
+
+    def _write(self, record: Dict) -> bool:
+        line = utf8_encode(string=json_encode(obj=record)) + b'\n'
+        try:
+            _make_dirs(path=self.__path)
+            with open(self.__path, 'ab') as file:
+                file.write(line)
+                file.flush()
+                os.fsync(file.fileno())
+        except OSError as error:
+            self.error(msg='failed to write outbox: %s, %s' % (self.__path, error))
+            return False
+        self.__lines += 1
+        return True
+
+    def _compact(self):
+        """ rewrite with live entries only """
+        if self.__lines == len(self.__live):
+            return
+        tmp = '%s.tmp' % self.__path
+        try:
+            _make_dirs(path=self.__path)
+            with open(tmp, 'wb') as file:
+                for key, info in self.__live.items():
+                    line = json_encode(obj={'add': key, 'msg': info})
+                    file.write(utf8_encode(string=line) + b'\n')
+                file.flush()
+                os.fsync(file.fileno())
+            os.replace(tmp, self.__path)
+        except OSError as error:
+            self.error(msg='failed to compact outbox: %s, %s' % (self.__path, error))
+            return
+        self.info(msg='outbox compacted: %d -> %d line(s), %s' % (self.__lines, len(self.__live), self.__path))
+        self.__lines = len(self.__live)
+
+
+class RedisOutboxStorage(Cache, OutboxStorage):
+    """
+        redis key: 'dkd.{TABLE}.{OWNER}.messages'  -- hash: key => message
+        redis key: 'dkd.{TABLE}.{OWNER}.keys'      -- ordered set: key => time
+
+        owner is the address of the bot, table is 'outbox' or 'parked'
+    """
+
+    def __init__(self, connector, owner: str, table: str = 'outbox'):
+        super().__init__(connector=connector)
+        self.__owner = owner
+        self.__table = table
+
+    @property  # Override
+    def db_name(self) -> Optional[str]:
+        return 'dkd'
+
+    @property  # Override
+    def tbl_name(self) -> str:
+        return self.__table
+
+    def __messages_name(self) -> str:
+        return '%s.%s.%s.messages' % (self.db_name, self.tbl_name, self.__owner)
+
+    def __keys_name(self) -> str:
+        return '%s.%s.%s.keys' % (self.db_name, self.tbl_name, self.__owner)
+
+    # Override
+    async def load(self) -> List[Tuple[str, Dict]]:
+        keys = await self.zrange(name=self.__keys_name())
+        array = []
+        for key in keys:
+            key = utf8_decode(data=key)
+            value = await self.hget(name=self.__messages_name(), key=key)
+            if value is None:
+                continue
+            info = _parse_json(data=value)
+            if info is not None:
+                array.append((key, info))
+        return array
+
+    # Override
+    async def append(self, key: str, info: Dict) -> bool:
+        value = utf8_encode(string=json_encode(obj=info))
+        await self.hset(name=self.__messages_name(), key=key, value=value)
+        await self.zadd(name=self.__keys_name(), mapping={key: int(time.time() * 1000)})
+        return True
+
+    # Override
+    async def remove(self, keys: List[str]) -> bool:
+        if len(keys) == 0:
+            return True
+        for key in keys:
+            await self.hdel(name=self.__messages_name(), key=key)
+        await self.zrem(self.__keys_name(), *keys)
+        return True
+
+
+class Outbox(Logging):
+    """ Messages waiting for resending, bounded in memory """
+
+    CAPACITY = 4096          # messages
+    EXPIRES = 3600 * 24 * 3  # seconds
+    MAX_ATTEMPTS = 16        # resending
+
+    def __init__(self, storage: OutboxStorage, capacity: int = None,
+                 parking: Optional[OutboxStorage] = None, attempts: int = None):
+        super().__init__()
+        self.__storage = storage
+        self.__parking = parking
+        self.__capacity = self.CAPACITY if capacity is None or capacity <= 0 else capacity
+        self.__max_attempts = self.MAX_ATTEMPTS if attempts is None or attempts <= 0 else attempts
+        # receiver => (key => message), oldest first
+        self.__queues: Dict[ID, Dict[str, InstantMessage]] = OrderedDict()
+        self.__attempts: Dict[str, int] = {}  # key => failed times
+        self.__count = 0
+        self.__loaded = False
+
+    @property
+    def storage(self) -> OutboxStorage:
+        return self.__storage
+
+    @property
+    def parking(self) -> Optional[OutboxStorage]:
+        """ messages failed too many times """
+        return self.__parking
+
+    @property
+    def count(self) -> int:
+        return self.__count
+
+    async def load(self):
+        """ load messages from storage (once) """
+        if self.__loaded:
+            return
+        self.__loaded = True
+        expired = []
+        for key, info in await self.__storage.load():
+            msg = InstantMessage.parse(msg=info)
+            if msg is None or _is_expired(msg=msg, now=time.time(), expires=self.EXPIRES):
+                expired.append(key)
+            else:
+                self._push(key=key, msg=msg)
+        if len(expired) > 0:
+            await self.__storage.remove(keys=expired)
+        self.info(msg='outbox loaded: %d message(s), %d expired' % (self.__count, len(expired)))
+        # trim after loading, in case the capacity was reduced
+        await self._trim()
+
+    def _push(self, key: str, msg: InstantMessage):
+        receiver = msg.receiver
+        queue = self.__queues.get(receiver)
+        if queue is None:
+            queue = OrderedDict()
+            self.__queues[receiver] = queue
+        if key not in queue:
+            self.__count += 1
+        queue[key] = msg
+
+    async def append(self, msg: InstantMessage) -> bool:
+        await self.load()
+        key = get_msg_key(msg=msg)
+        self._push(key=key, msg=msg)
+        ok = await self.__storage.append(key=key, info=msg.dictionary)
+        await self._trim()
+        return ok
+
+    async def _trim(self):
+        """ drop the oldest messages when over capacity """
+        overflow = self.__count - self.__capacity
+        if overflow <= 0:
+            return
+        dropped = []
+        while len(dropped) < overflow:
+            oldest = None
+            for queue in self.__queues.values():
+                key, msg = next(iter(queue.items()))
+                if oldest is None or _msg_time(msg) < _msg_time(oldest[1]):
+                    oldest = (key, msg)
+            dropped.append(oldest[0])
+            self._pop(key=oldest[0], receiver=oldest[1].receiver)
+        self.warning(msg='outbox full, dropped %d oldest message(s)' % len(dropped))
+        await self.__storage.remove(keys=dropped)
+
+    def _pop(self, key: str, receiver: ID):
+        self.__attempts.pop(key, None)
+        queue = self.__queues.get(receiver)
+        if queue is not None and queue.pop(key, None) is not None:
+            self.__count -= 1
+            if len(queue) == 0:
+                self.__queues.pop(receiver, None)
+
+    async def get_batch(self, limit: int) -> List[Tuple[str, InstantMessage]]:
+        """ messages for resending, each receiver in order """
+        await self.load()
+        now = time.time()
+        batch = []
+        expired = []
+        for queue in self.__queues.values():
+            for key, msg in queue.items():
+                if _is_expired(msg=msg, now=now, expires=self.EXPIRES):
+                    expired.append((key, msg.receiver))
+                elif len(batch) < limit:
+                    batch.append((key, msg))
+        if len(expired) > 0:
+            self.warning(msg='drop %d expired message(s) from outbox' % len(expired))
+            await self.remove(keys=expired)
+        return batch
+
+    async def remove(self, keys: List[Tuple[str, ID]]):
+        """ remove messages (key, receiver) sent """
+        if len(keys) == 0:
+            return
+        for key, receiver in keys:
+            self._pop(key=key, receiver=receiver)
+        await self.__storage.remove(keys=[key for key, _ in keys])
+
+    async def failed(self, key: str, msg: InstantMessage) -> bool:
+        """ count failure of resending, put it aside when failed too many times """
+        count = self.__attempts.get(key, 0) + 1
+        if count < self.__max_attempts:
+            self.__attempts[key] = count
+            return False
+        self.warning(msg='put aside message failed %d times: %s -> %s' % (count, msg.sender, msg.receiver))
+        parking = self.__parking
+        if parking is not None:
+            await parking.append(key=key, info=msg.dictionary)
+        await self.remove(keys=[(key, msg.receiver)])
+        return True
+
+
+def get_msg_key(msg: InstantMessage) -> str:
+    """ '{RECEIVER}/{SN}' """
+    return '%s/%d' % (msg.receiver, msg.content.sn)
+
+
+def _msg_time(msg: InstantMessage) -> float:
+    when = msg.time
+    return 0 if when is None else when.timestamp
+
+
+def _is_expired(msg: InstantMessage, now: float, expires: int) -> bool:
+    return _msg_time(msg) < now - expires
+
+
+def _parse_json(data: bytes) -> Optional[Dict]:
+    try:
+        info = json_decode(string=utf8_decode(data=data))
+    except ValueError:
+        return None
+    return info if isinstance(info, Dict) else None
+
+
+def _parse_record(line: bytes) -> Optional[Dict]:
+    line = line.strip()
+    if len(line) == 0:
+        return None
+    return _parse_json(data=line)
+
+
+def _make_dirs(path: str):
+    directory = os.path.dirname(path)
+    if len(directory) > 0:
+        os.makedirs(directory, exist_ok=True)
@@ -26,16 +26,48 @@
 from typing import Optional
 
 from dimples import SymmetricKey
-from dimples import InstantMessage, SecureMessage
+from dimples import InstantMessage, SecureMessage, ReliableMessage
 from dimples import FileContent
+from dimples import Facebook, Messenger
 
 from dimples.client import ClientMessagePacker
 
+from .dedup import DuplicateFilter
 from .emitter import Emitter
 
 
 class ClientPacker(ClientMessagePacker):
 
+    def __init__(self, facebook: Facebook, messenger: Messenger):
+        super().__init__(facebook=facebook, messenger=messenger)
+        self.__duplicate_filter: Optional[DuplicateFilter] = None
+
+    @property
+    def duplicate_filter(self) -> Optional[DuplicateFilter]:
+        return self.__duplicate_filter
+
+    @duplicate_filter.setter
+    def duplicate_filter(self, checker: DuplicateFilter):
+        self.__duplicate_filter = checker
+
+    # Override
+    async def verify_message(self, msg: ReliableMessage) -> Optional[SecureMessage]:
+        checker = self.__duplicate_filter
+        if checker is None:
+            return await super().verify_message(msg=msg)
+        # drop replays before verifying & decrypting,
+        # copies arrived together wait for the one in flight
+        tag = await checker.acquire(msg=msg)
+        if tag is None:
+            self.warning(msg='drop duplicated message: %s -> %s, %s' % (msg.sender, msg.receiver, msg.time))
+            return None
+        s_msg = None
+        try:
+            s_msg = await super().verify_message(msg=msg)
+        finally:
+            checker.release(tag=tag, verified=s_msg is not None)
+        return s_msg
+
     # Override
     async def encrypt_message(self, msg: InstantMessage) -> Optional[SecureMessage]:
         # make sure visa.key exists before encrypting message
@@ -52,13 +84,9 @@ class ClientPacker(ClientMessagePacker):
         except Exception as error:
             self.error(msg='failed to encrypt message: %s' % error)
             return None
-        # receiver = msg.receiver
-        # if receiver.is_group:
-        #     # reuse group message keys
-        #     messenger = self.messenger
-        #     key = messenger.cipher_key(sender=msg.sender, receiver=receiver)
-        #     key['reused'] = True
-        # # TODO: reuse personal message key?
+        # NOTICE: group & personal message keys are reused and rotated by
+        #         'messenger.message_keys', with the encrypted keys cached,
+        #         so the key is still attached for receivers without key cache.
         return s_msg
 
     # Override
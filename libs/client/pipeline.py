@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+# ==============================================================================
+# MIT License
+#
+# Copyright (c) 2024 Albert Moky
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+# ==============================================================================
+
+
+"""
+    Inbound Pipeline
+    ~~~~~~~~~~~~~~~~
+
+    Verify, decrypt & process incoming messages in stages, with bounded queues between them:
+    bursts are verified/decrypted in batches (concurrently), contents are processed in order
+"""
+
+import asyncio
+import weakref
+from typing import Optional, List
+
+from dimples import InstantMessage, SecureMessage, ReliableMessage
+from dimples import ReceiptCommand
+from dimples.client import ClientMessenger
+
+from ..utils import Logging
+
+
+class InboundPipeline(Logging):
+
+    QUEUE_SIZE = 256  # messages waiting for each stage
+    BATCH_SIZE = 32   # messages verified/decrypted together
+
+    def __init__(self, messenger: ClientMessenger, queue_size: int = None, batch_size: int = None):
+        super().__init__()
+        self.__messenger = weakref.ref(messenger)
+        self.__queue_size = self.QUEUE_SIZE if queue_size is None or queue_size <= 0 else queue_size
+        self.__batch_size = self.BATCH_SIZE if batch_size is None or batch_size <= 0 else batch_size
+        self.__verifying: Optional[asyncio.Queue] = None   # ReliableMessage
+        self.__decrypting: Optional[asyncio.Queue] = None  # (SecureMessage, ReliableMessage)
+        self.__processing: Optional[asyncio.Queue] = None  # (InstantMessage, ReliableMessage)
+        self.__tasks: List[asyncio.Task] = []
+
+    @property
+    def messenger(self) -> ClientMessenger:
+        return self.__messenger()
+
+    @property
+    def pending(self) -> int:
+        """ messages in queues """
+        queues = [self.__verifying, self.__decrypting, self.__processing]
+        return sum(queue.qsize() for queue in queues if queue is not None)
+
+    def _start(self):
+        if len(self.__tasks) > 0:
+            return
+        size = self.__queue_size
+        self.__verifying = asyncio.Queue(maxsize=size)
+        self.__decrypting = asyncio.Queue(maxsize=size)
+        self.__processing = asyncio.Queue(maxsize=size)
+        self.__tasks = [
+            asyncio.create_task(self._verify_loop()),
+            asyncio.create_task(self._decrypt_loop()),
+            asyncio.create_task(self._process_loop()),
+        ]
+        self.info(msg='inbound pipeline started, queue size: %d, batch size: %d' % (size, self.__batch_size))
+
+    def stop(self):
+        tasks = self.__tasks
+        self.__tasks = []
+        for task in tasks:
+            task.cancel()
+
+    async def push(self, msg: ReliableMessage):
+        """ append message to the first stage, wait when it's full """
+        self._start()
+        await self.__verifying.put(msg)
+
+    #
+    #   Stages
+    #
+
+    async def _verify_loop(self):
+        while True:
+            batch = await _get_batch(queue=self.__verifying, size=self.__batch_size)
+            results = await asyncio.gather(*[self._verify(msg=msg) for msg in batch])
+            for r_msg, s_msg in zip(batch, results):
+                if s_msg is not None:
+                    await self.__decrypting.put((s_msg, r_msg))
+
+    async def _decrypt_loop(self):
+        while True:
+            batch = await _get_batch(queue=self.__decrypting, size=self.__batch_size)
+            results = await asyncio.gather(*[self._decrypt(msg=s_msg) for s_msg, _ in batch])
+            for (_, r_msg), i_msg in zip(batch, results):
+                if i_msg is not None:
+                    await self.__processing.put((i_msg, r_msg))
+
+    async def _process_loop(self):
+        while True:
+            i_msg, r_msg = await self.__processing.get()
+            try:
+                await self._process(msg=i_msg, r_msg=r_msg)
+            except Exception as error:
+                self.error(msg='failed to process message: %s -> %s, %s' % (r_msg.sender, r_msg.receiver, error))
+
+    async def _verify(self, msg: ReliableMessage) -> Optional[SecureMessage]:
+        try:
+            return await self.messenger.verify_message(msg=msg)
+        except Exception as error:
+            self.error(msg='failed to verify message: %s -> %s, %s' % (msg.sender, msg.receiver, error))
+
+    async def _decrypt(self, msg: SecureMessage) -> Optional[InstantMessage]:
+        try:
+            return await self.messenger.decrypt_message(msg=msg)
+        except Exception as error:
+            self.error(msg='failed to decrypt message: %s -> %s, %s' % (msg.sender, msg.receiver, error))
+
+    async def _process(self, msg: InstantMessage, r_msg: ReliableMessage):
+        messenger = self.messenger
+        responses = await messenger.process_instant_message(msg=msg, r_msg=r_msg)
+        if len(responses) > 0:
+            for res in responses:
+                await messenger.send_instant_message(msg=res)
+        elif messenger._needs_receipt(msg=r_msg):
+            # same as 'ClientMessenger.process_reliable_message()'
+            res = ReceiptCommand.create(text='Message received.', envelope=r_msg.envelope)
+            await messenger.send_content(sender=None, receiver=r_msg.sender, content=res)
+
+
+async def _get_batch(queue: asyncio.Queue, size: int) -> List:
+    """ wait for the first one, then take all ready (no more than size) """
+    batch = [await queue.get()]
+    while len(batch) < size and not queue.empty():
+        batch.append(queue.get_nowait())
+    return batch
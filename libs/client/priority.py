@@ -0,0 +1,212 @@
+# -*- coding: utf-8 -*-
+# ==============================================================================
+# MIT License
+#
+# Copyright (c) 2024 Albert Moky
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+# ==============================================================================
+
+"""
+    Priority Lanes
+    ~~~~~~~~~~~~~~
+
+    Choose lane for outgoing message by content type, 'muted', 'hidden' & size;
+    each lane has its own departure priority (order on the wire, by the session),
+    and a budget for messages packing (encrypt & sign) and queueing at the same time
+"""
+
+import asyncio
+from typing import Optional, Iterable, List, Dict
+
+from startrek import DeparturePriority
+
+from dimples import ContentType
+from dimples import InstantMessage
+
+from ..utils import utf8_encode
+
+
+class Lane:
+    """
+        Messages waiting for the budget are queued in order (semaphore);
+        re-entrant for the task holding it (e.g. sending another message while packing),
+        so a small budget won't deadlock
+    """
+
+    def __init__(self, name: str, priority: int, budget: int = 0):
+        super().__init__()
+        self.__name = name
+        self.__priority = priority
+        self.__budget = budget  # 0 means unlimited
+        self.__semaphore: Optional[asyncio.Semaphore] = None
+        self.__holders: Dict[asyncio.Task, int] = {}  # task => times entered
+        self.__sending = 0
+
+    # Override
+    def __str__(self) -> str:
+        clazz = self.__class__.__name__
+        return '<%s name="%s" priority=%d budget=%d />' % (clazz, self.name, self.priority, self.budget)
+
+    # Override
+    def __repr__(self) -> str:
+        return self.__str__()
+
+    @property
+    def name(self) -> str:
+        return self.__name
+
+    @property
+    def priority(self) -> int:
+        """ departure priority for the session, smaller is faster """
+        return self.__priority
+
+    @property
+    def budget(self) -> int:
+        """ max messages sending at the same time """
+        return self.__budget
+
+    @property
+    def sending(self) -> int:
+        return self.__sending
+
+    async def __aenter__(self):
+        task = asyncio.current_task()
+        count = self.__holders.get(task, 0)
+        if count > 0:
+            # entered again by the same task, budget taken already
+            self.__holders[task] = count + 1
+            return self
+        if self.__budget > 0:
+            if self.__semaphore is None:
+                self.__semaphore = asyncio.Semaphore(self.__budget)
+            await self.__semaphore.acquire()
+        self.__holders[task] = 1
+        self.__sending += 1
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        task = asyncio.current_task()
+        count = self.__holders.get(task, 0) - 1
+        if count > 0:
+            self.__holders[task] = count
+            return
+        self.__holders.pop(task, None)
+        self.__sending -= 1
+        if self.__semaphore is not None:
+            self.__semaphore.release()
+
+
+class PriorityPolicy:
+    """
+        1. lane for content type, if configured;
+        2. messages with flags (default: 'hidden') go to bulk lane;
+        3. large text goes to bulk lane;
+        4. others go to normal lane.
+    """
+
+    URGENT = 'urgent'
+    NORMAL = 'normal'
+    BULK = 'bulk'
+
+    BULK_SIZE = 1024 * 4  # bytes
+
+    def __init__(self, bulk_size: int = None, normal_budget: int = 16, bulk_budget: int = 2,
+                 types: Dict[int, str] = None, flags: Iterable[str] = None):
+        super().__init__()
+        self.__bulk_size = self.BULK_SIZE if bulk_size is None or bulk_size <= 0 else bulk_size
+        self.__lanes = {
+            self.URGENT: Lane(name=self.URGENT, priority=DeparturePriority.URGENT),
+            self.NORMAL: Lane(name=self.NORMAL, priority=DeparturePriority.NORMAL, budget=normal_budget),
+            self.BULK: Lane(name=self.BULK, priority=DeparturePriority.SLOWER, budget=bulk_budget),
+        }
+        # content type => lane name
+        self.__types = {
+            ContentType.COMMAND: self.URGENT,
+            ContentType.HISTORY: self.URGENT,
+        }
+        if types is not None:
+            self.__types.update(types)
+        # fields in content/message for bulk lane,
+        # NOTICE: most responses from services are 'muted', so it's not a bulk flag by default
+        self.__flags = ['hidden'] if flags is None else list(flags)
+
+    @property
+    def bulk_size(self) -> int:
+        return self.__bulk_size
+
+    @property
+    def lanes(self) -> Iterable[Lane]:
+        return self.__lanes.values()
+
+    def get_lane(self, msg: InstantMessage) -> Lane:
+        content = msg.content
+        # 1. check content type
+        name = self.__types.get(content.type)
+        if name is None:
+            # 2. check flags
+            if self._has_flag(msg=msg):
+                name = self.BULK
+            # 3. check size
+            elif estimate_size(content=content) > self.__bulk_size:
+                name = self.BULK
+            else:
+                name = self.NORMAL
+        return self.__lanes.get(name, self.__lanes[self.NORMAL])
+
+    def _has_flag(self, msg: InstantMessage) -> bool:
+        content = msg.content
+        for key in self.__flags:
+            if _is_set(content.get(key)) or _is_set(msg.get(key)):
+                return True
+        return False
+
+
+def estimate_size(content) -> int:
+    """ bytes of text, file data will be uploaded separately """
+    text = content.get('text')
+    if isinstance(text, str):
+        return len(utf8_encode(string=text))
+    return 0
+
+
+def _is_set(value) -> bool:
+    if value is None or value is False:
+        return False
+    elif isinstance(value, str):
+        return value.lower() not in ['', 'no', 'false', '0']
+    return True
+
+
+def parse_flags(text: Optional[str]) -> Optional[List[str]]:
+    """ 'hidden, muted' => ['hidden', 'muted'] """
+    if text is None:
+        return None
+    return [item.strip() for item in text.split(',') if len(item.strip()) > 0]
+
+
+def parse_types(text: Optional[str], lane: str) -> Dict[int, str]:
+    """ '0x88, 0x89' => {136: lane, 137: lane} """
+    types = {}
+    if text is not None:
+        for item in text.split(','):
+            item = item.strip()
+            if len(item) > 0:
+                types[int(item, 0)] = lane
+    return types
@@ -23,8 +23,9 @@
 # SOFTWARE.
 # ==============================================================================
 
+import re
 from abc import ABC, abstractmethod
-from typing import Optional, List
+from typing import Optional, Tuple, List, Dict
 
 from dimples import ReliableMessage
 from dimples import Envelope
@@ -49,11 +50,91 @@ class Service(ABC):
         raise NotImplemented
 
 
+class ServiceRouter:
+    """
+        Route content to service by:
+            1. 'app' & 'mod' (or 'app' only);
+            2. keyword prefix in text, e.g. "news: today", "/tv list";
+            3. content type;
+            4. default service.
+        all by dictionary lookup, content without service will not be dispatched.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.__apps: Dict[Tuple[str, Optional[str]], Service] = {}
+        self.__keywords: Dict[str, Service] = {}
+        self.__types: Dict[int, Service] = {}
+        self.__default: Optional[Service] = None
+
+    @property
+    def default_service(self) -> Optional[Service]:
+        return self.__default
+
+    @default_service.setter
+    def default_service(self, service: Service):
+        self.__default = service
+
+    @property
+    def services(self) -> List[Service]:
+        """ all services, no duplicated """
+        array = []
+        candidates = list(self.__apps.values()) + list(self.__keywords.values()) + list(self.__types.values())
+        if self.__default is not None:
+            candidates.append(self.__default)
+        for item in candidates:
+            if item not in array:
+                array.append(item)
+        return array
+
+    def add_app(self, app: str, service: Service, mod: str = None):
+        self.__apps[(app, mod)] = service
+
+    def add_keyword(self, keyword: str, service: Service):
+        self.__keywords[keyword.lower()] = service
+
+    def add_type(self, msg_type: int, service: Service):
+        self.__types[msg_type] = service
+
+    def get_service(self, content: Content) -> Optional[Service]:
+        # 1. check 'app' & 'mod'
+        app = content.get('app')
+        if app is not None and len(self.__apps) > 0:
+            service = self.__apps.get((app, content.get('mod')))
+            if service is None:
+                service = self.__apps.get((app, None))
+            if service is not None:
+                return service
+        # 2. check keyword
+        if len(self.__keywords) > 0:
+            keyword = get_keyword(text=content.get('text'))
+            if keyword is not None:
+                service = self.__keywords.get(keyword)
+                if service is not None:
+                    return service
+        # 3. check content type
+        service = self.__types.get(content.type)
+        if service is None:
+            service = self.__default
+        return service
+
+
+_keyword_pattern = re.compile(r'^\s*([^\s:]{1,32})(:|\s|$)')
+
+
+def get_keyword(text: Optional[str]) -> Optional[str]:
+    """ 'News: today' => 'news' """
+    if isinstance(text, str):
+        match = _keyword_pattern.match(text)
+        if match is not None:
+            return match.group(1).lower()
+
+
 class ClientProcessor(ClientMessageProcessor, ABC):
 
     def __init__(self, facebook: CommonFacebook, messenger: CommonMessenger):
         super().__init__(facebook=facebook, messenger=messenger)
-        self.__service = self._create_service()
+        self.__router = self._create_router()
 
     @property
     def facebook(self) -> CommonFacebook:
@@ -61,15 +142,28 @@ class ClientProcessor(ClientMessageProcessor, ABC):
         assert isinstance(barrack, CommonFacebook), 'facebook error: %s' % barrack
         return barrack
 
+    @property
+    def router(self) -> ServiceRouter:
+        return self.__router
+
+    def _create_router(self) -> ServiceRouter:
+        """ Create Service Router, override it to add more services """
+        router = ServiceRouter()
+        router.default_service = self._create_service()
+        return router
+
     @abstractmethod
-    def _create_service(self) -> Service:
-        """ Create Service Handler """
+    def _create_service(self) -> Optional[Service]:
+        """ Create default Service Handler """
         raise NotImplemented
 
     # Override
     async def process_content(self, content: Content, r_msg: ReliableMessage) -> List[Content]:
-        service = self.__service
-        responses = await service.handle_request(content=content, envelope=r_msg.envelope)
+        service = self.__router.get_service(content=content)
+        if service is None:
+            responses = None
+        else:
+            responses = await service.handle_request(content=content, envelope=r_msg.envelope)
         if responses is None:
             responses = await super().process_content(content=content, r_msg=r_msg)
         return responses
@@ -0,0 +1,210 @@
+# -*- coding: utf-8 -*-
+# ==============================================================================
+# MIT License
+#
+# Copyright (c) 2024 Albert Moky
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+# ==============================================================================
+
+"""
+    Upload Index
+    ~~~~~~~~~~~~
+
+    Persistent map for uploaded files: upload key => (expires, IV, download URL)
+
+    The upload key is built from the file data (plaintext) and the message key,
+    so the encrypted data uploaded before can only be reused with the same key & IV.
+"""
+
+import asyncio
+import dbm
+import os
+import threading
+import time
+from typing import Optional, Tuple
+
+from dimples import EncryptKey
+
+from ..utils import md5, sha256, hex_encode
+from ..utils import utf8_encode, utf8_decode
+from ..utils import Logging
+
+
+class UploadIndex(Logging):
+    """
+        On-disk hash table (dbm), opened lazily,
+        nothing is loaded into memory at startup
+    """
+
+    EXPIRES = 3600 * 24 * 7        # seconds
+    PURGE_INTERVAL = 3600 * 24     # seconds
+
+    def __init__(self, path: str, expires: int = None):
+        super().__init__()
+        self.__path = path
+        self.__expires = self.EXPIRES if expires is None or expires <= 0 else expires
+        self.__db = None
+        self.__lock = threading.Lock()
+        self.__last_purge = time.time()
+
+    @property
+    def path(self) -> str:
+        return self.__path
+
+    @property
+    def expires(self) -> int:
+        return self.__expires
+
+    def _open(self):
+        db = self.__db
+        if db is None:
+            directory = os.path.dirname(self.__path)
+            if len(directory) > 0:
+                os.makedirs(directory, exist_ok=True)
+            self.__db = db = dbm.open(self.__path, 'c')
+            self.info(msg='upload index opened: %s' % self.__path)
+        return db
+
+    async def get_upload(self, upload_key: str, now: float = None) -> Optional[Tuple[str, Optional[str]]]:
+        """ get download URL & IV of the file uploaded before """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, self._get, upload_key, now)
+
+    async def save_upload(self, upload_key: str, url: str, iv: Optional[str], now: float = None) -> bool:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, self._save, upload_key, url, iv, now)
+
+    async def purge(self, now: float = None) -> int:
+        """ remove expired (and broken) entries """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, self._purge, now)
+
+    #
+    #   dbm I/O (in executor)
+    #
+
+    def _get(self, upload_key: str, now: float = None) -> Optional[Tuple[str, Optional[str]]]:
+        if now is None:
+            now = time.time()
+        key = utf8_encode(string=upload_key)
+        with self.__lock:
+            try:
+                db = self._open()
+                value = db.get(key)
+                if value is None:
+                    return None
+                expires, iv, url = _decode(value=value)
+                if expires > now and url is not None:
+                    return url, iv
+                # expired
+                del db[key]
+            except Exception as error:
+                self.error(msg='failed to get URL: %s, %s' % (upload_key, error))
+
+    def _save(self, upload_key: str, url: str, iv: Optional[str], now: float = None) -> bool:
+        if now is None:
+            now = time.time()
+        key = utf8_encode(string=upload_key)
+        value = _encode(expires=now + self.__expires, iv=iv, url=url)
+        with self.__lock:
+            try:
+                db = self._open()
+                db[key] = value
+                _sync(db=db)
+            except Exception as error:
+                self.error(msg='failed to save URL: %s => %s, %s' % (upload_key, url, error))
+                return False
+        if now - self.__last_purge > self.PURGE_INTERVAL:
+            self._purge(now=now)
+        return True
+
+    def _purge(self, now: float = None) -> int:
+        if now is None:
+            now = time.time()
+        self.__last_purge = now
+        count = 0
+        with self.__lock:
+            try:
+                db = self._open()
+                keys = db.keys()
+            except Exception as error:
+                self.error(msg='failed to purge upload index: %s' % error)
+                return 0
+            for key in keys:
+                try:
+                    if _decode(value=db[key])[0] > now:
+                        continue
+                except Exception as error:
+                    # broken entry, drop it too
+                    self.warning(msg='drop broken entry in upload index: %s, %s' % (key, error))
+                try:
+                    del db[key]
+                    count += 1
+                except Exception as error:
+                    self.error(msg='failed to remove entry in upload index: %s, %s' % (key, error))
+            if count > 0:
+                try:
+                    _sync(db=db)
+                except Exception as error:
+                    self.error(msg='failed to sync upload index: %s' % error)
+        if count > 0:
+            self.info(msg='purged %d expired URL(s) from %s' % (count, self.__path))
+        return count
+
+    def close(self):
+        with self.__lock:
+            db = self.__db
+            if db is not None:
+                self.__db = None
+                db.close()
+
+
+def get_upload_key(data: bytes, password: EncryptKey) -> Optional[str]:
+    """
+    '{MD5 of file data}:{SHA-256 of message key}',
+    hashing may take a while for large file, call it in a worker thread
+    """
+    secret = password.get('data')
+    if not isinstance(secret, str):
+        # unknown key
+        return None
+    key_hash = sha256(data=utf8_encode(string='%s:%s' % (password.algorithm, secret)))
+    return '%s:%s' % (hex_encode(data=md5(data=data)), hex_encode(data=key_hash))
+
+
+def _encode(expires: float, iv: Optional[str], url: str) -> bytes:
+    """ '{EXPIRES} {IV} {URL}', IV is '-' if not set """
+    return utf8_encode(string='%d %s %s' % (expires, '-' if iv is None else iv, url))
+
+
+def _decode(value: bytes) -> Tuple[int, Optional[str], Optional[str]]:
+    parts = utf8_decode(data=value).split(' ', 2)
+    if len(parts) != 3:
+        # old format ('{EXPIRES} {URL}', keyed by encrypted filename), never matched
+        return int(parts[0]), None, None
+    expires, iv, url = parts
+    return int(expires), None if iv == '-' else iv, url
+
+
+def _sync(db):
+    # not all dbm implementations support it
+    fn = getattr(db, 'sync', None)
+    if fn is not None:
+        fn()
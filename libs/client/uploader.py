@@ -0,0 +1,250 @@
+# -*- coding: utf-8 -*-
+# ==============================================================================
+# MIT License
+#
+# Copyright (c) 2024 Albert Moky
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+# ==============================================================================
+
+"""
+    Uploader
+    ~~~~~~~~
+
+    Upload encrypted file data in background, with bounded concurrency & retries
+"""
+
+import asyncio
+from abc import ABC, abstractmethod
+from typing import Optional, Set
+
+import aiohttp
+
+from dimples import ID
+
+from ..utils import json_decode
+from ..utils import template_replace
+from ..utils import Logging
+
+from .cipher import iter_chunks
+
+
+class UploadError(IOError):
+    """ Upload rejected by the server, only retried on server errors (HTTP 5xx) """
+
+    def __init__(self, msg: str, status: int):
+        super().__init__(msg)
+        self.__status = status
+
+    @property
+    def status(self) -> int:
+        return self.__status
+
+    @property
+    def retryable(self) -> bool:
+        return self.__status >= 500
+
+
+class UploadBackend(ABC):
+    """ Storage for encrypted file data """
+
+    @abstractmethod
+    async def upload(self, data: bytes, filename: str, sender: ID) -> Optional[str]:
+        """
+        Upload file data
+
+        :param data:     encrypted data
+        :param filename: encoded filename
+        :param sender:   message sender
+        :return: download URL, None on failed
+        """
+        raise NotImplemented
+
+    async def close(self):
+        """ release resources """
+        pass
+
+
+class UploadDelegate(ABC):
+    """ Callbacks for upload tasks """
+
+    @abstractmethod
+    async def upload_success(self, filename: str, url: str):
+        """ callback when file data uploaded to CDN and download URL responded """
+        raise NotImplemented
+
+    @abstractmethod
+    async def upload_failed(self, filename: str):
+        """ callback when failed to upload file data """
+        raise NotImplemented
+
+
+class HttpUploadBackend(UploadBackend, Logging):
+    """
+        Post file data to HTTP server as form field 'file',
+        and get download URL from response: '{"url": "..."}' or plain text
+
+        API template: 'http://127.0.0.1:8081/{ID}/upload?filename={FILENAME}'
+    """
+
+    POOL_SIZE = 16         # connections
+    KEEP_ALIVE = 60        # seconds
+    TIMEOUT = 120          # seconds
+
+    def __init__(self, api: str, pool_size: int = None, timeout: float = None):
+        super().__init__()
+        self.__api = api
+        self.__pool_size = self.POOL_SIZE if pool_size is None or pool_size <= 0 else pool_size
+        self.__timeout = self.TIMEOUT if timeout is None or timeout <= 0 else timeout
+        self.__session: Optional[aiohttp.ClientSession] = None
+
+    @property
+    def api(self) -> str:
+        return self.__api
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        """ persistent session (connection pool), created on the running loop """
+        session = self.__session
+        if session is None or session.closed:
+            connector = aiohttp.TCPConnector(limit=self.__pool_size, keepalive_timeout=self.KEEP_ALIVE)
+            timeout = aiohttp.ClientTimeout(total=self.__timeout)
+            self.__session = session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+        return session
+
+    # Override
+    async def upload(self, data: bytes, filename: str, sender: ID) -> Optional[str]:
+        url = template_replace(template=self.api, key='ID', value=str(sender))
+        url = template_replace(template=url, key='FILENAME', value=filename)
+        # stream the data in chunks, instead of buffering all of it in the transport
+        form = aiohttp.FormData()
+        form.add_field('file', _stream(data=data), filename=filename, content_type='application/octet-stream')
+        session = self._get_session()
+        async with session.post(url, data=form) as response:
+            if response.status != 200:
+                raise UploadError('upload error: HTTP %d, %s' % (response.status, url), status=response.status)
+            text = await response.text()
+        return parse_download_url(text=text)
+
+    # Override
+    async def close(self):
+        session = self.__session
+        if session is not None:
+            self.__session = None
+            await session.close()
+
+
+async def _stream(data: bytes):
+    for chunk in iter_chunks(data=data):
+        yield chunk
+
+
+def parse_download_url(text: Optional[str]) -> Optional[str]:
+    if text is None:
+        return None
+    text = text.strip()
+    if text.startswith('{'):
+        info = json_decode(string=text)
+        if isinstance(info, dict):
+            url = info.get('url')
+            if url is None:
+                url = info.get('URL')
+            return url
+    elif text.find('://') > 0:
+        return text
+
+
+class Uploader(Logging):
+    """ Upload tasks running on the event loop, never waited by the caller """
+
+    MAX_CONCURRENT = 8
+    MAX_RETRIES = 3
+    RETRY_DELAY = 1.0  # seconds, doubled for each retry
+
+    def __init__(self, backend: UploadBackend, delegate: UploadDelegate,
+                 max_concurrent: int = None, max_retries: int = None):
+        super().__init__()
+        self.__backend = backend
+        self.__delegate = delegate
+        self.__max_concurrent = self.MAX_CONCURRENT if max_concurrent is None or max_concurrent <= 0 \
+            else max_concurrent
+        self.__max_retries = self.MAX_RETRIES if max_retries is None or max_retries <= 0 else max_retries
+        self.__semaphore: Optional[asyncio.Semaphore] = None
+        self.__tasks: Set[asyncio.Task] = set()
+
+    @property
+    def backend(self) -> UploadBackend:
+        return self.__backend
+
+    @property
+    def pending(self) -> int:
+        """ count of tasks waiting or uploading """
+        return len(self.__tasks)
+
+    def upload(self, data: bytes, filename: str, sender: ID) -> bool:
+        """ add upload task, delegate will be called when done """
+        try:
+            task = asyncio.get_running_loop().create_task(self._run(data=data, filename=filename, sender=sender))
+        except RuntimeError as error:
+            self.error(msg='failed to add upload task: %s, %s' % (filename, error))
+            return False
+        # keep a strong reference until done
+        self.__tasks.add(task)
+        task.add_done_callback(self.__tasks.discard)
+        return True
+
+    async def _run(self, data: bytes, filename: str, sender: ID):
+        if self.__semaphore is None:
+            self.__semaphore = asyncio.Semaphore(self.__max_concurrent)
+        url = None
+        delay = self.RETRY_DELAY
+        total = self.__max_retries + 1
+        for attempt in range(total):
+            if attempt > 0:
+                # back off without holding the slot
+                await asyncio.sleep(delay)
+                delay *= 2
+            try:
+                async with self.__semaphore:
+                    url = await self.__backend.upload(data=data, filename=filename, sender=sender)
+            except UploadError as error:
+                if not error.retryable:
+                    # rejected (e.g. HTTP 400, 413), it won't succeed by trying again
+                    self.error(msg='upload rejected: %s, %s' % (filename, error))
+                    break
+                self.warning(msg='upload failed (%d/%d): %s, %s' % (attempt + 1, total, filename, error))
+                continue
+            except (aiohttp.ClientError, asyncio.TimeoutError, OSError) as error:
+                # connection error or timeout
+                self.warning(msg='upload failed (%d/%d): %s, %s' % (attempt + 1, total, filename, error))
+                continue
+            except Exception as error:
+                self.error(msg='upload error: %s, %s' % (filename, error))
+                break
+            if url is not None:
+                break
+            self.warning(msg='upload failed (%d/%d): %s, no URL responded' % (attempt + 1, total, filename))
+        delegate = self.__delegate
+        try:
+            if url is None:
+                await delegate.upload_failed(filename=filename)
+            else:
+                self.info(msg='uploaded %d bytes: %s => %s' % (len(data), filename, url))
+                await delegate.upload_success(filename=filename, url=url)
+        except Exception as error:
+            self.error(msg='upload callback error: %s, %s' % (filename, error))
@@ -34,6 +34,7 @@ from dimples.common.dbi import *
 from .dos import *
 from .redis import *
 
+from .cache import CacheStats
 from .database import DbInfo
 from .database import Database
 
@@ -62,6 +63,8 @@ __all__ = [
     'GroupKeysStorage',
     'LoginStorage',
     'StationStorage',
+    'InboxStorage',
+    'IdentifierStorage',
 
     #
     #   Redis
@@ -69,10 +72,12 @@ __all__ = [
     'MetaCache',
     'DocumentCache',
     'GroupCache', 'GroupHistoryCache',
+    'InboxCache',
 
     #
     #   Database
     #
+    'CacheStats',
     'DbInfo',
     'Database',
 
@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+# ==============================================================================
+# MIT License
+#
+# Copyright (c) 2024 Albert Moky
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+# ==============================================================================
+
+"""
+    Cache Stats
+    ~~~~~~~~~~~
+
+    Hit rates of the memory cache pools in front of the tables (meta, documents),
+    counted in the metrics registry ('cache'), so the exporter reports them periodically
+"""
+
+import time
+from typing import Any
+
+from dimples.utils import CachePool
+
+from ..utils import MetricsRegistry
+
+
+class CacheStats:
+    """ Check the pool before the table reading it, without changing anything """
+
+    def __init__(self, name: str, pool: CachePool):
+        super().__init__()
+        self.__name = name
+        self.__pool = pool
+        self.__labels = {'pool': name}
+        self.__metrics = MetricsRegistry().get_metrics(name='cache')
+
+    @property
+    def name(self) -> str:
+        return self.__name
+
+    @property
+    def hits(self) -> int:
+        return int(self.__metrics.get_counter(name='hits', labels=self.__labels))
+
+    @property
+    def misses(self) -> int:
+        return int(self.__metrics.get_counter(name='misses', labels=self.__labels))
+
+    def observe(self, key: Any, now: float = None):
+        if now is None:
+            now = time.time()
+        value, holder = self.__pool.fetch(key=key, now=now)
+        metrics = self.__metrics
+        if value is not None:
+            metrics.increase(name='hits', labels=self.__labels)
+        elif holder is not None and holder.is_alive(now=now):
+            # cached as not found
+            metrics.increase(name='hits', labels=self.__labels)
+            metrics.increase(name='negative_hits', labels=self.__labels)
+        else:
+            metrics.increase(name='misses', labels=self.__labels)
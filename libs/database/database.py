@@ -29,6 +29,7 @@
 
 """
 
+import os
 from typing import Optional, Tuple, List, Dict
 
 from dimples import SymmetricKey, PrivateKey, SignKey, DecryptKey
@@ -44,14 +45,23 @@ from dimples.database import MetaTable
 from dimples.database import DocumentTable
 from dimples.database import GroupTable
 from dimples.database import GroupHistoryTable
+from dimples.utils import SharedCacheManager
+
+from .cache import CacheStats
+from .dos import InboxStorage
+from .dos import IdentifierStorage
+from .redis import InboxCache
 
 
 class Database(AccountDBI, MessageDBI, SessionDBI):
 
-    def __init__(self, info: DbInfo):
+    def __init__(self, info: DbInfo, owner: ID):
         super().__init__()
-        self.__users = []
-        self.__contacts = {}
+        self.__root = info.root_dir
+        # files & keys of the bot, bots sharing the same database must not share them
+        path = os.path.join(info.root_dir, 'protected', str(owner.address), 'users.log')
+        self.__users = IdentifierStorage(path=path)
+        self.__contacts: Dict[ID, IdentifierStorage] = {}
         # Entity
         self.__private_table = PrivateKeyTable(info=info)
         self.__meta_table = MetaTable(info=info)
@@ -62,6 +72,15 @@ class Database(AccountDBI, MessageDBI, SessionDBI):
         self.__cipherkey_table = CipherKeyTable(info=info)
         # # ANS
         # self.__ans_table = AddressNameTable(info=info)
+        if info.redis_connector is None:
+            path = os.path.join(info.root_dir, 'protected', str(owner.address), 'inbox')
+            self.__inbox = InboxStorage(root=path)
+        else:
+            self.__inbox = InboxCache(connector=info.redis_connector, owner=str(owner.address))
+        # hit rates of the memory caches in the tables, reported by the metrics exporter
+        man = SharedCacheManager()
+        self.__meta_stats = CacheStats(name='meta', pool=man.get_pool(name='meta'))
+        self.__document_stats = CacheStats(name='documents', pool=man.get_pool(name='documents'))
 
     def show_info(self):
         # Entity
@@ -72,6 +91,7 @@ class Database(AccountDBI, MessageDBI, SessionDBI):
         self.__history_table.show_info()
         # Message
         self.__cipherkey_table.show_info()
+        self.__inbox.show_info()
         # # ANS
         # self.__ans_table.show_info()
 
@@ -115,6 +135,7 @@ class Database(AccountDBI, MessageDBI, SessionDBI):
 
     # Override
     async def get_meta(self, identifier: ID) -> Optional[Meta]:
+        self.__meta_stats.observe(key=identifier)
         return await self.__meta_table.get_meta(identifier=identifier)
 
     """
@@ -137,91 +158,79 @@ class Database(AccountDBI, MessageDBI, SessionDBI):
 
     # Override
     async def get_documents(self, identifier: ID) -> List[Document]:
+        self.__document_stats.observe(key=identifier)
         return await self.__document_table.get_documents(identifier=identifier)
 
     """
         User contacts
         ~~~~~~~~~~~~~
 
-        file path: '.dim/protected/{ADDRESS}/contacts.txt'
-        redis key: 'mkm.user.{ID}.contacts'
+        file path: '.dim/protected/{OWNER}/users.log'
+        file path: '.dim/protected/{ADDRESS}/contacts.log'
     """
 
     # Override
     async def get_local_users(self) -> List[ID]:
-        return self.__users
+        return self.__users.get_all()
 
     # Override
     async def save_local_users(self, users: List[ID]) -> bool:
-        self.__users = users
-        return True
+        return self.__users.replace(identifiers=users)
 
     # Override
     async def add_user(self, user: ID) -> bool:
-        array = await self.get_local_users()
-        if user in array:
-            # self.warning(msg='user exists: %s, %s' % (user, array))
-            return True
-        array.insert(0, user)
-        return await self.save_local_users(users=array)
+        if not self.__users.contains(identifier=user):
+            self.__users.add(identifier=user, front=True)
+        return True
 
     # Override
     async def remove_user(self, user: ID) -> bool:
-        array = await self.get_local_users()
-        if user not in array:
-            # self.warning(msg='user not exists: %s, %s' % (user, array))
-            return True
-        array.remove(user)
-        return await self.save_local_users(users=array)
+        self.__users.remove(identifier=user)
+        return True
 
     # Override
     async def current_user(self) -> Optional[ID]:
-        array = await self.get_local_users()
-        if len(array) > 0:
-            return array[0]
+        return self.__users.first()
 
     # Override
     async def set_current_user(self, user: ID) -> bool:
-        array = await self.get_local_users()
-        if user in array:
-            index = array.index(user)
-            if index == 0:
-                # self.warning(msg='current user not changed: %s, %s' % (user, array))
-                return True
-            array.pop(index)
-        array.insert(0, user)
-        return await self.save_local_users(users=array)
+        self.__users.add(identifier=user, front=True)
+        return True
+
+    def _contacts_storage(self, user: ID) -> IdentifierStorage:
+        storage = self.__contacts.get(user)
+        if storage is None:
+            path = os.path.join(self.__root, 'protected', str(user.address), 'contacts.log')
+            storage = self.__contacts[user] = IdentifierStorage(path=path)
+        return storage
 
     # Override
     async def save_contacts(self, contacts: List[ID], user: ID) -> bool:
-        self.__contacts[user] = contacts
-        return True
+        return self._contacts_storage(user=user).replace(identifiers=contacts)
 
     # Override
     async def get_contacts(self, user: ID) -> List[ID]:
-        array = self.__contacts.get(user)
-        if array is None:
-            array = []
-            self.__contacts[user] = array
-        return array
+        return self._contacts_storage(user=user).get_all()
 
     # Override
     async def add_contact(self, contact: ID, user: ID) -> bool:
-        array = await self.get_contacts(user=user)
-        if contact in array:
-            # self.warning(msg='contact exists: %s, user: %s' % (contact, user))
-            return True
-        array.append(contact)
-        return await self.save_contacts(contacts=array, user=user)
+        self._contacts_storage(user=user).add(identifier=contact)
+        return True
 
     # Override
     async def remove_contact(self, contact: ID, user: ID) -> bool:
-        array = await self.get_contacts(user=user)
-        if contact not in array:
-            # self.warning(msg='contact not exists: %s, user: %s' % (contact, user))
-            return True
-        array.remove(contact)
-        return await self.save_contacts(contacts=array, user=user)
+        self._contacts_storage(user=user).remove(identifier=contact)
+        return True
+
+    def has_contact(self, contact: ID, user: ID) -> bool:
+        """ O(1) membership check, without copying the contacts list """
+        return self._contacts_storage(user=user).contains(identifier=contact)
+
+    def flush(self):
+        """ write pending changes of users & contacts """
+        self.__users.flush()
+        for storage in list(self.__contacts.values()):
+            storage.flush()
 
     """
         Group members
@@ -291,24 +300,22 @@ class Database(AccountDBI, MessageDBI, SessionDBI):
         Reliable message for Receivers
         ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 
-        redis key: 'dkd.msg.{ID}.{sig}'
-        redis key: 'dkd.msg.{ID}.messages'
+        redis key: 'dkd.inbox.{OWNER}.{ID}.messages'
+        redis key: 'dkd.inbox.{OWNER}.{ID}.signatures'
+        or segment files in '{root}/protected/{OWNER}/inbox/'
     """
 
     # Override
     async def get_reliable_messages(self, receiver: ID, limit: int = 1024) -> List[ReliableMessage]:
-        # TODO: get cached reliable messages
-        return []
+        return await self.__inbox.get_reliable_messages(receiver=receiver, limit=limit)
 
     # Override
     async def cache_reliable_message(self, msg: ReliableMessage, receiver: ID) -> bool:
-        # TODO: cache reliable messages
-        return True
+        return await self.__inbox.save_reliable_message(msg=msg, receiver=receiver)
 
     # Override
     async def remove_reliable_message(self, msg: ReliableMessage, receiver: ID) -> bool:
-        # TODO: remove sent reliable message
-        return True
+        return await self.__inbox.remove_reliable_message(msg=msg, receiver=receiver)
 
     """
         Message Keys
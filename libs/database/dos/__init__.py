@@ -31,6 +31,9 @@
 
 from dimples.database.dos import *
 
+from .inbox import InboxStorage
+from .contacts import IdentifierStorage
+
 __all__ = [
 
     'Storage',
@@ -41,4 +44,7 @@ __all__ = [
     'LoginStorage',
     'StationStorage',
 
+    'InboxStorage',
+    'IdentifierStorage',
+
 ]
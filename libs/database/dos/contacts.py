@@ -0,0 +1,221 @@
+# -*- coding: utf-8 -*-
+# ==============================================================================
+# MIT License
+#
+# Copyright (c) 2024 Albert Moky
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+# ==============================================================================
+
+"""
+    Identifier Storage
+    ~~~~~~~~~~~~~~~~~~
+
+    Ordered set of IDs (local users, contacts) in memory, persisted as an append-only log
+"""
+
+import asyncio
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional, List
+
+from dimples import ID
+
+from ...utils import utf8_encode, utf8_decode
+from ...utils import Logging
+
+
+class IdentifierStorage(Logging):
+    """
+        Log file, one record per line:
+            +{ID}  -- append
+            ^{ID}  -- insert at the front
+            -{ID}  -- remove
+        rewritten with the live IDs when there are too many dead lines;
+        changes are written in batches, flushed when the batch is full or after a short delay
+    """
+
+    BATCH_SIZE = 256   # records
+    FLUSH_DELAY = 1.0  # seconds
+
+    def __init__(self, path: str):
+        super().__init__()
+        self.__path = path
+        self.__items: Optional[OrderedDict] = None  # ordered set: ID => None
+        self.__pending: List[str] = []
+        self.__lines = 0
+        self.__flush_handle = None
+        self.__lock = threading.Lock()
+
+    @property
+    def path(self) -> str:
+        return self.__path
+
+    def _load(self) -> OrderedDict:
+        items = self.__items
+        if items is not None:
+            return items
+        items = OrderedDict()
+        lines = 0
+        try:
+            with open(self.__path, 'rb') as file:
+                for line in file:
+                    lines += 1
+                    _replay(items=items, line=utf8_decode(data=line).strip())
+        except FileNotFoundError:
+            pass
+        except (OSError, UnicodeDecodeError) as error:
+            self.error(msg='failed to load IDs: %s, %s' % (self.__path, error))
+        self.__items = items
+        self.__lines = lines
+        return items
+
+    #
+    #   Reading
+    #
+
+    def contains(self, identifier: ID) -> bool:
+        with self.__lock:
+            return identifier in self._load()
+
+    def get_all(self) -> List[ID]:
+        with self.__lock:
+            return list(self._load())
+
+    def first(self) -> Optional[ID]:
+        with self.__lock:
+            return next(iter(self._load()), None)
+
+    #
+    #   Writing
+    #
+
+    def add(self, identifier: ID, front: bool = False) -> bool:
+        """ return False if nothing changed """
+        with self.__lock:
+            items = self._load()
+            if front:
+                if next(iter(items), None) == identifier:
+                    return False
+                items[identifier] = None
+                items.move_to_end(identifier, last=False)
+                self._push(record='^%s' % identifier)
+            elif identifier in items:
+                return False
+            else:
+                items[identifier] = None
+                self._push(record='+%s' % identifier)
+        return True
+
+    def remove(self, identifier: ID) -> bool:
+        """ return False if not exists """
+        with self.__lock:
+            items = self._load()
+            if identifier not in items:
+                return False
+            del items[identifier]
+            self._push(record='-%s' % identifier)
+        return True
+
+    def replace(self, identifiers: List[ID]) -> bool:
+        """ replace all IDs and rewrite the file """
+        with self.__lock:
+            self.__items = OrderedDict.fromkeys(identifiers)
+            self.__pending.clear()
+            return self._rewrite()
+
+    def _push(self, record: str):
+        self.__pending.append(record)
+        if len(self.__pending) >= self.BATCH_SIZE:
+            self._flush()
+        elif self.__flush_handle is None:
+            try:
+                loop = asyncio.get_running_loop()
+            except RuntimeError:
+                # no event loop, write immediately
+                self._flush()
+                return
+            self.__flush_handle = loop.call_later(self.FLUSH_DELAY, self.flush)
+
+    def flush(self) -> bool:
+        with self.__lock:
+            return self._flush()
+
+    def _flush(self) -> bool:
+        handle = self.__flush_handle
+        if handle is not None:
+            self.__flush_handle = None
+            handle.cancel()
+        pending = self.__pending
+        if len(pending) == 0:
+            return True
+        self.__pending = []
+        data = utf8_encode(string=''.join('%s\n' % record for record in pending))
+        try:
+            _make_dirs(path=self.__path)
+            with open(self.__path, 'ab') as file:
+                file.write(data)
+        except OSError as error:
+            self.error(msg='failed to write IDs: %s, %s' % (self.__path, error))
+            return False
+        self.__lines += len(pending)
+        if self.__lines > 1024 and self.__lines > len(self.__items) * 4:
+            self._rewrite()
+        return True
+
+    def _rewrite(self) -> bool:
+        """ rewrite with live IDs only """
+        start = time.time()
+        tmp = '%s.tmp' % self.__path
+        data = utf8_encode(string=''.join('+%s\n' % identifier for identifier in self.__items))
+        try:
+            _make_dirs(path=self.__path)
+            with open(tmp, 'wb') as file:
+                file.write(data)
+            os.replace(tmp, self.__path)
+        except OSError as error:
+            self.error(msg='failed to rewrite IDs: %s, %s' % (self.__path, error))
+            return False
+        self.__lines = len(self.__items)
+        self.debug(msg='IDs rewritten: %d, %s (%f seconds)' % (self.__lines, self.__path, time.time() - start))
+        return True
+
+
+def _replay(items: OrderedDict, line: str):
+    if len(line) < 2:
+        return
+    identifier = ID.parse(identifier=line[1:])
+    if identifier is None:
+        return
+    op = line[0]
+    if op == '+':
+        items[identifier] = None
+    elif op == '-':
+        items.pop(identifier, None)
+    elif op == '^':
+        items[identifier] = None
+        items.move_to_end(identifier, last=False)
+
+
+def _make_dirs(path: str):
+    directory = os.path.dirname(path)
+    if len(directory) > 0:
+        os.makedirs(directory, exist_ok=True)
@@ -0,0 +1,360 @@
+# -*- coding: utf-8 -*-
+# ==============================================================================
+# MIT License
+#
+# Copyright (c) 2024 Albert Moky
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+# ==============================================================================
+
+"""
+    Inbox Storage
+    ~~~~~~~~~~~~~
+
+    Reliable messages waiting for receivers, stored in append-only segment files
+"""
+
+import asyncio
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional, Tuple, List, Dict
+
+from dimples import ID
+from dimples import ReliableMessage
+from dimples.utils import get_msg_sig
+
+from ...utils import utf8_encode, utf8_decode
+from ...utils import json_encode, json_decode
+from ...utils import Logging
+
+
+class InboxStorage(Logging):
+    """
+        Segment files '{dir}/{NUMBER}.log', one JSON record per line:
+            {"add": "{SIG}", "to": "{RECEIVER}", "time": 0, "msg": {...}}
+            {"del": "{SIG}", "to": "{RECEIVER}"}
+
+        index in memory: receiver => (sig => (segment, offset, length, time)),
+        segments are dropped from the oldest one when nothing alive in it,
+        live messages in the oldest segment are moved when too many segments
+    """
+
+    # only relay cached messages within 7 days
+    EXPIRES = 3600 * 24 * 7  # seconds
+
+    SEGMENT_SIZE = 1024 * 1024 * 4  # bytes
+    MAX_SEGMENTS = 8
+
+    def __init__(self, root: str):
+        super().__init__()
+        self.__root = root
+        self.__index: Dict[ID, Dict[str, Tuple[int, int, int, float]]] = {}
+        self.__live: Dict[int, int] = OrderedDict()  # segment => count of live messages
+        self.__current = 0       # current segment number
+        self.__current_size = 0  # bytes
+        self.__loaded = False
+        self.__lock = threading.Lock()
+
+    @property
+    def root(self) -> str:
+        return self.__root
+
+    def show_info(self):
+        print('!!! reliable messages stored in segments: %s' % self.__root)
+
+    def _segment_path(self, segment: int) -> str:
+        return os.path.join(self.__root, '%08d.log' % segment)
+
+    #
+    #   Loading
+    #
+
+    def _load(self):
+        if self.__loaded:
+            return
+        self.__loaded = True
+        try:
+            names = os.listdir(self.__root)
+        except FileNotFoundError:
+            names = []
+        segments = sorted(int(name[:-4]) for name in names if name.endswith('.log') and name[:-4].isdigit())
+        for segment in segments:
+            self.__live[segment] = 0
+            self._load_segment(segment=segment)
+        if len(segments) > 0:
+            self.__current = segments[-1]
+            self.__current_size = os.path.getsize(self._segment_path(segment=self.__current))
+        # order by message time, as live messages may be moved into newer segments
+        for receiver, table in self.__index.items():
+            self.__index[receiver] = OrderedDict(sorted(table.items(), key=lambda item: item[1][3]))
+        count = sum(self.__live.values())
+        self.info(msg='inbox loaded: %d message(s) in %d segment(s), %s' % (count, len(segments), self.__root))
+        self._compact()
+
+    def _load_segment(self, segment: int):
+        offset = 0
+        try:
+            with open(self._segment_path(segment=segment), 'rb') as file:
+                for line in file:
+                    length = len(line)
+                    record = _parse_record(line=line)
+                    if record is not None:
+                        self._replay(record=record, position=(segment, offset, length))
+                    offset += length
+        except OSError as error:
+            self.error(msg='failed to load inbox segment: %d, %s' % (segment, error))
+
+    def _replay(self, record: Dict, position: Tuple[int, int, int]):
+        receiver = ID.parse(identifier=record.get('to'))
+        if receiver is None:
+            return
+        sig = record.get('add')
+        if sig is not None:
+            self._put(receiver=receiver, sig=sig, position=position, when=record.get('time', 0))
+            return
+        sig = record.get('del')
+        if sig is not None:
+            self._pop(receiver=receiver, sig=sig)
+
+    #
+    #   Index
+    #
+
+    def _put(self, receiver: ID, sig: str, position: Tuple[int, int, int], when: float):
+        table = self.__index.get(receiver)
+        if table is None:
+            table = self.__index[receiver] = OrderedDict()
+        old = table.get(sig)
+        if old is not None:
+            self.__live[old[0]] -= 1
+        segment, offset, length = position
+        table[sig] = (segment, offset, length, when)
+        self.__live[segment] = self.__live.get(segment, 0) + 1
+
+    def _pop(self, receiver: ID, sig: str) -> bool:
+        table = self.__index.get(receiver)
+        if table is None:
+            return False
+        entry = table.pop(sig, None)
+        if entry is None:
+            return False
+        if len(table) == 0:
+            self.__index.pop(receiver, None)
+        self.__live[entry[0]] -= 1
+        return True
+
+    #
+    #   Writing
+    #
+
+    def _append(self, record: Dict) -> Optional[Tuple[int, int, int]]:
+        """ append record to current segment, return position """
+        line = utf8_encode(string=json_encode(obj=record)) + b'\n'
+        if self.__current_size > 0 and self.__current_size + len(line) > self.SEGMENT_SIZE:
+            # new segment
+            self.__current += 1
+            self.__current_size = 0
+        segment = self.__current
+        offset = self.__current_size
+        try:
+            os.makedirs(self.__root, exist_ok=True)
+            with open(self._segment_path(segment=segment), 'ab') as file:
+                file.write(line)
+        except OSError as error:
+            self.error(msg='failed to write inbox segment: %d, %s' % (segment, error))
+            return None
+        self.__live.setdefault(segment, 0)
+        self.__current_size += len(line)
+        return segment, offset, len(line)
+
+    def _compact(self):
+        """ drop dead segments from the oldest, move live messages out of the oldest one if too many segments """
+        # segments created while relocating are not checked in this round
+        current = self.__current
+        while len(self.__live) > 1:
+            segment, count = next(iter(self.__live.items()))
+            if segment >= current:
+                break
+            elif count > 0:
+                if len(self.__live) <= self.MAX_SEGMENTS or not self._relocate(segment=segment):
+                    break
+            try:
+                os.remove(self._segment_path(segment=segment))
+            except FileNotFoundError:
+                pass
+            except OSError as error:
+                self.error(msg='failed to remove inbox segment: %d, %s' % (segment, error))
+                break
+            self.__live.pop(segment, None)
+
+    def _relocate(self, segment: int) -> bool:
+        """ copy live messages in the segment to current segment """
+        moving = []
+        for receiver, table in self.__index.items():
+            for sig, entry in table.items():
+                if entry[0] == segment:
+                    moving.append((receiver, sig, entry))
+        for receiver, sig, entry in moving:
+            info = self._verify(record=self._read(entry=entry), sig=sig, receiver=receiver)
+            if info is None:
+                self._pop(receiver=receiver, sig=sig)
+                continue
+            position = self._append(record=info)
+            if position is None:
+                return False
+            # replace position, keep order in the receiver's table
+            table = self.__index[receiver]
+            table[sig] = position + (entry[3],)
+            self.__live[segment] -= 1
+            self.__live[position[0]] += 1
+        self.info(msg='inbox segment %d relocated: %d message(s)' % (segment, len(moving)))
+        return True
+
+    #
+    #   Reading
+    #
+
+    def _verify(self, record: Optional[Dict], sig: str, receiver: ID) -> Optional[Dict]:
+        """ check the record at the position is the message expected """
+        if record is None:
+            return None
+        if record.get('add') != sig or record.get('to') != str(receiver):
+            self.error(msg='inbox record mismatched: %s -> %s, got %s -> %s'
+                           % (sig, receiver, record.get('add'), record.get('to')))
+            return None
+        return record
+
+    def _read(self, entry: Tuple[int, int, int, float]) -> Optional[Dict]:
+        segment, offset, length, _ = entry
+        try:
+            with open(self._segment_path(segment=segment), 'rb') as file:
+                file.seek(offset)
+                return _parse_record(line=file.read(length))
+        except OSError as error:
+            self.error(msg='failed to read inbox segment: %d, %s' % (segment, error))
+
+    def _read_batch(self, entries: List[Tuple[int, int, int, float]]) -> List[Optional[Dict]]:
+        """ read records, each segment file opened once """
+        results: List[Optional[Dict]] = [None] * len(entries)
+        by_segment: Dict[int, List[int]] = {}
+        for pos, entry in enumerate(entries):
+            by_segment.setdefault(entry[0], []).append(pos)
+        for segment, positions in by_segment.items():
+            try:
+                with open(self._segment_path(segment=segment), 'rb') as file:
+                    for pos in sorted(positions, key=lambda p: entries[p][1]):
+                        _, offset, length, _ = entries[pos]
+                        file.seek(offset)
+                        results[pos] = _parse_record(line=file.read(length))
+            except OSError as error:
+                self.error(msg='failed to read inbox segment: %d, %s' % (segment, error))
+        return results
+
+    #
+    #   Reliable Messages
+    #
+
+    async def save_reliable_message(self, msg: ReliableMessage, receiver: ID) -> bool:
+        sig = get_msg_sig(msg=msg)
+        when = msg.time
+        record = {
+            'add': sig,
+            'to': str(receiver),
+            'time': 0 if when is None else when.timestamp,
+            'msg': msg.dictionary,
+        }
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, self._save, record, sig, receiver)
+
+    async def remove_reliable_message(self, msg: ReliableMessage, receiver: ID) -> bool:
+        sig = get_msg_sig(msg=msg)
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, self._remove, sig, receiver)
+
+    async def get_reliable_messages(self, receiver: ID, limit: int = 1024) -> List[ReliableMessage]:
+        assert limit > 0, 'message limit error: %d' % limit
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, self._get_messages, receiver, limit)
+
+    #
+    #   File I/O (in executor, the lock is never held across an await)
+    #
+
+    def _save(self, record: Dict, sig: str, receiver: ID) -> bool:
+        with self.__lock:
+            self._load()
+            position = self._append(record=record)
+            if position is None:
+                return False
+            self._put(receiver=receiver, sig=sig, position=position, when=record['time'])
+        return True
+
+    def _remove(self, sig: str, receiver: ID) -> bool:
+        with self.__lock:
+            self._load()
+            if not self._pop(receiver=receiver, sig=sig):
+                return True
+            ok = self._append(record={'del': sig, 'to': str(receiver)}) is not None
+            self._compact()
+        return ok
+
+    def _get_messages(self, receiver: ID, limit: int) -> List[ReliableMessage]:
+        expired = time.time() - self.EXPIRES
+        array = []
+        with self.__lock:
+            self._load()
+            table = self.__index.get(receiver)
+            if table is None:
+                return array
+            dead = []
+            batch = []
+            for sig, entry in table.items():
+                if 0 < entry[3] < expired:
+                    dead.append(sig)
+                    continue
+                batch.append((sig, entry))
+                if len(batch) >= limit:
+                    break
+            records = self._read_batch(entries=[entry for _, entry in batch])
+            for (sig, _), record in zip(batch, records):
+                record = self._verify(record=record, sig=sig, receiver=receiver)
+                msg = None if record is None else ReliableMessage.parse(msg=record.get('msg'))
+                if msg is None:
+                    dead.append(sig)
+                else:
+                    array.append(msg)
+            for sig in dead:
+                if self._pop(receiver=receiver, sig=sig):
+                    self._append(record={'del': sig, 'to': str(receiver)})
+            if len(dead) > 0:
+                self.warning(msg='drop %d expired/broken message(s) for %s' % (len(dead), receiver))
+                self._compact()
+        return array
+
+def _parse_record(line: bytes) -> Optional[Dict]:
+    line = line.strip()
+    if len(line) == 0:
+        return None
+    try:
+        info = json_decode(string=utf8_decode(data=line))
+    except ValueError:
+        return None
+    return info if isinstance(info, Dict) else None
@@ -31,6 +31,8 @@
 
 from dimples.database.redis import *
 
+from .inbox import InboxCache
+
 
 __all__ = [
 
@@ -42,4 +44,6 @@ __all__ = [
     'MessageCache',
     'StationCache',
 
+    'InboxCache',
+
 ]
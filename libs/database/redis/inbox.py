@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+# ==============================================================================
+# MIT License
+#
+# Copyright (c) 2024 Albert Moky
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+# ==============================================================================
+
+"""
+    Inbox Cache
+    ~~~~~~~~~~~
+
+    Reliable messages waiting for receivers, stored in Redis
+"""
+
+import time
+from typing import Optional, Iterable, List
+
+from dimples import ID
+from dimples import ReliableMessage
+from dimples.utils import get_msg_sig
+from dimples.database.redis.base import Cache
+
+from ...utils import utf8_encode, utf8_decode
+from ...utils import json_encode, json_decode
+
+
+class InboxCache(Cache):
+    """
+        redis key: 'dkd.inbox.{OWNER}.{ID}.messages'    -- hash: sig => message
+        redis key: 'dkd.inbox.{OWNER}.{ID}.signatures'  -- list: sig, oldest first
+
+        owner is the address of the bot;
+        removing a message only deletes it from the hash (O(1)),
+        dead signatures are trimmed from the list head while reading,
+        and a signature pushed again (saved again after removed) is read only once.
+    """
+
+    # only relay cached messages within 7 days
+    EXPIRES = 3600 * 24 * 7  # seconds
+
+    BATCH = 64  # signatures read from the list each round
+
+    def __init__(self, connector, owner: str):
+        super().__init__(connector=connector)
+        self.__owner = owner
+
+    @property  # Override
+    def db_name(self) -> Optional[str]:
+        return 'dkd'
+
+    @property  # Override
+    def tbl_name(self) -> str:
+        return 'inbox'
+
+    def __messages_name(self, receiver: ID) -> str:
+        return '%s.%s.%s.%s.messages' % (self.db_name, self.tbl_name, self.__owner, receiver)
+
+    def __signatures_name(self, receiver: ID) -> str:
+        return '%s.%s.%s.%s.signatures' % (self.db_name, self.tbl_name, self.__owner, receiver)
+
+    def show_info(self):
+        print('!!! reliable messages cached in redis: %s.%s.%s.*' % (self.db_name, self.tbl_name, self.__owner))
+
+    #
+    #   List & Hash Mapping
+    #
+
+    async def rpush(self, name: str, *values):
+        """ Append values to the list with name """
+        redis = self.redis
+        if redis is None:
+            return False
+        redis.rpush(name, *values)
+        return True
+
+    async def lrange(self, name: str, start: int = 0, end: int = -1) -> List[bytes]:
+        """ Get items with range [start, end] from the list with name """
+        redis = self.redis
+        if redis is None:
+            return []
+        items = redis.lrange(name, start, end)
+        return [] if items is None else items
+
+    async def ltrim(self, name: str, start: int, end: int = -1):
+        """ Keep items with range [start, end] in the list with name """
+        redis = self.redis
+        if redis is None:
+            return False
+        redis.ltrim(name, start, end)
+        return True
+
+    async def hmget(self, name: str, keys: Iterable) -> List[Optional[bytes]]:
+        """ Get values from the hash table with name & keys, in one round trip """
+        redis = self.redis
+        if redis is None:
+            return []
+        values = redis.hmget(name, list(keys))
+        return [] if values is None else values
+
+    #
+    #   Reliable Messages
+    #
+
+    async def save_reliable_message(self, msg: ReliableMessage, receiver: ID) -> bool:
+        sig = get_msg_sig(msg=msg)
+        value = utf8_encode(string=json_encode(obj=msg.dictionary))
+        messages_key = self.__messages_name(receiver=receiver)
+        signatures_key = self.__signatures_name(receiver=receiver)
+        # append the signature only when it's a new message
+        is_new = await self.hget(name=messages_key, key=sig) is None
+        if not await self.hset(name=messages_key, key=sig, value=value):
+            return False
+        if is_new:
+            await self.rpush(signatures_key, sig)
+        await self.expire(name=messages_key, time=self.EXPIRES)
+        await self.expire(name=signatures_key, time=self.EXPIRES)
+        return True
+
+    async def remove_reliable_message(self, msg: ReliableMessage, receiver: ID) -> bool:
+        sig = get_msg_sig(msg=msg)
+        return await self.hdel(name=self.__messages_name(receiver=receiver), key=sig)
+
+    async def get_reliable_messages(self, receiver: ID, limit: int = 1024) -> List[ReliableMessage]:
+        assert limit > 0, 'message limit error: %d' % limit
+        messages_key = self.__messages_name(receiver=receiver)
+        signatures_key = self.__signatures_name(receiver=receiver)
+        expired = time.time() - self.EXPIRES
+        array = []
+        seen = set()  # signatures read
+        dead = []     # signatures removed, expired or broken
+        leading = 0   # count of dead (or repeated) signatures at the head of the list
+        start = 0
+        while len(array) < limit:
+            signatures = await self.lrange(name=signatures_key, start=start, end=start + self.BATCH - 1)
+            if len(signatures) == 0:
+                break
+            start += len(signatures)
+            # one round trip for a batch of messages
+            values = await self.hmget(name=messages_key, keys=signatures)
+            for sig, value in zip(signatures, values):
+                if sig in seen:
+                    # pushed again after removed & saved again, skip it (keep the message)
+                    if len(array) == 0:
+                        leading += 1
+                    continue
+                seen.add(sig)
+                msg = None if value is None else _parse_message(data=value)
+                if msg is None or _msg_time(msg=msg) < expired:
+                    if value is not None:
+                        dead.append(sig)
+                    if len(array) == 0:
+                        leading += 1
+                elif len(array) < limit:
+                    array.append(msg)
+        for sig in dead:
+            await self.hdel(name=messages_key, key=sig)
+        if leading > 0:
+            await self.ltrim(name=signatures_key, start=leading)
+        return array
+
+
+def _msg_time(msg: ReliableMessage) -> float:
+    when = msg.time
+    # messages without time never expire
+    return time.time() if when is None else when.timestamp
+
+
+def _parse_message(data: bytes) -> Optional[ReliableMessage]:
+    try:
+        info = json_decode(string=utf8_decode(data=data))
+        return ReliableMessage.parse(msg=info)
+    except Exception as error:
+        print('[REDIS] message error: %s => %s' % (error, data))
@@ -40,7 +40,13 @@ from dimples.database.dos.document import parse_document
 
 from .pnf import get_filename, get_extension
 from .pnf import get_cache_name
-from .pnf import filename_from_url, filename_from_data
+from .pnf import filename_from_url, filename_from_data, filename_from_digest
+
+from .mapped import MappedFile
+
+from .metrics import Histogram, Metrics
+from .metrics import MetricsRegistry, MetricsExporter
+from .profiler import Profiler
 
 
 def md_esc(text: str) -> str:
@@ -102,7 +108,13 @@ __all__ = [
     #
     'get_filename', 'get_extension',
     'get_cache_name',
-    'filename_from_url', 'filename_from_data',
+    'filename_from_url', 'filename_from_data', 'filename_from_digest',
+
+    'MappedFile',
+
+    'Histogram', 'Metrics',
+    'MetricsRegistry', 'MetricsExporter',
+    'Profiler',
 
     #
     #   Others
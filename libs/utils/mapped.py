@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+# ==============================================================================
+# MIT License
+#
+# Copyright (c) 2024 Albert Moky
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+# ==============================================================================
+
+
+"""
+    Mapped File
+    ~~~~~~~~~~~
+
+    Read-only memory map, bytes stay in the page cache until decoded.
+
+    NOTICE: files should be replaced by renaming (write to a temporary file,
+            then move it to the path), so the mapped inode keeps unchanged.
+
+    Readers 'retain' the map while using it and 'release' it after that;
+    a retired map (file replaced) is closed when the last reader released it.
+"""
+
+import mmap
+import os
+import threading
+from typing import Optional, Tuple, List
+
+
+class MappedFile:
+
+    def __init__(self, path: str):
+        super().__init__()
+        with open(path, 'rb') as file:
+            info = os.fstat(file.fileno())
+            # the map keeps its own handle, so the file can be closed here
+            self.__map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.__path = path
+        self.__stamp = (info.st_ino, info.st_size, info.st_mtime_ns)
+        self.__readers = 0
+        self.__retired = False
+        self.__lock = threading.Lock()
+
+    @property
+    def path(self) -> str:
+        return self.__path
+
+    @property
+    def size(self) -> int:
+        return self.__stamp[1]
+
+    def is_modified(self) -> bool:
+        """ check whether the file was replaced or rewritten """
+        try:
+            info = os.stat(self.__path)
+        except OSError:
+            return True
+        return self.__stamp != (info.st_ino, info.st_size, info.st_mtime_ns)
+
+    def close(self):
+        self.__map.close()
+
+    @property
+    def closed(self) -> bool:
+        return self.__map.closed
+
+    def retain(self) -> bool:
+        """ return False if it's closed already """
+        with self.__lock:
+            if self.__map.closed:
+                return False
+            self.__readers += 1
+            return True
+
+    def release(self):
+        with self.__lock:
+            self.__readers -= 1
+            if self.__retired and self.__readers <= 0:
+                self.__map.close()
+
+    def retire(self):
+        """ close it now if no reader, or after the last reader released it """
+        with self.__lock:
+            self.__retired = True
+            if self.__readers <= 0:
+                self.__map.close()
+
+    def read(self, start: int = 0, end: Optional[int] = None) -> bytes:
+        """ copy the bytes out """
+        return self.__map[start:end]
+
+    def decode(self, start: int = 0, end: Optional[int] = None, encoding: str = 'utf-8') -> str:
+        """ decode directly from the mapped buffer """
+        view = memoryview(self.__map)
+        try:
+            return str(view[start:end], encoding)
+        except UnicodeDecodeError:
+            # broken file? keep the readable parts
+            return str(view[start:end], encoding, errors='replace')
+        finally:
+            view.release()
+
+    def split(self, limit: int) -> List[Tuple[int, int]]:
+        """ get ranges not larger than limit (bytes), at line breaks if possible """
+        ranges = []
+        buffer = self.__map
+        total = self.size
+        start = 0
+        while total - start > limit:
+            end = start + limit
+            pos = buffer.rfind(b'\n', start, end)
+            if pos >= start:
+                end = pos + 1
+            else:
+                # no line break, cut at UTF-8 character boundary
+                while end > start + 1 and buffer[end] & 0xC0 == 0x80:
+                    end -= 1
+            ranges.append((start, end))
+            start = end
+        if start < total:
+            ranges.append((start, total))
+        return ranges
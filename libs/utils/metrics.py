@@ -0,0 +1,212 @@
+# -*- coding: utf-8 -*-
+# ==============================================================================
+# MIT License
+#
+# Copyright (c) 2024 Albert Moky
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+# ==============================================================================
+
+"""
+    Metrics
+    ~~~~~~~
+
+    Counters & latency histograms with labels, exported as JSON file periodically
+"""
+
+import bisect
+import os
+import threading
+import time
+from typing import Optional, Tuple, List, Dict
+
+from dimples.utils import json_encode, utf8_encode
+from dimples.utils import Singleton, Runner, Logging
+
+
+class Histogram:
+    """ Count of values in each bucket (upper bounds) """
+
+    BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60)  # seconds
+
+    def __init__(self, buckets: Tuple[float, ...] = None):
+        super().__init__()
+        self.__buckets = self.BUCKETS if buckets is None else tuple(sorted(buckets))
+        self.__counts = [0] * (len(self.__buckets) + 1)  # the last one for overflow
+        self.__count = 0
+        self.__total = 0.0
+
+    @property
+    def count(self) -> int:
+        return self.__count
+
+    @property
+    def total(self) -> float:
+        return self.__total
+
+    def observe(self, value: float):
+        pos = bisect.bisect_left(self.__buckets, value)
+        self.__counts[pos] += 1
+        self.__count += 1
+        self.__total += value
+
+    def snapshot(self) -> Dict:
+        buckets = {}
+        for bound, count in zip(self.__buckets, self.__counts):
+            buckets[str(bound)] = count
+        buckets['inf'] = self.__counts[-1]
+        return {
+            'count': self.__count,
+            'sum': round(self.__total, 6),
+            'buckets': buckets,
+        }
+
+
+class Metrics:
+    """ Counters & histograms of one module, keyed by (name, labels) """
+
+    def __init__(self, name: str):
+        super().__init__()
+        self.__name = name
+        self.__counters: Dict[Tuple[str, str], float] = {}
+        self.__histograms: Dict[Tuple[str, str], Histogram] = {}
+        self.__lock = threading.Lock()
+
+    @property
+    def name(self) -> str:
+        return self.__name
+
+    def increase(self, name: str, labels: Dict[str, str] = None, value: float = 1):
+        key = (name, _labels_string(labels=labels))
+        with self.__lock:
+            self.__counters[key] = self.__counters.get(key, 0) + value
+
+    def observe(self, name: str, value: float, labels: Dict[str, str] = None):
+        key = (name, _labels_string(labels=labels))
+        with self.__lock:
+            histogram = self.__histograms.get(key)
+            if histogram is None:
+                histogram = self.__histograms[key] = Histogram()
+            histogram.observe(value=value)
+
+    def get_counter(self, name: str, labels: Dict[str, str] = None) -> float:
+        key = (name, _labels_string(labels=labels))
+        with self.__lock:
+            return self.__counters.get(key, 0)
+
+    def get_histogram(self, name: str, labels: Dict[str, str] = None) -> Optional[Histogram]:
+        key = (name, _labels_string(labels=labels))
+        with self.__lock:
+            return self.__histograms.get(key)
+
+    def snapshot(self) -> Dict:
+        """ { 'counters': { name: { labels: value } }, 'histograms': { name: { labels: {...} } } } """
+        counters = {}
+        histograms = {}
+        with self.__lock:
+            for (name, labels), value in self.__counters.items():
+                counters.setdefault(name, {})[labels] = value
+            for (name, labels), histogram in self.__histograms.items():
+                histograms.setdefault(name, {})[labels] = histogram.snapshot()
+        return {
+            'counters': counters,
+            'histograms': histograms,
+        }
+
+
+def _labels_string(labels: Optional[Dict[str, str]]) -> str:
+    """ 'key1=value1,key2=value2' """
+    if labels is None or len(labels) == 0:
+        return ''
+    return ','.join('%s=%s' % (key, labels[key]) for key in sorted(labels))
+
+
+@Singleton
+class MetricsRegistry:
+    """ All metrics in this process """
+
+    def __init__(self):
+        super().__init__()
+        self.__metrics: Dict[str, Metrics] = {}
+        self.__lock = threading.Lock()
+
+    def get_metrics(self, name: str) -> Metrics:
+        """ get (create if not exists) metrics with module name """
+        with self.__lock:
+            metrics = self.__metrics.get(name)
+            if metrics is None:
+                metrics = self.__metrics[name] = Metrics(name=name)
+            return metrics
+
+    @property
+    def names(self) -> List[str]:
+        with self.__lock:
+            return list(self.__metrics.keys())
+
+    def snapshot(self) -> Dict:
+        with self.__lock:
+            array = list(self.__metrics.values())
+        info = {}
+        for metrics in array:
+            info[metrics.name] = metrics.snapshot()
+        return info
+
+
+class MetricsExporter(Runner, Logging):
+    """ Write all metrics into a JSON file periodically """
+
+    INTERVAL = 60  # seconds
+
+    def __init__(self, path: str, interval: float = None):
+        super().__init__(interval=1.0)
+        self.__path = path
+        self.__export_interval = self.INTERVAL if interval is None or interval <= 0 else interval
+        self.__next_time = 0
+
+    @property
+    def path(self) -> str:
+        return self.__path
+
+    # Override
+    async def process(self) -> bool:
+        now = time.time()
+        if now < self.__next_time:
+            return False
+        self.__next_time = now + self.__export_interval
+        try:
+            self.export(now=now)
+        except Exception as error:
+            self.error(msg='failed to export metrics: %s, %s' % (self.__path, error))
+        return False
+
+    def export(self, now: float = None):
+        if now is None:
+            now = time.time()
+        info = {
+            'time': int(now),
+            'metrics': MetricsRegistry().snapshot(),
+        }
+        data = utf8_encode(string=json_encode(obj=info))
+        directory = os.path.dirname(self.__path)
+        if len(directory) > 0:
+            os.makedirs(directory, exist_ok=True)
+        tmp = '%s.tmp' % self.__path
+        with open(tmp, 'wb') as file:
+            file.write(data)
+        os.replace(tmp, self.__path)
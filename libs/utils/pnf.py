@@ -115,13 +115,22 @@ def filename_from_url(url: URI, filename: Optional[str]) -> str:
 
 
 def filename_from_data(data: bytes, filename: str) -> str:
+    ext = get_extension(filename=filename)
+    if _is_encoded(filename=filename, ext=ext):
+        # already encoded, no need to hash the data again
+        return filename
+    return filename_from_digest(digest=md5(data=data), filename=filename)
+
+
+def filename_from_digest(digest: bytes, filename: str) -> str:
+    """ build filename with MD5 digest of data, which was calculated before """
     # split file extension
     ext = get_extension(filename=filename)
     if _is_encoded(filename=filename, ext=ext):
         # already encoded
         return filename
-    # get filename from data
-    filename = hex_encode(data=md5(data=data))
+    # get filename from digest
+    filename = hex_encode(data=digest)
     if ext is None or len(ext) == 0:
         return filename
     else:
@@ -0,0 +1,251 @@
+# -*- coding: utf-8 -*-
+# ==============================================================================
+# MIT License
+#
+# Copyright (c) 2024 Albert Moky
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+# ==============================================================================
+
+
+"""
+    Profiler
+    ~~~~~~~~
+
+    Profile the running process on demand, triggered by signals or command file:
+        'cpu {seconds}'    - cProfile the event loop thread (packer, processor, emitter)
+        'stack {seconds}'  - sample stacks of all threads (services included), folded for flame graphs
+        'memory {top}'     - tracemalloc top-N allocations (tracing starts at the first call)
+"""
+
+import asyncio
+import cProfile
+import io
+import os
+import pstats
+import signal
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from typing import Optional
+
+from dimples.utils import Runner, Logging
+
+
+class Profiler(Runner, Logging):
+    """
+        Results are written into directory:
+            'cpu-{TIME}.prof' & 'cpu-{TIME}.txt'
+            'stack-{TIME}.folded'
+            'memory-{TIME}.txt'
+        commands are read from '{DIR}/profile.cmd', one command per line, deleted after read
+    """
+
+    CPU_SECONDS = 30
+    STACK_SECONDS = 30
+    STACK_INTERVAL = 0.005  # seconds
+    MEMORY_TOP = 30
+    MEMORY_FRAMES = 8
+
+    def __init__(self, directory: str, loop: asyncio.AbstractEventLoop):
+        super().__init__(interval=1.0)
+        self.__directory = directory
+        self.__loop = loop  # event loop of the messenger
+        self.__cpu: Optional[cProfile.Profile] = None
+        self.__sampling = False
+        self.__last_snapshot: Optional[tracemalloc.Snapshot] = None
+
+    @property
+    def directory(self) -> str:
+        return self.__directory
+
+    @property
+    def command_file(self) -> str:
+        return os.path.join(self.__directory, 'profile.cmd')
+
+    def install_signals(self) -> bool:
+        """ SIGUSR1: cpu, SIGUSR2: stack; call it in the main thread """
+        loop = self.__loop
+        try:
+            loop.add_signal_handler(signal.SIGUSR1, self.profile_cpu)
+            loop.add_signal_handler(signal.SIGUSR2, self.sample_stacks)
+        except (NotImplementedError, RuntimeError, AttributeError) as error:
+            self.warning(msg='profiling signals not supported: %s' % error)
+            return False
+        return True
+
+    # Override
+    async def process(self) -> bool:
+        path = self.command_file
+        if not os.path.exists(path):
+            return False
+        try:
+            with open(path, 'r') as file:
+                lines = file.readlines()
+            os.remove(path)
+        except OSError as error:
+            self.error(msg='failed to read command: %s, %s' % (path, error))
+            return False
+        for line in lines:
+            self.execute(command=line)
+        return False
+
+    def execute(self, command: str):
+        words = command.split()
+        if len(words) == 0:
+            return
+        name = words[0].lower()
+        value = int(words[1]) if len(words) > 1 and words[1].isdigit() else None
+        if name == 'cpu':
+            self.profile_cpu(seconds=value)
+        elif name == 'stack':
+            self.sample_stacks(seconds=value)
+        elif name == 'memory':
+            self.snapshot_memory(top=value)
+        else:
+            self.warning(msg='unknown profile command: %s' % command.strip())
+
+    def _output(self, prefix: str, ext: str) -> str:
+        os.makedirs(self.__directory, exist_ok=True)
+        name = '%s-%s.%s' % (prefix, time.strftime('%Y%m%d-%H%M%S'), ext)
+        return os.path.join(self.__directory, name)
+
+    #
+    #   cProfile
+    #
+
+    def profile_cpu(self, seconds: int = None):
+        """ profile the event loop thread for a while (thread safe) """
+        if seconds is None or seconds <= 0:
+            seconds = self.CPU_SECONDS
+        self.__loop.call_soon_threadsafe(self._start_cpu, seconds)
+
+    def _start_cpu(self, seconds: int):
+        if self.__cpu is not None:
+            self.warning(msg='cpu profiling already running')
+            return
+        self.info(msg='cpu profiling for %d seconds' % seconds)
+        self.__cpu = profile = cProfile.Profile()
+        profile.enable()
+        self.__loop.call_later(seconds, self._stop_cpu)
+
+    def _stop_cpu(self):
+        profile = self.__cpu
+        self.__cpu = None
+        if profile is None:
+            return
+        profile.disable()
+        path = self._output(prefix='cpu', ext='prof')
+        try:
+            profile.dump_stats(path)
+            text = io.StringIO()
+            stats = pstats.Stats(profile, stream=text)
+            stats.sort_stats(pstats.SortKey.CUMULATIVE).print_stats(50)
+            with open(path[:-5] + '.txt', 'w') as file:
+                file.write(text.getvalue())
+        except OSError as error:
+            self.error(msg='failed to save cpu profile: %s, %s' % (path, error))
+            return
+        self.info(msg='cpu profile saved: %s' % path)
+
+    #
+    #   Stack Sampling
+    #
+
+    def sample_stacks(self, seconds: int = None):
+        """ sample stacks of all threads in a background thread """
+        if seconds is None or seconds <= 0:
+            seconds = self.STACK_SECONDS
+        if self.__sampling:
+            self.warning(msg='stack sampling already running')
+            return
+        self.__sampling = True
+        thr = threading.Thread(target=self._sample, args=(seconds,), daemon=True, name='stack-sampler')
+        thr.start()
+
+    def _sample(self, seconds: int):
+        self.info(msg='stack sampling for %d seconds' % seconds)
+        stacks = Counter()
+        me = threading.get_ident()
+        end = time.time() + seconds
+        try:
+            while time.time() < end:
+                names = {thr.ident: thr.name for thr in threading.enumerate()}
+                for ident, frame in sys._current_frames().items():
+                    if ident == me:
+                        continue
+                    stacks[_fold(frame=frame, thread=names.get(ident, str(ident)))] += 1
+                time.sleep(self.STACK_INTERVAL)
+            path = self._output(prefix='stack', ext='folded')
+            with open(path, 'w') as file:
+                for stack, count in stacks.most_common():
+                    file.write('%s %d\n' % (stack, count))
+            self.info(msg='stack samples saved: %s, %d stacks' % (path, len(stacks)))
+        except Exception as error:
+            self.error(msg='failed to sample stacks: %s' % error)
+        finally:
+            self.__sampling = False
+
+    #
+    #   Memory
+    #
+
+    def snapshot_memory(self, top: int = None):
+        """ top allocations, and the differences since last snapshot """
+        if top is None or top <= 0:
+            top = self.MEMORY_TOP
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(self.MEMORY_FRAMES)
+            self.__last_snapshot = tracemalloc.take_snapshot()
+            self.info(msg='memory tracing started, call again to get the snapshot')
+            return
+        snapshot = tracemalloc.take_snapshot()
+        snapshot = snapshot.filter_traces([tracemalloc.Filter(False, tracemalloc.__file__)])
+        current, peak = tracemalloc.get_traced_memory()
+        lines = ['traced memory: current=%d, peak=%d' % (current, peak), '', '[ Top %d ]' % top]
+        for stat in snapshot.statistics('lineno')[:top]:
+            lines.append(str(stat))
+        last = self.__last_snapshot
+        if last is not None:
+            lines.extend(['', '[ Top %d differences ]' % top])
+            for stat in snapshot.compare_to(last, 'lineno')[:top]:
+                lines.append(str(stat))
+        self.__last_snapshot = snapshot
+        path = self._output(prefix='memory', ext='txt')
+        try:
+            with open(path, 'w') as file:
+                file.write('\n'.join(lines))
+                file.write('\n')
+        except OSError as error:
+            self.error(msg='failed to save memory snapshot: %s, %s' % (path, error))
+            return
+        self.info(msg='memory snapshot saved: %s' % path)
+
+
+def _fold(frame, thread: str) -> str:
+    """ 'thread;outer (file:line);...;inner (file:line)', line of function definition """
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append('%s (%s:%d)' % (code.co_name, os.path.basename(code.co_filename), code.co_firstlineno))
+        frame = frame.f_back
+    names.append(thread)
+    return ';'.join(reversed(names))
@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+import unittest
+
+from dimples import ReliableMessage
+
+from libs.client.dedup import DuplicateFilter
+
+
+def create_message(sig: str) -> ReliableMessage:
+    return ReliableMessage.parse(msg={
+        'sender': 'moky@4DnqXWdTV8wuZgfqSCX9GjE2kNq7HJrUgQ',
+        'receiver': 'hulk@4YeVEN3aUnvC1DNUufCq1bs9zoBSJTzVEj',
+        'time': 1700000000,
+        'data': 'BASE64',
+        'signature': sig,
+    })
+
+
+class DuplicateFilterTestCase(unittest.IsolatedAsyncioTestCase):
+
+    async def _verify(self, checker: DuplicateFilter, msg: ReliableMessage, ok: bool, calls: list) -> bool:
+        tag = await checker.acquire(msg=msg)
+        if tag is None:
+            return False
+        verified = False
+        try:
+            calls.append(tag)
+            await asyncio.sleep(0.01)
+            verified = ok
+        finally:
+            checker.release(tag=tag, verified=verified)
+        return verified
+
+    async def test_concurrent_copies(self):
+        checker = DuplicateFilter()
+        msg = create_message(sig='SIGNATURE1')
+        calls = []
+        results = await asyncio.gather(*[self._verify(checker, msg, True, calls) for _ in range(5)])
+        self.assertEqual(results.count(True), 1)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(checker.dropped, 4)
+        self.assertTrue(checker.duplicated(msg=msg))
+
+    async def test_failed_copy_not_recorded(self):
+        checker = DuplicateFilter()
+        msg = create_message(sig='SIGNATURE2')
+        calls = []
+        forged = self._verify(checker, msg, False, calls)
+        real = self._verify(checker, msg, True, calls)
+        results = await asyncio.gather(forged, real)
+        self.assertEqual(results, [False, True])
+        self.assertEqual(len(calls), 2)
+        self.assertTrue(checker.duplicated(msg=msg))
+
+
+if __name__ == '__main__':
+    unittest.main()
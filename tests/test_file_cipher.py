@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+
+import os
+import tempfile
+import unittest
+
+from dimples import SymmetricKey
+from dimples import FileContent
+import dimples.common  # noqa: F401  registers the crypto plugins for generating keys
+
+from libs.client.cipher import CHUNK_SIZE
+from libs.client.cipher import encrypt_file_data, get_file_params
+from libs.client.downloader import _decrypt_file
+
+
+class FileCipherTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.password = SymmetricKey.generate(algorithm=SymmetricKey.AES)
+        self.tmp = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def _upload(self, data: bytes) -> FileContent:
+        """ encrypt as the emitter does, 'IV' recorded in the content """
+        content = FileContent.file(filename='test.bin')
+        content.password = self.password
+        extra = {}
+        encrypted, filename = encrypt_file_data(data=data, filename='test.bin', password=self.password, extra=extra)
+        for key in extra:
+            content[key] = extra[key]
+        content.url = 'https://cdn.example.com/%s' % filename
+        path = os.path.join(self.tmp.name, filename)
+        with open(path, 'wb') as file:
+            file.write(encrypted)
+        self.path = path
+        return content
+
+    def _roundtrip(self, data: bytes):
+        content = self._upload(data=data)
+        # body encryption with the same key puts another 'IV' into the message, not the content
+        msg = {'content': content.dictionary}
+        self.password.encrypt(data=b'{"type": 16}', extra=msg)
+        self.assertNotEqual(msg['IV'], content.get('IV'))
+        params = get_file_params(content=content)
+        self.assertIsNotNone(params)
+        plain, name = _decrypt_file(self.path, self.password, params, content.filename)
+        self.assertEqual(plain, data)
+        self.assertTrue(name.endswith('.bin'))
+
+    def test_small_file(self):
+        self._roundtrip(data=os.urandom(1000))
+
+    def test_chunked_file(self):
+        # not multiple of the block size, crossing chunks
+        self._roundtrip(data=os.urandom(CHUNK_SIZE * 2 + 7))
+
+    def test_missing_iv(self):
+        content = self._upload(data=os.urandom(100))
+        content.pop('IV', None)
+        self.assertIsNone(get_file_params(content=content))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+import os
+import unittest
+
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+from dimples import ID
+
+from libs.client.cipher import CHUNK_SIZE
+from libs.client.uploader import HttpUploadBackend, Uploader, UploadDelegate
+
+
+SENDER = ID.parse(identifier='moky@4DnqXWdTV8wuZgfqSCX9GjE2kNq7HJrUgQ')
+
+
+class Delegate(UploadDelegate):
+
+    def __init__(self):
+        super().__init__()
+        self.results = []
+
+    async def upload_success(self, filename: str, url: str):
+        self.results.append((filename, url))
+
+    async def upload_failed(self, filename: str):
+        self.results.append((filename, None))
+
+
+class UploaderTestCase(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.requests = []
+        self.status = 200
+        app = web.Application(client_max_size=CHUNK_SIZE * 8)
+        app.router.add_post('/{sender}/upload', self._handle)
+        self.server = TestServer(app)
+        await self.server.start_server()
+        api = 'http://%s:%d/{ID}/upload?filename={FILENAME}' % (self.server.host, self.server.port)
+        self.backend = HttpUploadBackend(api=api)
+
+    async def asyncTearDown(self):
+        await self.backend.close()
+        await self.server.close()
+
+    async def _handle(self, request: web.Request) -> web.Response:
+        self.requests.append(request.query.get('filename'))
+        if self.status != 200:
+            return web.Response(status=self.status)
+        reader = await request.multipart()
+        part = await reader.next()
+        self.assertEqual(part.name, 'file')
+        data = await part.read()
+        self.received = (part.filename, bytes(data))
+        return web.json_response({'url': 'https://cdn.example.com/%s' % part.filename})
+
+    async def _upload(self, data: bytes, filename: str) -> Delegate:
+        delegate = Delegate()
+        uploader = Uploader(backend=self.backend, delegate=delegate, max_retries=2)
+        uploader.RETRY_DELAY = 0.01
+        self.assertTrue(uploader.upload(data=data, filename=filename, sender=SENDER))
+        while uploader.pending > 0:
+            await asyncio.sleep(0.01)
+        return delegate
+
+    async def test_multipart_streaming(self):
+        # larger than one chunk, not multiple of the chunk size
+        data = os.urandom(CHUNK_SIZE * 2 + 100)
+        delegate = await self._upload(data=data, filename='abc.bin')
+        self.assertEqual(delegate.results, [('abc.bin', 'https://cdn.example.com/abc.bin')])
+        self.assertEqual(self.received, ('abc.bin', data))
+
+    async def test_client_error_not_retried(self):
+        self.status = 413
+        delegate = await self._upload(data=b'too large', filename='big.bin')
+        self.assertEqual(delegate.results, [('big.bin', None)])
+        self.assertEqual(len(self.requests), 1)
+
+    async def test_server_error_retried(self):
+        self.status = 503
+        delegate = await self._upload(data=b'data', filename='retry.bin')
+        self.assertEqual(delegate.results, [('retry.bin', None)])
+        self.assertEqual(len(self.requests), 3)
+
+
+if __name__ == '__main__':
+    unittest.main()